@@ -0,0 +1,26 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Micro-benchmarks for the hot paths of the web hook handlers. Each module can
+be run from the top-level directory with "python -m benchmarks.<name>".
+"""
+
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "github_webhooks.settings")
+
+
+def best_of(repeat, function, *args):
+    """
+    Calls |function| with |args| |repeat| times and returns the shortest
+    time it took, in seconds.
+    """
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return min(times)
@@ -0,0 +1,43 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Measures trybot_control.models.render_builder_statuses() on pull requests
+with an increasing number of builds (several builders, each of which may
+have been retried a few times). The time per build should stay the same.
+"""
+
+import random
+
+from django.conf import settings
+
+from benchmarks import best_of
+from trybot_control.models import *
+
+
+BUILDERS = ('crosswalk-linux', 'crosswalk-win', 'Crosswalk Android x86',
+            'Crosswalk Android ARM', 'crosswalk-tizen', 'Crosswalk Lite')
+
+
+def make_builds(count):
+    rng = random.Random(count)
+    statuses = (STATUS_PENDING, STATUS_FAILURE, STATUS_SUCCESS)
+    return [(rng.choice(BUILDERS), rng.randint(1, 100000), rng.choice(statuses))
+            for i in xrange(count)]
+
+
+def main():
+    settings.TRYBOT_BASE_URL = 'http://build.crosswalk-project.org'
+
+    print '%10s %10s %12s' % ('builds', 'time', 'us/build')
+    for count in (10, 100, 1000, 10000):
+        builds = make_builds(count)
+        elapsed = best_of(20, render_builder_statuses, 'user/crosswalk',
+                          'deadbeef' * 5, builds)
+        print '%10d %8.2fms %12.2f' % (count, elapsed * 1000,
+                                       elapsed * 1000000 / count)
+
+
+if __name__ == '__main__':
+    main()
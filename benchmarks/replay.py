@@ -0,0 +1,577 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Replays GitHub and Buildbot traffic against the web application, which runs
+in-process as a WSGI application, and reports the latency, throughput and
+number of queries of each endpoint, as well as the time taken by the jobs the
+handlers queue.
+
+GitHub, Buildbot and JIRA are replaced by local stand-in servers that answer
+after --latency seconds and fail a fraction --error-rate of the requests with
+a 502. The jobs are run by --workers threads while the traffic is replayed,
+so the patches they send to the Buildbot stand-in turn into build events that
+are replayed as well. For example:
+
+    python -m benchmarks.replay --requests 2000 --rate 100 --concurrency 8 \\
+        --latency 0.05 --error-rate 0.01
+
+By default, the traffic is synthetic: pull requests are opened, updated and
+merged (some of them mentioning JIRA issues), and built by a few builders.
+With --replay FILE, recorded deliveries are sent instead, in a loop. FILE has
+one JSON object per line, either {"path": ..., "event": ..., "payload": ...}
+for a GitHub delivery (which is signed again with GITHUB_HOOK_SECRET) or
+{"path": ..., "packets": [...]} for Buildbot status packets.
+
+With --rate, requests are sent on a fixed schedule and latencies are
+measured from the time each request was due, so an application that cannot
+keep up shows a higher latency instead of a lower request rate. Without it,
+each of the --concurrency clients sends requests back to back.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import collections
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, reset_queries
+from django.test.utils import setup_test_environment
+from django.utils import timezone
+
+from github_webhooks import github
+from github_webhooks.jobs import claim_job, run_job
+from github_webhooks.models import Job, JOB_QUEUED, JOB_RUNNING
+from github_webhooks.test.utils import mock_pull_request_payload
+from updater_for_jira import jirahelper
+
+
+GITHUB_PATH = '/github-hooks/'
+BUILDBOT_PATH = '/trybot_control/buildbot'
+BUILDERS = ('crosswalk-linux', 'crosswalk-android', 'crosswalk-windows')
+PATCH = '+++ some/file\n--- some/file\n+ new line\n' * 100
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    do_DELETE = do_PATCH = do_POST = do_PUT = do_GET
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    break
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        return body
+
+    def _handle(self):
+        stand_in = self.server.stand_in
+        body = self._read_body()
+        time.sleep(stand_in.latency)
+        if stand_in.random.random() < stand_in.error_rate:
+            status, response = 502, 'Injected error'
+        else:
+            status, response = stand_in.handler(self.command, self.path, body)
+        stand_in.record(status)
+
+        content_type = 'text/plain'
+        if not isinstance(response, basestring):
+            content_type = 'application/json'
+            response = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class StandInServer(object):
+    """
+    A local HTTP server standing in for the |name| service. Requests are
+    answered by |handler|(method, path, body), which returns a (status code,
+    body) tuple (bodies that are not strings are sent as JSON), after
+    |latency| seconds. A fraction |error_rate| of the requests fail with a
+    502 instead.
+    """
+    def __init__(self, name, handler, latency, error_rate, seed):
+        self.name = name
+        self.handler = handler
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # Number of responses by status code.
+        self.responses = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                           _StandInRequestHandler)
+        self.server.stand_in = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def record(self, status):
+        with self.lock:
+            self.responses[status] += 1
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class GitHubStandIn(object):
+    """
+    Answers the GitHub API requests sent by the trybot: patch downloads,
+    comments and commit statuses.
+    """
+    def __init__(self):
+        self.comment_ids = iter(xrange(1, sys.maxint))
+        self.lock = threading.Lock()
+
+    def __call__(self, method, path, body):
+        if method == 'GET' and path.endswith('.patch'):
+            return 200, PATCH
+        if method == 'POST' and path.endswith('/comments'):
+            with self.lock:
+                return 201, {'id': next(self.comment_ids)}
+        if method == 'POST' and '/statuses/' in path:
+            return 201, {}
+        if method == 'PATCH' and '/issues/comments/' in path:
+            return 200, {}
+        return 404, {'message': 'Not Found'}
+
+
+class BuildbotStandIn(object):
+    """
+    Accepts patches and requests to stop builds. Every patch that is sent
+    makes |traffic| replay the start and the end of its builds later.
+    """
+    def __init__(self, traffic):
+        self.traffic = traffic
+
+    def __call__(self, method, path, body):
+        if method != 'POST':
+            return 404, ''
+        if path.endswith('/stop'):
+            return 200, ''
+        form = urlparse.parse_qs(body)
+        if 'issue' in form:
+            self.traffic.add_builds(int(form['issue'][0]))
+        return 200, ''
+
+
+def jira_stand_in(method, path, body):
+    """
+    Answers the JIRA REST API requests sent when commenting on and resolving
+    issues.
+    """
+    path = urlparse.urlparse(path).path
+    parts = path.strip('/').split('/')
+    if path == '/rest/auth/1/session':
+        return 200, {'name': settings.JIRA_USER}
+    if path == '/rest/api/2/serverInfo':
+        return 200, {'version': '6.4.0', 'versionNumbers': [6, 4, 0]}
+    if parts[:3] != ['rest', 'api', '2'] or len(parts) < 5 or \
+       parts[3] != 'issue':
+        return 404, {}
+    key = parts[4]
+    if len(parts) == 5 and method == 'GET':
+        return 200, {
+            'id': key.rsplit('-', 1)[1], 'key': key,
+            'self': 'http://jira/rest/api/2/issue/%s' % key,
+            'fields': {'project': {'key': key.rsplit('-', 1)[0]},
+                       'issuetype': {'id': '1'}, 'status': {'id': '1'}},
+        }
+    if parts[5:] == ['comment'] and method == 'POST':
+        return 201, {'id': '1', 'body': json.loads(body)['body']}
+    if parts[5:] == ['transitions']:
+        if method == 'GET':
+            return 200, {'transitions': [
+                {'id': '5', 'name': settings.JIRA_TRANSITION_RESOLVE_NAME}]}
+        return 204, ''
+    return 404, {}
+
+
+class Traffic(object):
+    """
+    Produces the requests to replay, as (path, body, content type, headers)
+    tuples. Requests carrying Buildbot packets for builds that are due are
+    interleaved with the GitHub deliveries, which come from |recorded| (a
+    list of JSON objects, see the module documentation) or are synthetic.
+    """
+    def __init__(self, recorded, seed):
+        self.recorded = recorded
+        # URL of the GitHub stand-in the patches are downloaded from.
+        self.github_url = None
+        self.random = random.Random(seed)
+        # Buildbot packets waiting to be sent.
+        self.packets = collections.deque()
+        # Numbers of the synthetic pull requests that are open.
+        self.open_pull_requests = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add_builds(self, issue):
+        with self.lock:
+            for number, builder in enumerate(BUILDERS):
+                build = {'builderName': builder, 'number': issue,
+                         'properties': [('issue', issue, '')]}
+                self.packets.append({'event': 'buildStarted',
+                                     'payload': {'build': build}})
+                finished = dict(build, results=self.random.choice((0, 0, 2)))
+                self.packets.append({'event': 'buildFinished',
+                                     'payload': {'build': finished}})
+
+    def next_request(self):
+        with self.lock:
+            self.count += 1
+            if self.packets and self.random.random() < 0.5:
+                # Buildbot sends a few packets at a time.
+                packets = [self.packets.popleft()
+                           for i in xrange(min(3, len(self.packets)))]
+                return buildbot_request(BUILDBOT_PATH, packets)
+            if self.recorded:
+                entry = self.recorded[self.count % len(self.recorded)]
+                if 'packets' in entry:
+                    return buildbot_request(entry['path'], entry['packets'])
+                return github_request(entry['path'], entry['payload'],
+                                      entry.get('event', 'pull_request'))
+            return github_request(GITHUB_PATH, self._next_delivery(),
+                                  'pull_request')
+
+    def _next_delivery(self):
+        payload = mock_pull_request_payload()
+        pull_request = payload['pull_request']
+        choice = self.random.random()
+        if not self.open_pull_requests or choice < 0.4:
+            number = self.count
+            self.open_pull_requests.append(number)
+        else:
+            number = self.random.choice(self.open_pull_requests)
+            if choice < 0.85:
+                payload['action'] = 'synchronize'
+            else:
+                payload['action'] = 'closed'
+                pull_request['merged'] = True
+                self.open_pull_requests.remove(number)
+
+        pull_request['number'] = number
+        pull_request['head']['sha'] = hashlib.sha1(str(self.count)).hexdigest()
+        pull_request['patch_url'] = '%s/crosswalk-project/crosswalk/pull/' \
+                                    '%d.patch' % (self.github_url, number)
+        if self.random.random() < 0.3:
+            pull_request['body'] += '\n\nBUG=%s-%d' % \
+                                    (settings.JIRA_PROJECTS[0], number)
+        return payload
+
+
+def github_request(path, payload, event):
+    body = json.dumps(payload)
+    signature = hmac.new(settings.GITHUB_HOOK_SECRET, body, hashlib.sha1)
+    headers = {'X-GitHub-Event': event,
+               'X-GitHub-Delivery': str(uuid.uuid4()),
+               'X-Hub-Signature': 'sha1=%s' % signature.hexdigest()}
+    return path, body, 'application/json', headers
+
+
+def buildbot_request(path, packets):
+    body = urllib.urlencode({'packets': json.dumps(packets)})
+    return path, body, 'application/x-www-form-urlencoded', {}
+
+
+def call(application, path, body, content_type, headers):
+    """
+    Posts |body| to |path| through the WSGI |application| and returns the
+    status code of the response and the number of queries it took.
+    """
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO.StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.iteritems():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+    status = []
+    result = application(environ, lambda s, h, e=None: status.append(s))
+    try:
+        ''.join(result)
+        # The queries are reset when the request starts, and kept when the
+        # connection is closed after it.
+        queries = len(connection.queries)
+    finally:
+        result.close()
+    return int(status[0].split()[0]), queries
+
+
+class Stats(object):
+    """
+    Latencies, errors and number of queries grouped by a name (an endpoint
+    or a job task).
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.queries = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, failed, queries=0):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.queries[name] += queries
+            if failed:
+                self.errors[name] += 1
+
+    def print_table(self, title, elapsed, show_queries):
+        print ('%-44s %8s %6s %9s %9s %8s %s' % (
+            title, 'count', 'errors', 'p50', 'p99', 'per sec',
+            'queries' if show_queries else '')).rstrip()
+        for name in sorted(self.latencies):
+            latencies = self.latencies[name]
+            queries = ''
+            if show_queries:
+                queries = '%7.1f' % (float(self.queries[name]) /
+                                     len(latencies))
+            print ('%-44s %8d %6d %7.1fms %7.1fms %8.1f %s' % (
+                name, len(latencies), self.errors[name],
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                len(latencies) / elapsed, queries)).rstrip()
+
+
+def send_requests(application, traffic, options, stats):
+    """
+    Sends |options.requests| requests from |options.concurrency| threads.
+    Returns the number of seconds it took.
+    """
+    counter = iter(xrange(options.requests))
+    counter_lock = threading.Lock()
+    start = time.time()
+
+    def client():
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            due = time.time()
+            if options.rate:
+                due = start + float(index) / options.rate
+                time.sleep(max(0, due - time.time()))
+            path, body, content_type, headers = traffic.next_request()
+            try:
+                status, queries = call(application, path, body, content_type,
+                                       headers)
+            except Exception:
+                logging.exception('Request to %s failed.' % path)
+                status, queries = 500, 0
+            stats.record(path, time.time() - due, status >= 400, queries)
+
+    clients = [threading.Thread(target=client)
+               for i in xrange(options.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return time.time() - start
+
+
+def run_jobs(stop, stats):
+    """
+    Runs jobs as they are queued until |stop| is set, like process_jobs
+    --loop does.
+    """
+    while not stop.is_set():
+        job = claim_job()
+        if job is None:
+            time.sleep(0.01)
+            continue
+        start = time.time()
+        succeeded = run_job(job)
+        stats.record(job.task, time.time() - start, not succeeded)
+        # Queries are only logged to be counted in the requests.
+        reset_queries()
+    connection.close()
+
+
+def wait_for_jobs(timeout):
+    """
+    Waits until there are no jobs left to run now (jobs being retried later
+    are left alone), or for |timeout| seconds.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pending = Job.objects.filter(run_after__lte=timezone.now(),
+                                     state__in=(JOB_QUEUED, JOB_RUNNING))
+        if not pending.exists():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def configure(github_server, buildbot_server, jira_server):
+    settings.DEBUG = True
+    settings.GITHUB_API_URL = github_server.url
+    settings.GITHUB_REQUESTS_PER_SECOND = 10000
+    settings.GITHUB_REQUESTS_BURST = 10000
+    settings.GITHUB_RETRY_BACKOFF = 0
+    settings.TRYBOT_BASE_URL = buildbot_server.url
+    settings.TRYBOT_SEND_PATCH_URL = buildbot_server.url + '/send_try_patch'
+    settings.JIRA_SERVER = jira_server.url
+    settings.JIRA_VERIFY_SSL = False
+    settings.JIRA_PROJECTS = ('PROJ',)
+    settings.JIRA_TRANSITION_RESOLVE_NAME = 'Resolve'
+    settings.JIRA_RESOLUTION_FIXED_ID = '1'
+    github.reset_session()
+    jirahelper.reset_client_pool()
+
+
+def main():
+    parser = optparse.OptionParser(usage='python -m benchmarks.replay '
+                                         '[options]')
+    parser.add_option('--requests', type='int', default=1000,
+                      help='Number of requests to send.')
+    parser.add_option('--rate', type='float', default=0,
+                      help='Requests per second (default: as fast as '
+                           'possible).')
+    parser.add_option('--concurrency', type='int', default=4,
+                      help='Number of requests sent at the same time.')
+    parser.add_option('--workers', type='int', default=2,
+                      help='Number of threads running jobs.')
+    parser.add_option('--latency', type='float', default=0.02,
+                      help='Seconds the stand-in servers take to answer.')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help='Fraction of the requests to the stand-in '
+                           'servers that fail.')
+    parser.add_option('--replay', metavar='FILE',
+                      help='Replay the deliveries recorded in FILE.')
+    parser.add_option('--drain-timeout', type='float', default=60,
+                      help='Seconds to wait for the queued jobs to run once '
+                           'all requests have been sent.')
+    parser.add_option('--seed', type='int', default=42)
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help='Show the messages logged by the application.')
+    options, args = parser.parse_args()
+
+    if not options.verbose:
+        logging.disable(logging.CRITICAL)
+    recorded = []
+    if options.replay:
+        with open(options.replay) as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+
+    traffic = Traffic(recorded, options.seed)
+    servers = [
+        StandInServer('github', GitHubStandIn(), options.latency,
+                      options.error_rate, options.seed),
+        StandInServer('buildbot', BuildbotStandIn(traffic), options.latency,
+                      options.error_rate, options.seed + 1),
+        StandInServer('jira', jira_stand_in, options.latency,
+                      options.error_rate, options.seed + 2),
+    ]
+    traffic.github_url = servers[0].url
+    configure(*servers)
+
+    # Threads get their own database connections, so an in-memory SQLite
+    # database cannot be used.
+    setup_test_environment()
+    test_dir = None
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        test_dir = tempfile.mkdtemp()
+        settings.DATABASES['default']['TEST_NAME'] = \
+            os.path.join(test_dir, 'replay.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0)
+    connection.close()
+
+    application = get_wsgi_application()
+    request_stats = Stats()
+    job_stats = Stats()
+    stop = threading.Event()
+    workers = [threading.Thread(target=run_jobs, args=(stop, job_stats))
+               for i in xrange(options.workers)]
+    try:
+        start = time.time()
+        for thread in workers:
+            thread.start()
+        elapsed = send_requests(application, traffic, options, request_stats)
+        drained = wait_for_jobs(options.drain_timeout)
+        total_elapsed = time.time() - start
+    finally:
+        stop.set()
+        for thread in workers:
+            thread.join()
+        for server in servers:
+            server.shutdown()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if test_dir is not None:
+            shutil.rmtree(test_dir)
+
+    request_stats.print_table('endpoint', elapsed, True)
+    print
+    job_stats.print_table('job', total_elapsed, False)
+    if not drained:
+        print 'Some jobs were still queued after %ds.' % options.drain_timeout
+    print
+    for server in servers:
+        print '%-8s %s' % (server.name, ', '.join(
+            '%d: %d' % item for item in sorted(server.responses.items())))
+
+
+if __name__ == '__main__':
+    main()
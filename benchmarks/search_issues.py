@@ -0,0 +1,56 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Measures updater_for_jira.views.search_issues() on pull request bodies of
+increasing size, made mostly of pasted build logs with a few issue references
+and BUG= lines. The time per MB should stay the same as the size grows.
+"""
+
+import random
+
+from django.conf import settings
+
+from benchmarks import best_of
+from updater_for_jira.views import search_issues
+
+
+LOG_LINES = (
+    '[ 42%] Building CXX object xwalk/runtime/CMakeFiles/xwalk.dir/foo.cc.o',
+    'FAILED: XWalkRuntimeTest.LoadsApplication (1234 ms)',
+    'W/chromium(12345): [WARNING:render_process_host_impl.cc(1871)] crashed',
+    'See PROJ-%d for the details.',
+    'Traceback (most recent call last):',
+    '    at org.xwalk.core.XWalkView.load(XWalkView.java:123)',
+)
+
+
+def make_body(size):
+    rng = random.Random(size)
+    lines = ['This fixes a crash when loading applications.', '']
+    length = 0
+    while length < size:
+        line = rng.choice(LOG_LINES)
+        if '%d' in line:
+            line = line % rng.randint(1, 9999)
+        lines.append(line)
+        length += len(line) + 1
+    lines.extend(['', 'BUG=PROJ-1234', 'BUG=https://jira/browse/OTHERPROJ-56'])
+    return '\r\n'.join(lines)
+
+
+def main():
+    settings.JIRA_PROJECTS = ('PROJ', 'OTHERPROJ')
+
+    print '%10s %10s %10s %8s' % ('size', 'issues', 'time', 'MB/s')
+    for size_kb in (16, 64, 256, 1024, 4096):
+        body = make_body(size_kb * 1024)
+        elapsed = best_of(5, search_issues, body)
+        issues = len(search_issues(body))
+        print '%8dKB %10d %8.1fms %8.1f' % (size_kb, issues, elapsed * 1000,
+                                            len(body) / 1048576. / elapsed)
+
+
+if __name__ == '__main__':
+    main()
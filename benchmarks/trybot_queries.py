@@ -0,0 +1,99 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Measures the queries run by sync_trybot_status and by the Buildbot and GitHub
+handlers on a test database seeded with a growing number of old pull
+requests (superseded heads whose builds never finished, which is what
+accumulates over time). Only a few pull requests need to be synced at any
+time, so the number of queries and their latency should stay the same as
+the history grows.
+"""
+
+from django.db import connection, reset_queries
+from django.conf import settings
+from django.db.models import Q
+from django.test.utils import setup_test_environment
+
+from benchmarks import best_of
+from trybot_control.models import *
+
+
+BATCH_SIZE = 500
+DIRTY = 20
+
+
+def seed(start, count):
+    for first in xrange(start, start + count, BATCH_SIZE):
+        numbers = xrange(first, min(start + count, first + BATCH_SIZE))
+        PullRequest.objects.bulk_create(
+            PullRequest(number=n, head_sha='%040x' % n,
+                        base_repo_path='crosswalk-project/crosswalk',
+                        head_repo_path='user/crosswalk', comment_id=n,
+                        needs_sync=False, superseded=True)
+            for n in numbers)
+    pks = PullRequest.objects.filter(number__gte=start).values_list(
+        'pk', flat=True)
+    for first in xrange(0, len(pks), BATCH_SIZE):
+        TrybotBuild.objects.bulk_create(
+            TrybotBuild(pull_request_id=pk, builder_name='crosswalk-linux',
+                        build_number=pk)
+            for pk in pks[first:first + BATCH_SIZE])
+
+
+def dirty():
+    PullRequest.objects.filter(
+        pk__in=PullRequest.objects.order_by('-pk').values_list(
+            'pk', flat=True)[:DIRTY]).update(needs_sync=True, superseded=False)
+
+
+def hot_queries(number):
+    list(PullRequest.objects.filter(needs_sync=True, superseded=False))
+    PullRequest.objects.filter(status__in=FINISHED_STATUSES).filter(
+        Q(needs_sync=False) | Q(superseded=True)).count()
+    TrybotBuild.objects.get(master='', builder_name='crosswalk-linux',
+                            build_number=number)
+    PullRequest.objects.get(base_repo_path='crosswalk-project/crosswalk',
+                            number=number, head_sha='%040x' % number)
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return '; '.join(row[-1] for row in cursor.fetchall())
+
+
+def main():
+    setup_test_environment()
+    settings.DEBUG = True
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        print '%10s %10s %10s' % ('history', 'queries', 'time')
+        seeded = 0
+        for size in (1000, 10000, 100000):
+            seed(seeded + 1, size - seeded)
+            seeded = size
+            dirty()
+            reset_queries()
+            hot_queries(size / 2)
+            queries = len(connection.queries)
+            elapsed = best_of(20, hot_queries, size / 2)
+            print '%10d %10d %8.2fms' % (size, queries, elapsed * 1000)
+
+        if connection.vendor == 'sqlite':
+            print
+            print 'needs_sync:', explain(PullRequest.objects.filter(
+                needs_sync=True, superseded=False))
+            print 'finished:  ', explain(PullRequest.objects.filter(
+                status__in=FINISHED_STATUSES))
+            print 'head:      ', explain(PullRequest.objects.filter(
+                base_repo_path='crosswalk-project/crosswalk', number=1,
+                head_sha='0' * 40))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Measures github_webhooks.signatures.verify_request() on deliveries of
+increasing size, signed with the current secret or with an old one right
+after the hooks have switched to it, compared to keying a new HMAC object for
+every delivery. Verifying with the current secret should never be slower than
+keying a new HMAC object, and the old secret should cost one more HMAC.
+"""
+
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.test import RequestFactory
+from django.utils.crypto import constant_time_compare
+
+from benchmarks import best_of
+from github_webhooks import signatures
+
+
+REPEAT = 1000
+
+
+def make_requests(body, secret):
+    signature = 'sha256=%s' % hmac.new(secret, body, hashlib.sha256) \
+                                  .hexdigest()
+    requests = []
+    for i in xrange(REPEAT):
+        request = RequestFactory().post('/', body, content_type='text/plain')
+        request.META['HTTP_X_HUB_SIGNATURE_256'] = signature
+        requests.append(request)
+    return requests
+
+
+def verify_all(requests):
+    for request in requests:
+        assert signatures.verify_request(request)
+
+
+def verify_all_with_old_secret(requests):
+    ring = signatures.secret_ring()
+    for request in requests:
+        # As if the hooks had just switched secrets.
+        ring.promote('current secret')
+        assert signatures.verify_request(request)
+
+
+def rekey_all(requests):
+    for request in requests:
+        mac = hmac.new(settings.GITHUB_HOOK_SECRET, request.body,
+                       hashlib.sha256)
+        assert constant_time_compare(
+            'sha256=' + mac.hexdigest(),
+            request.META['HTTP_X_HUB_SIGNATURE_256'])
+
+
+def main():
+    settings.GITHUB_HOOK_SECRET = 'current secret'
+    settings.GITHUB_HOOK_OLD_SECRETS = ('old secret',)
+
+    print '%10s %12s %12s %12s' % ('body', 'rekeyed', 'current', 'old')
+    for size in (100, 1000, 10000, 100000):
+        body = 'x' * size
+        # The body is read from the requests the first time, and reused
+        # afterwards.
+        current = make_requests(body, 'current secret')
+        old = make_requests(body, 'old secret')
+        results = [best_of(5, function, requests) * 1000000 / REPEAT
+                   for function, requests in (
+                       (rekey_all, current), (verify_all, current),
+                       (verify_all_with_old_secret, old))]
+        print '%10d %10.1fus %10.1fus %10.1fus' % ((size,) + tuple(results))
+
+
+if __name__ == '__main__':
+    main()
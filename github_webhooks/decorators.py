@@ -2,11 +2,66 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+from functools import wraps
+
+from django.http import HttpResponse
+from django.utils.decorators import available_attrs
 from django.utils.decorators import decorator_from_middleware
 
+from github_webhooks import deliveries
+from github_webhooks.filters import EventFilter
 from github_webhooks.middleware import PayloadMiddleware
 from github_webhooks.middleware import SignatureMiddleware
 
 
 add_github_payload = decorator_from_middleware(PayloadMiddleware)
 require_github_signature = decorator_from_middleware(SignatureMiddleware)
+
+
+def filter_github_events(events, actions=None, repositories=None,
+                         branches=None):
+    """
+    Makes a view ignore any deliveries not matching an EventFilter built from
+    the arguments. It must be applied before add_github_payload, so that
+    deliveries of other event types are dropped before their payload is
+    decoded.
+    """
+    def decorator(view_func):
+        event_filter = EventFilter(
+            '%s.%s' % (view_func.__module__, view_func.__name__),
+            events, actions, repositories, branches)
+
+        @wraps(view_func, assigned=available_attrs(view_func))
+        def _wrapped_view(request, *args, **kwargs):
+            if not event_filter.accepts_request(request):
+                return HttpResponse()
+            # PayloadMiddleware checks the rest once it has the payload.
+            request.github_event_filter = event_filter
+            return view_func(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
+
+
+def ignore_duplicate_deliveries(view_func):
+    """
+    Makes a view answer deliveries whose X-GitHub-Delivery header has already
+    been seen with an empty response, without calling the view. Must be
+    applied after require_github_signature, so that only genuine deliveries
+    are recorded, and after add_github_payload, so that deliveries dropped by
+    the view's filters are not recorded either.
+    """
+    @wraps(view_func, assigned=available_attrs(view_func))
+    def _wrapped_view(request, *args, **kwargs):
+        delivery = request.META.get('HTTP_X_GITHUB_DELIVERY')
+        if delivery is None:
+            return view_func(request, *args, **kwargs)
+        key = 'delivery:%s' % delivery
+        if deliveries.is_duplicate(key):
+            return HttpResponse()
+        try:
+            return view_func(request, *args, **kwargs)
+        except Exception:
+            # Let GitHub try again.
+            deliveries.forget(key)
+            raise
+    return _wrapped_view
@@ -0,0 +1,140 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Detection of GitHub deliveries that have already been handled.
+
+GitHub sends a delivery again when it does not get a response in time, which
+would make us test the same patch series twice. Deliveries are identified by
+their X-GitHub-Delivery header, and consumers can also use keys of their own
+(such as a pull request number and its head SHA) for events that GitHub
+considers different but are the same to them.
+
+Keys are remembered for GITHUB_DELIVERY_TTL seconds in the Delivery table,
+whose unique constraint makes checking and recording a key a single INSERT
+shared by all processes. The most recent GITHUB_DELIVERY_CACHE_SIZE keys are
+also kept in memory, so that repeated deliveries arriving at the same process
+are recognized without a query.
+"""
+
+import collections
+import datetime
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from github_webhooks.models import Delivery
+
+
+class RecentKeys(object):
+    """
+    A thread-safe set of at most |max_size| keys, each of which is forgotten
+    |ttl| seconds after being added. The least recently added keys are
+    dropped first when the set is full.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Maps keys to their expiration time.
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.keys.get(key)
+            if expires is None:
+                return False
+            if time.time() >= expires:
+                del self.keys[key]
+                return False
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+            self.keys[key] = time.time() + self.ttl
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+
+_recent_keys = None
+_recent_keys_lock = threading.Lock()
+
+
+def recent_keys():
+    """
+    Returns the RecentKeys shared by the whole process, creating it if
+    necessary.
+    """
+    global _recent_keys
+    with _recent_keys_lock:
+        if _recent_keys is None:
+            _recent_keys = RecentKeys(settings.GITHUB_DELIVERY_CACHE_SIZE,
+                                      settings.GITHUB_DELIVERY_TTL)
+        return _recent_keys
+
+
+def reset_recent_keys():
+    """
+    Empties the in-memory cache, so that only the database is checked.
+    """
+    global _recent_keys
+    with _recent_keys_lock:
+        _recent_keys = None
+
+
+def is_duplicate(key):
+    """
+    Returns True if |key| has been seen in the last GITHUB_DELIVERY_TTL
+    seconds. Otherwise, records it and returns False.
+    """
+    hashed_key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if hashed_key in recent_keys():
+        return True
+
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            Delivery.objects.create(key=hashed_key, created_at=now)
+    except IntegrityError:
+        # It is either a duplicate or an expired key that has not been purged
+        # yet, in which case it counts as a new one.
+        expired = Delivery.objects.filter(
+            key=hashed_key, created_at__lt=_expiration_time(now)).update(
+            created_at=now)
+        if not expired:
+            recent_keys().add(hashed_key)
+            return True
+    recent_keys().add(hashed_key)
+    return False
+
+
+def forget(key):
+    """
+    Forgets |key|, so that it is not considered a duplicate if it is seen
+    again (e.g. because handling it failed).
+    """
+    hashed_key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    recent_keys().discard(hashed_key)
+    Delivery.objects.filter(key=hashed_key).delete()
+
+
+def purge_deliveries():
+    """
+    Deletes the keys older than GITHUB_DELIVERY_TTL seconds from the database.
+    """
+    Delivery.objects.filter(
+        created_at__lt=_expiration_time(timezone.now())).delete()
+
+
+def _expiration_time(now):
+    return now - datetime.timedelta(seconds=settings.GITHUB_DELIVERY_TTL)
@@ -0,0 +1,159 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Fan-out of GitHub pull request events to the applications that consume them.
+
+The ingress view in github_webhooks.views verifies and decodes each delivery
+once and sends the pull_request_changed signal with its payload. Applications
+register consumers with the pull_request_consumer() decorator, which connects
+them to the signal and wraps them so that:
+- Only the payloads accepted by the consumer's EventFilter reach it.
+- An exception raised by a consumer is logged instead of propagating, so it
+  does not prevent the other consumers from running. ConsumerFailed is raised
+  once they have all run, so that the delivery is answered with an error and
+  can be redelivered by GitHub.
+- Each consumer records the deliveries it has handled successfully (see
+  github_webhooks.deliveries), so a redelivery only reaches the consumers
+  that failed.
+- The time spent in each consumer is recorded, and consumers taking longer
+  than GITHUB_CONSUMER_SLOW_THRESHOLD seconds are logged. Consumers run in
+  the request, so they are expected to queue anything slow as a job.
+"""
+
+import logging
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+from github_webhooks import deliveries
+from github_webhooks import metrics
+from github_webhooks.filters import EventFilter
+from github_webhooks.signals import pull_request_changed
+
+
+# Maps the name of each consumer to its EventFilter.
+_consumer_filters = {}
+_consumer_filters_lock = threading.Lock()
+
+_consumer_seconds = metrics.histogram(
+    'github_consumer_duration_seconds',
+    'Time spent by each consumer handling pull request events.',
+    ('consumer',))
+_consumer_errors = metrics.counter(
+    'github_consumer_errors_total',
+    'Exceptions raised by each consumer while handling pull request events.',
+    ('consumer',))
+
+
+class ConsumerFailed(Exception):
+    """
+    Raised after a pull request event has been passed to all consumers if
+    some of them (whose names are in |consumers|) raised an exception.
+    """
+    def __init__(self, consumers):
+        super(ConsumerFailed, self).__init__(
+            'Consumers failed: %s.' % ', '.join(consumers))
+        self.consumers = consumers
+
+
+def pull_request_consumer(actions=None, repositories=None, branches=None):
+    """
+    Registers the decorated function as a consumer of pull_request events.
+    The function is called with the decoded payload if it matches |actions|,
+    |repositories| and |branches| (see EventFilter). The returned callable
+    can also be called directly with a payload, and behaves the same way
+    (raising ConsumerFailed if the function fails).
+    """
+    def decorator(func):
+        name = '%s.%s' % (func.__module__, func.__name__)
+        event_filter = EventFilter(name, ['pull_request'], actions,
+                                   repositories, branches)
+        with _consumer_filters_lock:
+            _consumer_filters[name] = event_filter
+
+        def consume(payload, delivery=None):
+            """
+            Returns whether the function failed. |delivery| is the
+            X-GitHub-Delivery header of the payload, if known.
+            """
+            if not event_filter.accepts_payload(payload):
+                return False
+            key = None
+            if delivery is not None:
+                key = 'consumer:%s:%s' % (name, delivery)
+                if deliveries.is_duplicate(key):
+                    # Handled before this delivery failed in another
+                    # consumer.
+                    return False
+            start = time.time()
+            failed = False
+            try:
+                func(payload)
+            except Exception:
+                failed = True
+                logging.error('Consumer %s failed:\n%s' %
+                              (name, traceback.format_exc()))
+                if key is not None:
+                    deliveries.forget(key)
+            _record(name, time.time() - start, failed)
+            return failed
+
+        def consumer(payload):
+            if consume(payload):
+                raise ConsumerFailed([name])
+
+        def receiver(sender, payload, delivery=None, **kwargs):
+            # Returns the name of the consumer if it failed.
+            if consume(payload, delivery):
+                return name
+            return None
+
+        # The receiver is a closure, so it must not be weakly referenced.
+        pull_request_changed.connect(receiver, weak=False, dispatch_uid=name)
+        consumer.__name__ = func.__name__
+        consumer.__doc__ = func.__doc__
+        consumer.event_filter = event_filter
+        return consumer
+    return decorator
+
+
+def send_pull_request_changed(payload, delivery=None):
+    """
+    Sends |payload| to all the registered pull_request consumers. |delivery|
+    is its X-GitHub-Delivery header, if any, which is used to only send it to
+    the consumers that have not handled it yet. Raises ConsumerFailed if any
+    of them failed.
+    """
+    responses = pull_request_changed.send(sender=None, payload=payload,
+                                          delivery=delivery)
+    failed = [response for _, response in responses if response]
+    if failed:
+        raise ConsumerFailed(failed)
+
+
+def consumer_actions():
+    """
+    Returns the pull_request actions at least one registered consumer is
+    interested in, or None if a consumer accepts all of them.
+    """
+    with _consumer_filters_lock:
+        filters = _consumer_filters.values()
+    actions = set()
+    for event_filter in filters:
+        if event_filter.actions is None:
+            return None
+        actions.update(event_filter.actions)
+    return actions
+
+
+def _record(name, seconds, failed):
+    _consumer_seconds.observe(seconds, consumer=name)
+    if failed:
+        _consumer_errors.inc(consumer=name)
+    if seconds > settings.GITHUB_CONSUMER_SLOW_THRESHOLD:
+        logging.warn('Consumer %s took %.2fs to handle a pull request event.' %
+                     (name, seconds))
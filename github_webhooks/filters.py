@@ -0,0 +1,119 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Declarative filters for the GitHub deliveries a web hook endpoint cares about.
+
+Filters are attached to views with the filter_github_events() decorator. The
+event type is checked against the X-GitHub-Event header before the payload is
+decoded, and the action, target repository and target branch are checked by
+PayloadMiddleware right after decoding it, before the view runs. Deliveries
+that do not pass are acknowledged with an empty 200 response, and counted in
+the github_deliveries_total metric.
+"""
+
+from github_webhooks import metrics
+
+
+# Reasons why a delivery can be dropped.
+DROPPED_EVENT = 'event'
+DROPPED_ACTION = 'action'
+DROPPED_REPOSITORY = 'repository'
+DROPPED_BRANCH = 'branch'
+
+_deliveries = metrics.counter(
+    'github_deliveries_total',
+    'Deliveries seen by each filter, by event, action and outcome '
+    '("accepted" or the reason why they were dropped).',
+    ('filter', 'event', 'action', 'outcome'))
+
+
+def _pull_request_target(payload):
+    base = payload.get('pull_request', {}).get('base', {})
+    return base.get('repo', {}).get('full_name'), base.get('ref')
+
+
+def _push_target(payload):
+    ref = payload.get('ref') or ''
+    if ref.startswith('refs/heads/'):
+        branch = ref[len('refs/heads/'):]
+    else:
+        # Tags are not on any branch.
+        branch = None
+    return payload.get('repository', {}).get('full_name'), branch
+
+
+def _repository_target(payload):
+    return payload.get('repository', {}).get('full_name'), None
+
+
+# Maps event types to a function returning the (repository full name, branch)
+# a payload of that type targets. Other event types only have a repository.
+_TARGETS = {
+    'pull_request': _pull_request_target,
+    'pull_request_review': _pull_request_target,
+    'pull_request_review_comment': _pull_request_target,
+    'push': _push_target,
+}
+
+
+class EventFilter(object):
+    """
+    Accepts the deliveries of the |events| types (e.g. 'pull_request').
+    |actions|, |repositories| (full names such as "crosswalk-project/crosswalk")
+    and |branches| further restrict the deliveries to accept if they are not
+    None. The repository and the branch are the base of a pull request, or
+    the ones pushed to. |branches| can only be used with events that have a
+    branch (those in _TARGETS).
+    """
+    def __init__(self, name, events, actions=None, repositories=None,
+                 branches=None):
+        self.name = name
+        self.events = frozenset(events)
+        if branches is not None and not self.events <= frozenset(_TARGETS):
+            raise ValueError('Deliveries of %s cannot be filtered by branch.'
+                             % ', '.join(sorted(self.events -
+                                                frozenset(_TARGETS))))
+        self.actions = frozenset(actions) if actions is not None else None
+        self.repositories = \
+            frozenset(repositories) if repositories is not None else None
+        self.branches = frozenset(branches) if branches is not None else None
+
+    def accepts_request(self, request):
+        """
+        Checks the parts of |request| that do not require decoding the
+        payload.
+        """
+        event = request.META.get('HTTP_X_GITHUB_EVENT')
+        if event not in self.events:
+            return self._drop(DROPPED_EVENT, event, None)
+        return True
+
+    def accepts_payload(self, payload, event='pull_request'):
+        """
+        Checks the decoded |payload| of a request accepted by
+        accepts_request(). |event| is the type of the delivery (its
+        X-GitHub-Event header).
+        """
+        action = payload.get('action')
+        if self.actions is not None and action not in self.actions:
+            return self._drop(DROPPED_ACTION, event, action)
+
+        if self.repositories is not None or self.branches is not None:
+            repository, branch = \
+                _TARGETS.get(event, _repository_target)(payload)
+            if self.repositories is not None and \
+               repository not in self.repositories:
+                return self._drop(DROPPED_REPOSITORY, event, action)
+            if self.branches is not None and branch not in self.branches:
+                return self._drop(DROPPED_BRANCH, event, action)
+        _deliveries.inc(filter=self.name, event=event, action=action,
+                        outcome='accepted')
+        return True
+
+    def _drop(self, reason, event, action):
+        _deliveries.inc(filter=self.name, event=event, action=action,
+                        outcome='dropped_' + reason)
+        return False
+
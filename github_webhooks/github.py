@@ -0,0 +1,228 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Shared HTTP client for everything that talks to GitHub.
+
+All requests go through a single requests.Session, so connections are kept
+alive and reused instead of doing a new TCP and TLS handshake for every call.
+The session is created lazily and authenticates as GITHUB_USERNAME.
+
+Connection errors are retried with an exponential backoff. Idempotent
+requests (GET, PUT, DELETE etc) are also retried when GitHub answers with a
+5xx status code; POST and PATCH are not, as that could lead to duplicate
+comments.
+
+Requests are also throttled by a RateLimiter, which spaces them out according
+to GITHUB_REQUESTS_PER_SECOND and keeps track of the API budget GitHub reports
+in its X-RateLimit-* headers. When the budget is exhausted, requests fail with
+RateLimitExceeded without being sent. Requests made with PRIORITY_LOW (such as
+comment edits) start failing earlier, when GITHUB_RATE_LIMIT_RESERVE requests
+or fewer are left, so that the rest of the budget goes to commit statuses.
+"""
+
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from github_webhooks import metrics
+
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request cannot be sent before the GitHub API rate limit is
+    reset. |reset_at| is the time (as returned by time.time()) at which
+    requests are expected to be accepted again.
+    """
+    def __init__(self, reset_at):
+        super(RateLimitExceeded, self).__init__(
+            'GitHub API rate limit exceeded, resets in %ds.' %
+            max(0, reset_at - time.time()))
+        self.reset_at = reset_at
+
+
+class RateLimiter(object):
+    """
+    A token bucket that lets |rate| requests per second through (with bursts
+    of up to |burst| requests), combined with the budget reported by GitHub
+    in the responses to previous requests.
+    """
+    def __init__(self, rate, burst, reserve):
+        self.rate = float(rate)
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        # Requests left until |reset_at| according to GitHub (None if no
+        # response has been received yet).
+        self.remaining = None
+        self.reset_at = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, priority=PRIORITY_HIGH):
+        """
+        Blocks until a request can be sent, or raises RateLimitExceeded if
+        there is no budget left for |priority|.
+        """
+        with self.lock:
+            now = time.time()
+            if self.remaining is not None and now < self.reset_at:
+                if priority == PRIORITY_LOW:
+                    minimum = self.reserve
+                else:
+                    minimum = 0
+                if self.remaining <= minimum:
+                    raise RateLimitExceeded(self.reset_at)
+                self.remaining -= 1
+
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Take a token even if it is not there yet, and wait for it
+            # outside the lock.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, response):
+        """
+        Updates the budget from the headers of a response sent by GitHub.
+        Raises RateLimitExceeded if |response| says that the request was
+        rejected because of a rate limit.
+        """
+        headers = response.headers
+        with self.lock:
+            if 'X-RateLimit-Remaining' in headers:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.reset_at = int(headers['X-RateLimit-Reset'])
+
+            if response.status_code not in (403, 429):
+                return
+            # Secondary rate limits come with a Retry-After header instead.
+            # See https://developer.github.com/v3/#abuse-rate-limits.
+            if 'Retry-After' in headers:
+                self.remaining = 0
+                self.reset_at = time.time() + int(headers['Retry-After'])
+            if self.remaining == 0:
+                raise RateLimitExceeded(self.reset_at)
+
+    def seconds_until_reset(self):
+        """
+        Returns how long to wait until requests can be sent again, or None if
+        requests are not being blocked.
+        """
+        with self.lock:
+            now = time.time()
+            if self.remaining is None or self.remaining > 0 or \
+               now >= self.reset_at:
+                return None
+            return self.reset_at - now
+
+
+_session = None
+_rate_limiter = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    Returns the requests.Session shared by all GitHub requests in this
+    process, creating it if necessary.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _create_session()
+        return _session
+
+
+def rate_limiter():
+    """
+    Returns the RateLimiter shared by all GitHub requests in this process,
+    creating it if necessary.
+    """
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(settings.GITHUB_REQUESTS_PER_SECOND,
+                                        settings.GITHUB_REQUESTS_BURST,
+                                        settings.GITHUB_RATE_LIMIT_RESERVE)
+        return _rate_limiter
+
+
+def reset_session():
+    """
+    Closes the shared session and forgets the rate limit state, so that the
+    next requests use new ones created with the current settings.
+    """
+    global _session, _rate_limiter
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _rate_limiter = None
+
+
+def _create_session():
+    retries = Retry(total=settings.GITHUB_MAX_RETRIES,
+                    backoff_factor=settings.GITHUB_RETRY_BACKOFF,
+                    status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_maxsize=settings.GITHUB_POOL_SIZE,
+                          max_retries=retries)
+
+    s = requests.Session()
+    s.auth = (settings.GITHUB_USERNAME, settings.GITHUB_ACCESS_TOKEN)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+def request(method, url, priority=PRIORITY_HIGH, operation=None, **kwargs):
+    """
+    Sends a request to GitHub with the shared session. Accepts the same
+    arguments as requests.request(), plus the |priority| of the request and
+    the name of the |operation| it is part of (used in the metrics, defaults
+    to the lowercase method).
+    Raises RateLimitExceeded if the request cannot be sent now.
+    """
+    limiter = rate_limiter()
+    limiter.acquire(priority)
+
+    if operation is None:
+        operation = method.lower()
+    kwargs.setdefault('timeout', settings.GITHUB_TIMEOUT)
+    start = time.time()
+    try:
+        response = session().request(method, url, **kwargs)
+    except Exception:
+        metrics.record_response('github', operation, time.time() - start,
+                                None)
+        raise
+    metrics.record_response('github', operation, time.time() - start,
+                            response.status_code)
+    limiter.update(response)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,156 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+A small database-backed job queue.
+
+Views call enqueue() with the dotted path of a function and its keyword
+arguments, which must be serializable to JSON. The process_jobs management
+command then calls process_jobs() to run them outside of the request/response
+cycle, so that GitHub gets its response as soon as the event is stored.
+
+Jobs that raise an exception are retried after JOB_RETRY_DELAY seconds (which
+doubles on each attempt) until JOB_MAX_ATTEMPTS is reached, after which they
+are kept in the database in the "failed" state for inspection. Jobs failing
+because the GitHub API rate limit has been exceeded are postponed until it is
+reset instead, without counting as an attempt.
+"""
+
+import datetime
+import json
+import logging
+import time
+import traceback
+
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.module_loading import import_by_path
+
+from github_webhooks import github
+from github_webhooks import metrics
+from github_webhooks.models import Job, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+
+
+def enqueue(task, **kwargs):
+    """
+    Schedules |task| (a dotted path to a callable) to be called with |kwargs|
+    by a worker and returns the new Job.
+    """
+    return Job.objects.create(task=task, arguments=json.dumps(kwargs))
+
+
+def claim_job():
+    """
+    Picks the oldest job that can be run now, marks it as running and returns
+    it. Returns None if there is nothing to do.
+    Jobs that have been running for longer than JOB_LOCK_TIMEOUT seconds are
+    assumed to belong to a dead worker and can be claimed again.
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+    candidates = Job.objects.filter(run_after__lte=now).exclude(
+        state=JOB_FAILED).order_by('pk')
+
+    for job in candidates.filter(state=JOB_QUEUED)[:10]:
+        if _lock(job, JOB_QUEUED, now):
+            return job
+    for job in candidates.filter(state=JOB_RUNNING, locked_at__lt=stale)[:10]:
+        if _lock(job, JOB_RUNNING, now):
+            return job
+    return None
+
+
+def _lock(job, expected_state, now):
+    # The UPDATE only matches if nobody else has claimed the job in the
+    # meantime, so this is safe with multiple workers.
+    updated = Job.objects.filter(pk=job.pk, state=expected_state,
+                                 locked_at=job.locked_at).update(
+        state=JOB_RUNNING, locked_at=now)
+    if updated != 1:
+        return False
+    job.state = JOB_RUNNING
+    job.locked_at = now
+    return True
+
+
+def run_job(job):
+    """
+    Runs a job previously returned by claim_job(). Successful jobs are
+    deleted, failed ones are rescheduled or marked as failed. Returns whether
+    the job succeeded.
+    """
+    try:
+        task = import_by_path(job.task)
+        task(**json.loads(job.arguments))
+    except github.RateLimitExceeded as e:
+        # Nothing is wrong with the job itself, so this is not counted as an
+        # attempt. Run it again once GitHub accepts requests.
+        delay = github.rate_limiter().seconds_until_reset()
+        if delay is None:
+            delay = max(0, e.reset_at - time.time())
+        logging.warn('Job %d (%s) postponed for %ds: %s' %
+                     (job.pk, job.task, delay, e))
+        job.state = JOB_QUEUED
+        job.run_after = timezone.now() + datetime.timedelta(seconds=delay)
+        job.locked_at = None
+        job.save()
+        return False
+    except Exception:
+        job.attempts += 1
+        job.last_error = traceback.format_exc()
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            logging.error('Job %d (%s) failed for the last time:\n%s' %
+                          (job.pk, job.task, job.last_error))
+            job.state = JOB_FAILED
+        else:
+            logging.warn('Job %d (%s) failed, will retry:\n%s' %
+                         (job.pk, job.task, job.last_error))
+            delay = settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.state = JOB_QUEUED
+            job.run_after = timezone.now() + \
+                datetime.timedelta(seconds=delay)
+        job.locked_at = None
+        job.save()
+        return False
+
+    job.delete()
+    return True
+
+
+def process_jobs(limit=None):
+    """
+    Runs jobs until there are none left to run now (or |limit| jobs have been
+    run). Returns the number of jobs that were run.
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+@metrics.register_collector
+def collect_metrics():
+    """
+    Exports the size of the job queue by state, and how long the queued job
+    that has been runnable for the longest time has been waiting.
+    """
+    jobs = metrics.Gauge('jobs', 'Jobs in the queue by state.', ('state',))
+    for state in (JOB_QUEUED, JOB_RUNNING, JOB_FAILED):
+        jobs.set(0, state=state)
+    for row in Job.objects.values('state').annotate(count=Count('pk')):
+        jobs.set(row['count'], state=row['state'])
+
+    now = timezone.now()
+    oldest = Job.objects.filter(state=JOB_QUEUED, run_after__lte=now) \
+                        .aggregate(Min('run_after'))['run_after__min']
+    wait = metrics.Gauge('jobs_queued_wait_seconds',
+                         'Time since the oldest runnable queued job could '
+                         'have been run (0 if there is none).')
+    wait.set(0 if oldest is None else (now - oldest).total_seconds())
+    return [jobs, wait]
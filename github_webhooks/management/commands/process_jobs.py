@@ -0,0 +1,39 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from github_webhooks import metrics
+from github_webhooks.deliveries import purge_deliveries
+from github_webhooks.jobs import process_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs the jobs queued by the web hook handlers (posting comments ' \
+           'to GitHub, sending patches to Buildbot, updating JIRA etc).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep waiting for new jobs instead of exiting once '
+                         'the queue is empty.'),
+        make_option('--metrics-port', type='int', dest='metrics_port',
+                    default=None,
+                    help='Export the metrics of this process over HTTP on '
+                         'this port.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['metrics_port'] is not None:
+            metrics.start_http_server(options['metrics_port'])
+        while True:
+            process_jobs()
+            purge_deliveries()
+            if not options['loop']:
+                break
+            time.sleep(settings.JOB_POLL_INTERVAL)
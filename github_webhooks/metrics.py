@@ -0,0 +1,287 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Minimal in-process metrics in the Prometheus text exposition format.
+
+Counters, histograms and gauges are created once at module level with
+counter(), histogram() and gauge() and updated from the hot paths; updating
+one only takes a lock and a dictionary lookup. Values that are cheaper to
+compute when they are read (such as the size of a backlog in the database)
+are provided by collectors registered with register_collector(), which are
+only called when the metrics are exported.
+
+Metrics live in the memory of each process. The web application exports its
+own at /metrics, and the long-running management commands can export theirs
+with start_http_server().
+"""
+
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the buckets of latency histograms.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30)
+
+_metrics = {}
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+class Metric(object):
+    """
+    Base class for metrics with a set of |labels|. The value for each
+    combination of label values is kept separately.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[label] for label in self.labels)
+
+    def samples(self):
+        """
+        Returns a list of (name suffix, labels dict, value) tuples.
+        """
+        with self.lock:
+            values = self.values.items()
+        return [('', dict(zip(self.labels, key)), value)
+                for key, value in sorted(values)]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time spent in the body of a "with" statement.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts))
+                      for key, counts in self.values.iteritems()]
+        samples = []
+        for key, counts in sorted(values):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = dict(labels, le=_format_value(bound))
+                samples.append(('_bucket', bucket_labels, cumulative))
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, documentation, labels=()):
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labels, buckets)
+
+
+def get_sample_value(name, labels=None):
+    """
+    Returns the value of the sample called |name| (including any suffix such
+    as "_count") with exactly |labels| among the registered metrics, or None
+    if there is none.
+    """
+    labels = labels or {}
+    with _registry_lock:
+        metrics = _metrics.values()
+    for metric in metrics:
+        if not name.startswith(metric.name):
+            continue
+        for suffix, sample_labels, value in metric.samples():
+            if metric.name + suffix == name and sample_labels == labels:
+                return value
+    return None
+
+
+def register_collector(function):
+    """
+    Registers |function|, which is called every time the metrics are
+    exported and returns a list of Metric objects (not registered anywhere
+    else) with their current values. Can be used as a decorator.
+    """
+    with _registry_lock:
+        if function not in _collectors:
+            _collectors.append(function)
+    return function
+
+
+def generate_latest():
+    """
+    Returns all metrics in the Prometheus text exposition format.
+    """
+    with _registry_lock:
+        metrics = [_metrics[name] for name in sorted(_metrics)]
+        collectors = list(_collectors)
+    for collector in collectors:
+        metrics.extend(collector())
+
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for suffix, labels, value in metric.samples():
+            lines.append('%s%s%s %s' % (metric.name, suffix,
+                                        _format_labels(labels),
+                                        _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(labels[name])) for name in sorted(labels))
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+                     .replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, basestring):
+        return value
+    return repr(float(value))
+
+
+# Metrics shared by the code talking to other services.
+outbound_request_seconds = histogram(
+    'outbound_request_duration_seconds',
+    'Time spent in requests to GitHub, Buildbot and JIRA.',
+    ('service', 'operation'))
+outbound_requests = counter(
+    'outbound_requests_total',
+    'Requests to GitHub, Buildbot and JIRA by outcome (an HTTP status class '
+    'such as "2xx", "ok" or "error").',
+    ('service', 'operation', 'outcome'))
+
+
+@contextmanager
+def outbound_call(service, operation):
+    """
+    Records the duration and the outcome ("ok" or "error", depending on
+    whether an exception is raised) of the body of a "with" statement.
+    """
+    start = time.time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        outbound_request_seconds.observe(time.time() - start,
+                                         service=service, operation=operation)
+        outbound_requests.inc(service=service, operation=operation,
+                              outcome=outcome)
+
+
+def record_response(service, operation, seconds, status_code):
+    """
+    Records a request to |service| that got a response with |status_code|
+    after |seconds|. |status_code| is None if the request failed without a
+    response.
+    """
+    if status_code is None:
+        outcome = 'error'
+    else:
+        outcome = '%dxx' % (status_code / 100)
+    outbound_request_seconds.observe(seconds, service=service,
+                                     operation=operation)
+    outbound_requests.inc(service=service, operation=operation,
+                          outcome=outcome)
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, address=''):
+    """
+    Serves the metrics of this process over HTTP on |port| from a daemon
+    thread. Returns the server.
+    """
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [generate_latest()]
+
+    server = make_server(address, port, application,
+                         handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
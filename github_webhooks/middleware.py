@@ -2,48 +2,114 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import hashlib
-import hmac
 import json
+import time
+import urllib
 
-from django.conf import settings
 from django.http import HttpResponse, HttpResponseNotFound
-from django.utils.crypto import constant_time_compare
+
+from github_webhooks import metrics
+from github_webhooks import signatures
+
+
+_PAYLOAD_PREFIX = 'payload='
+
+_middleware_seconds = metrics.histogram(
+    'github_webhooks_middleware_duration_seconds',
+    'Time spent verifying ("signature") and decoding ("payload") deliveries.',
+    ('step',))
+_view_seconds = metrics.histogram(
+    'http_request_duration_seconds',
+    'Time spent in each view, including the middleware of its decorators.',
+    ('view',))
+_view_responses = metrics.counter(
+    'http_responses_total', 'Responses sent by each view, by status code.',
+    ('view', 'status'))
 
 
 class PayloadMiddleware(object):
     """
-    Verifies that the HTTP POST request contains a 'payload' variable, parses
-    the JSON payload and adds it to the request.
+    Verifies that the HTTP POST request contains a JSON payload, parses it and
+    adds it to the request.
+    GitHub sends the payload either as the request body (if the hook's content
+    type is application/json) or as a form variable called 'payload'. In both
+    cases, it is decoded straight from the raw body, which is read only once
+    and shared with SignatureMiddleware, instead of having Django build
+    request.POST first.
     Payloads containing a key called 'zen' are discarded, as they are pings
-    sent by GitHub when a hook is added.
+    sent by GitHub when a hook is added. So are payloads rejected by the
+    request's EventFilter, if the view uses filter_github_events().
     """
 
     def process_request(self, request):
-        if 'payload' not in request.POST:
-            return HttpResponseNotFound()
+        with _middleware_seconds.time(step='payload'):
+            # This is a test payload GitHub sends when we add a new hook.
+            # It does not contain the payload we expect, so just ignore it.
+            if request.META.get('HTTP_X_GITHUB_EVENT') == 'ping':
+                return HttpResponse()
 
-        payload = json.loads(request.POST['payload'])
+            raw_payload = _get_raw_payload(request)
+            if not raw_payload:
+                return HttpResponseNotFound()
 
-        # This is a test payload GitHub sends when we add a new hook.
-        # It does not contain the payload we expect, so just ignore it.
-        if 'zen' in payload:
-            return HttpResponse()
+            payload = json.loads(raw_payload)
+            if 'zen' in payload:
+                return HttpResponse()
 
-        request.payload = payload
+            event_filter = getattr(request, 'github_event_filter', None)
+            if event_filter is not None and \
+               not event_filter.accepts_payload(
+                   payload, request.META.get('HTTP_X_GITHUB_EVENT')):
+                return HttpResponse()
+
+            request.payload = payload
+
+
+def _get_raw_payload(request):
+    """
+    Returns the JSON payload of |request| as a string, or None if there is
+    none.
+    """
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    if content_type == 'application/json':
+        return request.body
+    if content_type == 'application/x-www-form-urlencoded':
+        body = request.body
+        # This is what GitHub sends, and it can be decoded in one go.
+        if body.startswith(_PAYLOAD_PREFIX) and '&' not in body:
+            return urllib.unquote_plus(body[len(_PAYLOAD_PREFIX):])
+    return request.POST.get('payload')
 
 
 class SignatureMiddleware(object):
     """
     Verifies that an HTTP request was really sent from GitHub by verifying that
-    the contents of the X-Hub-Signature header (a SHA1 HMAC of the request
-    body) matches our own calculation.
+    the contents of the X-Hub-Signature-256 or X-Hub-Signature header (an HMAC
+    of the request body) matches our own calculation. See
+    github_webhooks/signatures.py.
     """
 
     def process_request(self, request):
-        github_signature = request.META.get('HTTP_X_HUB_SIGNATURE', '')
-        computed_signature = 'sha1=%s' % \
-                             hmac.new(settings.GITHUB_HOOK_SECRET,
-                                      request.body, hashlib.sha1).hexdigest()
-        if not constant_time_compare(github_signature, computed_signature):
-            return HttpResponseNotFound()
+        with _middleware_seconds.time(step='signature'):
+            if not signatures.verify_request(request):
+                return HttpResponseNotFound()
+
+
+class MetricsMiddleware(object):
+    """
+    Records how long each view takes to respond and the status code of its
+    responses.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = '%s.%s' % (view_func.__module__,
+                                          view_func.__name__)
+        request.metrics_start = time.time()
+
+    def process_response(self, request, response):
+        view = getattr(request, 'metrics_view', None)
+        if view is not None:
+            _view_seconds.observe(time.time() - request.metrics_start,
+                                  view=view)
+            _view_responses.inc(view=view, status=response.status_code)
+        return response
@@ -0,0 +1,48 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+from django.db import models
+from django.utils import timezone
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FAILED = 'failed'
+
+
+class Job(models.Model):
+    """
+    A unit of deferred work. Views create these instead of talking to GitHub,
+    Buildbot or JIRA directly, and the process_jobs command runs them later.
+    See github_webhooks.jobs for the API used to create and run jobs.
+    """
+    # Dotted path to the callable that does the actual work, e.g.
+    # "trybot_control.handlers.start_try_job".
+    task = models.CharField(max_length=256)
+    # JSON-encoded keyword arguments passed to |task|.
+    arguments = models.TextField()
+    state = models.CharField(max_length=7, default=JOB_QUEUED, choices=(
+        (JOB_QUEUED, 'Queued'),
+        (JOB_RUNNING, 'Running'),
+        (JOB_FAILED, 'Failed'),
+    ))
+    # How many times running this job has been attempted so far.
+    attempts = models.IntegerField(default=0)
+    # The job is not run before this moment (used for retrying with a delay).
+    run_after = models.DateTimeField(default=timezone.now)
+    # When a worker started running the job. Used to detect workers that died
+    # while running a job.
+    locked_at = models.DateTimeField(null=True)
+    # Traceback of the last failed attempt.
+    last_error = models.TextField(blank=True)
+
+
+class Delivery(models.Model):
+    """
+    A GitHub delivery (or any other event identified by a key) that has
+    already been handled. See github_webhooks.deliveries.
+    """
+    # SHA-1 of the key identifying the delivery.
+    key = models.CharField(max_length=40, unique=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
@@ -20,6 +20,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'github_webhooks.middleware.MetricsMiddleware',
 )
 
 ROOT_URLCONF = 'github_webhooks.urls'
@@ -32,6 +33,123 @@ USE_I18N = False
 
 WSGI_APPLICATION = 'github_webhooks.wsgi.application'
 
+# Background jobs (see github_webhooks/jobs.py).
+# How many times a job is tried before it is marked as failed.
+JOB_MAX_ATTEMPTS = 5
+# Seconds to wait before retrying a failed job. Doubles on every attempt.
+JOB_RETRY_DELAY = 30
+# Seconds after which a running job is considered abandoned by its worker.
+JOB_LOCK_TIMEOUT = 600
+# Seconds process_jobs --loop sleeps when there is nothing to do.
+JOB_POLL_INTERVAL = 1
+
+# Connections to GitHub (see github_webhooks/github.py).
+# Base URL of the GitHub API.
+GITHUB_API_URL = 'https://api.github.com'
+# Maximum number of connections kept open to the GitHub API.
+GITHUB_POOL_SIZE = 10
+# How many times a request is retried on connection errors.
+GITHUB_MAX_RETRIES = 3
+# Retries wait GITHUB_RETRY_BACKOFF * 2^(retry number - 1) seconds.
+GITHUB_RETRY_BACKOFF = 0.5
+# Seconds to wait for GitHub to accept a connection or send data.
+GITHUB_TIMEOUT = 10
+# Maximum sustained rate of requests sent to GitHub by each process.
+GITHUB_REQUESTS_PER_SECOND = 5
+# Number of requests that can be sent at once before being throttled.
+GITHUB_REQUESTS_BURST = 10
+# Low priority requests (comment edits) are not sent when this number of
+# requests or fewer are left in the GitHub API budget.
+GITHUB_RATE_LIMIT_RESERVE = 100
+
+# Secrets that web hooks may still be signing deliveries with while
+# GITHUB_HOOK_SECRET is being changed. Like the secret itself, they belong in
+# internal_settings.py.
+GITHUB_HOOK_OLD_SECRETS = ()
+
+# Deliveries (identified by their X-GitHub-Delivery header or by keys of the
+# consumers) seen in the last GITHUB_DELIVERY_TTL seconds are ignored. The
+# last GITHUB_DELIVERY_CACHE_SIZE are also remembered in memory.
+GITHUB_DELIVERY_TTL = 24 * 60 * 60
+GITHUB_DELIVERY_CACHE_SIZE = 10000
+
+# pull_request_changed consumers taking longer than this many seconds are
+# logged, as they delay the response to GitHub.
+GITHUB_CONSUMER_SLOW_THRESHOLD = 0.5
+
+# sync_trybot_status --daemon (see trybot_control/notifications.py).
+# Local UDP address the daemon listens on for "needs sync" notifications.
+TRYBOT_SYNC_NOTIFY_ADDRESS = ('127.0.0.1', 8917)
+# Seconds the daemon waits for a notification before checking the database
+# anyway.
+TRYBOT_SYNC_POLL_INTERVAL = 30
+# Seconds the daemon keeps collecting notifications after receiving one, so
+# that several updates to the same pull request are sent together.
+TRYBOT_SYNC_DEBOUNCE = 0.25
+# Minimum number of seconds between two updates of the Trybot comment of a
+# pull request that is still being built. Changes reported in the meantime are
+# sent together in the next update.
+TRYBOT_COMMENT_UPDATE_INTERVAL = 10
+# Whether to ask Buildbot to stop the builds of a pull request when a newer
+# head is pushed to it. Builds that have not started yet are not affected.
+TRYBOT_STOP_SUPERSEDED_BUILDS = False
+# Pull requests that have finished building are moved to a summary table
+# (see trybot_control/retention.py) this many at a time, each batch in its own
+# transaction.
+TRYBOT_ARCHIVE_CHUNK_SIZE = 500
+# Days after which archived pull requests are deleted. None keeps them forever.
+TRYBOT_ARCHIVE_MAX_AGE_DAYS = None
+# Days after which pull requests that have not finished building are archived
+# anyway, counted from when they were last synced or changed. This covers
+# builds Buildbot never reports and superseded heads that were never built.
+# None keeps them until they finish.
+TRYBOT_ARCHIVE_STALE_AFTER_DAYS = 7
+# Pull requests tested by the trybot (see trybot_control/routing.py). Each
+# entry is a (base repository, target branch, options) tuple, where the
+# repository (a full name such as "crosswalk-project/crosswalk") and the
+# branch are shell-style globs. The first matching entry is used, and pull
+# requests matching none are ignored. The options can contain "builders",
+# the names of the builders that test the pull requests (by default, Buildbot
+# picks them; an empty list ignores the pull requests), and "masters", the
+# names of the TRYBOT_MASTERS they can be sent to (by default, any of them).
+TRYBOT_ROUTES = (
+    ('*', 'master', {}),
+    ('*/crosswalk', 'crosswalk-lite', {}),
+)
+# Buildbot masters try jobs can be sent to (see trybot_control/masters.py),
+# mapping a name to a dictionary with the "base_url" and "send_patch_url" of
+# the master (see TRYBOT_BASE_URL and TRYBOT_SEND_PATCH_URL). Names must not be
+# longer than 64 characters. If it is empty, TRYBOT_BASE_URL and
+# TRYBOT_SEND_PATCH_URL are used.
+TRYBOT_MASTERS = {}
+# Seconds during which the result of a master's health check is used.
+TRYBOT_MASTER_HEALTH_CHECK_INTERVAL = 60
+# Seconds to wait for a master to answer a health check.
+TRYBOT_MASTER_HEALTH_CHECK_TIMEOUT = 5
+# Seconds to wait for a master to accept a connection or send data when a
+# patch series is sent to it or one of its builds is stopped.
+TRYBOT_BUILDBOT_TIMEOUT = 30
+# Patch series are downloaded from GitHub and sent to Buildbot in chunks of
+# this many bytes, so that they are never copied as a whole.
+TRYBOT_PATCH_CHUNK_SIZE = 64 * 1024
+# Patch series bigger than this many bytes are not sent to Buildbot. It gets
+# their URL in the "patch_url" field instead of the "patch" field, and is
+# expected to download them itself.
+TRYBOT_MAX_INLINE_PATCH_SIZE = 4 * 1024 * 1024
+# Whether to gzip the requests sending patch series to Buildbot. Only enable
+# this if the web server in front of Buildbot decodes gzipped request bodies.
+TRYBOT_COMPRESS_PATCH = False
+
+# Connections to JIRA (see updater_for_jira/jirahelper.py).
+# Maximum number of JIRA clients (and thus connections) kept by each process.
+JIRA_POOL_SIZE = 4
+# Seconds after which an idle JIRA client is checked before being used again.
+JIRA_HEALTH_CHECK_INTERVAL = 300
+# Number of (project, issue type, status) combinations whose "Resolve"
+# transition is remembered, and for how many seconds.
+JIRA_TRANSITION_CACHE_SIZE = 256
+JIRA_TRANSITION_CACHE_TTL = 3600
+
 # Get internal settings (passwords, access tokens etc from another file that is
 # not part of the repository).
 from internal_settings import *
@@ -5,4 +5,4 @@
 import django.dispatch
 
 # A pull_request event has been sent by GitHub. |payload| is already a JSON.
-pull_request_changed = django.dispatch.Signal(providing_args=['payload'])
+pull_request_changed = django.dispatch.Signal(providing_args=['payload', 'delivery'])
@@ -0,0 +1,160 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Verification of the signatures GitHub adds to its deliveries.
+
+GitHub signs the body of each delivery with HMAC-SHA256 in the
+X-Hub-Signature-256 header and with HMAC-SHA1 in X-Hub-Signature. The former
+is checked when it is present. HMAC objects keyed with each secret are
+created once and copied for every delivery, so the key is not hashed again
+each time. The body is hashed in chunks as it is read from the client, and
+kept so that views can still use request.body and request.POST.
+
+Deliveries can be signed with GITHUB_HOOK_SECRET, or with one of
+GITHUB_HOOK_OLD_SECRETS while the secret is being rotated. The secret that
+verified the last delivery is tried first, so the others are only tried when
+the hooks switch from one secret to another.
+"""
+
+import hashlib
+import hmac
+import threading
+
+from io import BytesIO
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+
+# Size of the chunks the body of a delivery is read and hashed in.
+_CHUNK_SIZE = 64 * 1024
+
+# (META key, signature prefix, hash constructor) for each header, in order of
+# preference.
+_HEADERS = (
+    ('HTTP_X_HUB_SIGNATURE_256', 'sha256=', hashlib.sha256),
+    ('HTTP_X_HUB_SIGNATURE', 'sha1=', hashlib.sha1),
+)
+
+
+class SecretRing(object):
+    """
+    The |secrets| deliveries can be signed with, in the order in which they
+    are tried, and HMAC objects keyed with each of them.
+    """
+    def __init__(self, secrets):
+        self.secrets = list(secrets)
+        # Maps (secret, hash constructor) to an HMAC object that has not
+        # hashed any data yet.
+        self.keyed = {}
+        self.lock = threading.Lock()
+
+    def ordered(self):
+        with self.lock:
+            return list(self.secrets)
+
+    def hmac(self, secret, digestmod):
+        """
+        Returns a new HMAC object keyed with |secret|.
+        """
+        key = (secret, digestmod)
+        with self.lock:
+            keyed = self.keyed.get(key)
+            if keyed is None:
+                keyed = self.keyed[key] = hmac.new(secret, digestmod=digestmod)
+            return keyed.copy()
+
+    def promote(self, secret):
+        """
+        Makes |secret| the first one to be tried.
+        """
+        with self.lock:
+            self.secrets.remove(secret)
+            self.secrets.insert(0, secret)
+
+
+# Cache for secret_ring(): a ((GITHUB_HOOK_SECRET, GITHUB_HOOK_OLD_SECRETS),
+# SecretRing) tuple.
+_secret_ring_cache = (None, None)
+_secret_ring_lock = threading.Lock()
+
+
+def secret_ring():
+    """
+    Returns the SecretRing for the current GITHUB_HOOK_SECRET and
+    GITHUB_HOOK_OLD_SECRETS, creating it if they have changed.
+    """
+    global _secret_ring_cache
+    secrets = (settings.GITHUB_HOOK_SECRET, settings.GITHUB_HOOK_OLD_SECRETS)
+    with _secret_ring_lock:
+        cached_secrets, ring = _secret_ring_cache
+        if cached_secrets != secrets:
+            current, old = secrets
+            ring = SecretRing((current,) +
+                              tuple(s for s in old if s != current))
+            _secret_ring_cache = (secrets, ring)
+        return ring
+
+
+def verify_request(request):
+    """
+    Returns whether |request| has a valid signature of its body made with
+    one of the known secrets.
+    """
+    for meta_key, prefix, digestmod in _HEADERS:
+        signature = request.META.get(meta_key)
+        if signature is not None:
+            break
+    else:
+        return False
+    if not signature.startswith(prefix):
+        return False
+    signature = signature[len(prefix):]
+
+    ring = secret_ring()
+    secrets = ring.ordered()
+    mac = ring.hmac(secrets[0], digestmod)
+    body = _read_body(request, mac.update)
+    if constant_time_compare(mac.hexdigest(), signature):
+        return True
+
+    for secret in secrets[1:]:
+        mac = ring.hmac(secret, digestmod)
+        mac.update(body)
+        if constant_time_compare(mac.hexdigest(), signature):
+            ring.promote(secret)
+            return True
+    return False
+
+
+def _read_body(request, update):
+    """
+    Reads the body of |request| in chunks, passing each one to |update|, and
+    returns it. If request.body has already been read, its stream is read
+    again.
+    """
+    chunks = []
+    while True:
+        chunk = request.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        update(chunk)
+        chunks.append(chunk)
+    body = ''.join(chunks)
+    _cache_body(request, body)
+    return body
+
+
+def _cache_body(request, body):
+    """
+    Makes request.body return |body| and request.read() and request.POST
+    read it again, after the stream of |request| has been consumed.
+    Django has no public way of doing this, so this mimics what
+    HttpRequest.body does after reading the stream in Django 1.6 (see
+    django/http/request.py), and needs to be checked when upgrading Django.
+    It is the only code depending on those internals.
+    """
+    request._body = body
+    request._stream = BytesIO(body)
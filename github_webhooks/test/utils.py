@@ -13,22 +13,28 @@ from django.test.client import BOUNDARY, Client, encode_multipart
 
 class GitHubEventClient(Client):
     """
-    A django.test.client.Client subclass that takes care of adding a
-    proper X-Hub-Signature header to requests that are supposed to be
-    signed by GitHub.
+    A django.test.client.Client subclass that takes care of adding proper
+    X-Hub-Signature and X-Hub-Signature-256 headers to requests that are
+    supposed to be signed by GitHub. The X-GitHub-Event header defaults to
+    "pull_request".
     """
     def post(self, path, data, *args, **kwargs):
+        kwargs.setdefault('HTTP_X_GITHUB_EVENT', 'pull_request')
         payload = {'payload': json.dumps(data)}
         encoded_multipart = encode_multipart(BOUNDARY, payload)
 
         signature = hmac.new(settings.GITHUB_HOOK_SECRET,
                              encoded_multipart,
                              hashlib.sha1)
+        signature_256 = hmac.new(settings.GITHUB_HOOK_SECRET,
+                                 encoded_multipart,
+                                 hashlib.sha256)
 
         return super(GitHubEventClient, self).post(
             path,
             data=payload,
             HTTP_X_HUB_SIGNATURE='sha1=%s' % signature.hexdigest(),
+            HTTP_X_HUB_SIGNATURE_256='sha256=%s' % signature_256.hexdigest(),
             *args,
             **kwargs
         )
@@ -48,6 +54,7 @@ def mock_pull_request_payload():
             'title': 'Hello world',
             'body': 'some description',
             'html_url': 'http://pr.com',
+            'updated_at': '2015-01-01T12:00:00Z',
             'user': {
                 'login': 'rakuco',
                 'html_url': 'http://rakuco.com',
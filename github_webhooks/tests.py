@@ -2,15 +2,36 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
 import hashlib
+import hmac
 import json
 import mock
+import time
+import urllib
 
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import RequestFactory
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 
+from github_webhooks import github
+from github_webhooks import metrics
+from github_webhooks import signatures
+from github_webhooks.decorators import add_github_payload
+from github_webhooks.decorators import filter_github_events
+from github_webhooks.deliveries import is_duplicate, purge_deliveries
+from github_webhooks.deliveries import reset_recent_keys
+from github_webhooks.dispatch import ConsumerFailed
+from github_webhooks.jobs import claim_job, enqueue, process_jobs
 from github_webhooks.middleware import PayloadMiddleware
 from github_webhooks.middleware import SignatureMiddleware
+from github_webhooks.models import *
+from github_webhooks.test.utils import GitHubEventClient
+from github_webhooks.test.utils import mock_pull_request_payload
 
 
 class PayloadMiddlewareTests(TestCase):
@@ -23,11 +44,245 @@ class PayloadMiddlewareTests(TestCase):
         r = PayloadMiddleware().process_request(request)
         self.assertEqual(r.status_code, 200)
 
+    def test_ping_event(self):
+        request = RequestFactory().post('/ping', data='{}',
+                                        content_type='application/json',
+                                        HTTP_X_GITHUB_EVENT='ping')
+        r = PayloadMiddleware().process_request(request)
+        self.assertEqual(r.status_code, 200)
+
     def test_no_payload(self):
         request = RequestFactory().post('/no_payload')
         r = PayloadMiddleware().process_request(request)
         self.assertEqual(r.status_code, 404)
 
+        request = RequestFactory().post('/no_payload', data='',
+                                        content_type='application/json')
+        r = PayloadMiddleware().process_request(request)
+        self.assertEqual(r.status_code, 404)
+
+    def test_json_payload(self):
+        payload = {'action': 'opened', 'title': u'\u2018title\u2019'}
+        request = RequestFactory().post('/json', data=json.dumps(payload),
+                                        content_type='application/json')
+        r = PayloadMiddleware().process_request(request)
+        self.assertIsNone(r)
+        self.assertEqual(request.payload, payload)
+
+    def test_form_payload(self):
+        payload = {'action': 'opened', 'title': u'\u2018title & co\u2019'}
+        request = RequestFactory().post(
+            '/form', data=urllib.urlencode({'payload': json.dumps(payload)}),
+            content_type='application/x-www-form-urlencoded')
+        r = PayloadMiddleware().process_request(request)
+        self.assertIsNone(r)
+        self.assertEqual(request.payload, payload)
+
+        # Anything else is left to Django.
+        request = RequestFactory().post(
+            '/form', data=urllib.urlencode({'foo': 'bar',
+                                            'payload': json.dumps(payload)}),
+            content_type='application/x-www-form-urlencoded')
+        r = PayloadMiddleware().process_request(request)
+        self.assertIsNone(r)
+        self.assertEqual(request.payload, payload)
+
+
+@filter_github_events(['pull_request'], actions=('opened',),
+                      repositories=('crosswalk-project/crosswalk',),
+                      branches=('master',))
+@add_github_payload
+def filtered_view(request):
+    return HttpResponse('accepted')
+
+
+@filter_github_events(['push'], repositories=('crosswalk-project/crosswalk',),
+                      branches=('master',))
+@add_github_payload
+def filtered_push_view(request):
+    return HttpResponse('accepted')
+
+
+class EventFilterTests(TestCase):
+    def post(self, payload, event='pull_request'):
+        request = RequestFactory().post('/filtered', data=payload,
+                                        content_type='application/json',
+                                        HTTP_X_GITHUB_EVENT=event)
+        return filtered_view(request).content
+
+    def test_filter(self):
+        def dropped(reason, event='pull_request', action='opened'):
+            return metrics.get_sample_value('github_deliveries_total', {
+                'filter': 'github_webhooks.tests.filtered_view',
+                'event': event, 'action': action,
+                'outcome': 'dropped_' + reason}) or 0
+
+        counts = [dropped('event', 'issue_comment', None),
+                  dropped('event', None, None),
+                  dropped('action', action='labeled'),
+                  dropped('branch'), dropped('repository')]
+        payload = mock_pull_request_payload()
+        self.assertEqual(self.post(json.dumps(payload)), 'accepted')
+
+        # The payload is not even decoded.
+        self.assertEqual(self.post('not JSON', event='issue_comment'), '')
+        self.assertEqual(self.post('not JSON', event=None), '')
+
+        payload['action'] = 'labeled'
+        self.assertEqual(self.post(json.dumps(payload)), '')
+        payload['action'] = 'opened'
+        payload['pull_request']['base']['ref'] = 'crosswalk-lite'
+        self.assertEqual(self.post(json.dumps(payload)), '')
+        payload['pull_request']['base']['repo']['full_name'] = 'foo/bar'
+        self.assertEqual(self.post(json.dumps(payload)), '')
+
+        new_counts = [dropped('event', 'issue_comment', None),
+                      dropped('event', None, None),
+                      dropped('action', action='labeled'),
+                      dropped('branch'), dropped('repository')]
+        self.assertEqual([new - old for new, old in zip(new_counts, counts)],
+                         [1, 1, 1, 1, 1])
+
+    def test_push_filter(self):
+        def post(repository, ref):
+            payload = {'ref': ref, 'repository': {'full_name': repository}}
+            request = RequestFactory().post(
+                '/filtered', data=json.dumps(payload),
+                content_type='application/json', HTTP_X_GITHUB_EVENT='push')
+            return filtered_push_view(request).content
+
+        def count(outcome):
+            return metrics.get_sample_value('github_deliveries_total', {
+                'filter': 'github_webhooks.tests.filtered_push_view',
+                'event': 'push', 'action': None, 'outcome': outcome}) or 0
+
+        self.assertEqual(post('crosswalk-project/crosswalk',
+                              'refs/heads/master'), 'accepted')
+        self.assertEqual(post('crosswalk-project/crosswalk',
+                              'refs/heads/crosswalk-lite'), '')
+        self.assertEqual(post('crosswalk-project/crosswalk',
+                              'refs/tags/master'), '')
+        self.assertEqual(post('foo/bar', 'refs/heads/master'), '')
+        self.assertEqual(
+            [count(outcome) for outcome in
+             ('accepted', 'dropped_repository', 'dropped_branch')],
+            [1, 1, 2])
+
+    def test_branches_without_branch(self):
+        decorator = filter_github_events(['issue_comment'],
+                                         branches=('master',))
+        self.assertRaises(ValueError, decorator, filtered_view)
+
+
+class IngressTests(TestCase):
+    def setUp(self):
+        reset_recent_keys()
+        settings.JIRA_PROJECTS = ('PROJ',)
+        self.client = GitHubEventClient()
+        self.url = reverse('github_webhooks.views.handle_event')
+        self.payload = mock_pull_request_payload()
+        self.payload['pull_request']['body'] = 'BUG=PROJ-1'
+
+    def test_fan_out(self):
+        response = self.client.post(self.url, self.payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(Job.objects.values_list('task', flat=True)),
+            ['trybot_control.handlers.start_try_job',
+             'updater_for_jira.handlers.update_issue'])
+
+        # Each consumer has its own filter.
+        Job.objects.all().delete()
+        self.payload['action'] = 'synchronize'
+        self.payload['pull_request']['head']['sha'] = 'f00b4r'
+        self.client.post(self.url, self.payload)
+        self.assertEqual(Job.objects.get().task,
+                         'trybot_control.handlers.start_try_job')
+
+    def test_duplicate_delivery(self):
+        for i in xrange(2):
+            response = self.client.post(self.url, self.payload,
+                                        HTTP_X_GITHUB_DELIVERY='guid-1')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Job.objects.count(), 2)
+
+        # Deliveries are also remembered by the database.
+        reset_recent_keys()
+        self.client.post(self.url, self.payload,
+                         HTTP_X_GITHUB_DELIVERY='guid-1')
+        self.assertEqual(Job.objects.count(), 2)
+
+        # The same head is only tested once, even with a different delivery.
+        Job.objects.all().delete()
+        self.payload['action'] = 'synchronize'
+        self.client.post(self.url, self.payload,
+                         HTTP_X_GITHUB_DELIVERY='guid-2')
+        self.assertEqual(Job.objects.count(), 0)
+
+    def test_ignored_action(self):
+        # No consumer is interested in labeled pull requests, so they are
+        # dropped before anything is written to the database.
+        self.payload['action'] = 'labeled'
+        for url in (self.url,
+                    reverse('trybot_control.views.handle_pull_request'),
+                    reverse('updater_for_jira.views.handle_pull_request')):
+            with self.assertNumQueries(0):
+                response = self.client.post(url, self.payload,
+                                            HTTP_X_GITHUB_DELIVERY='guid-1')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Delivery.objects.count(), 0)
+
+    @override_settings(GITHUB_DELIVERY_TTL=60)
+    @mock.patch('django.utils.timezone.now')
+    def test_delivery_expiration(self, now_mock):
+        now = datetime.datetime(2015, 1, 1)
+        now_mock.return_value = now
+        self.assertFalse(is_duplicate('foo'))
+        reset_recent_keys()
+        self.assertTrue(is_duplicate('foo'))
+
+        now_mock.return_value = now + datetime.timedelta(seconds=61)
+        reset_recent_keys()
+        self.assertFalse(is_duplicate('foo'))
+        self.assertTrue(is_duplicate('foo'))
+
+        now_mock.return_value = now + datetime.timedelta(seconds=200)
+        purge_deliveries()
+        self.assertEqual(Delivery.objects.count(), 0)
+
+    @mock.patch('github_webhooks.views.send_pull_request_changed')
+    def test_failed_delivery_forgotten(self, send_mock):
+        send_mock.side_effect = IOError('Database is gone')
+        self.assertRaises(IOError, self.client.post, self.url, self.payload,
+                          HTTP_X_GITHUB_DELIVERY='guid-1')
+        self.assertFalse(is_duplicate('delivery:guid-1'))
+
+    @mock.patch('trybot_control.handlers.enqueue')
+    def test_failing_consumer(self, enqueue_mock):
+        enqueue_mock.side_effect = IOError('Database is gone')
+        def errors(consumer):
+            return metrics.get_sample_value('github_consumer_errors_total',
+                                            {'consumer': consumer}) or 0
+        trybot = 'trybot_control.handlers.on_pull_request_changed'
+        jira = 'updater_for_jira.views.on_pull_request_changed'
+        trybot_errors, jira_errors = errors(trybot), errors(jira)
+
+        # The other consumers still run, but the delivery fails so that it
+        # can be redelivered.
+        self.assertRaises(ConsumerFailed, self.client.post, self.url,
+                          self.payload, HTTP_X_GITHUB_DELIVERY='guid-1')
+        self.assertEqual(Job.objects.get().task,
+                         'updater_for_jira.handlers.update_issue')
+        self.assertEqual(errors(trybot), trybot_errors + 1)
+        self.assertEqual(errors(jira), jira_errors)
+
+        # The redelivery only reaches the consumer that failed.
+        enqueue_mock.side_effect = None
+        self.client.post(self.url, self.payload,
+                         HTTP_X_GITHUB_DELIVERY='guid-1')
+        self.assertEqual(enqueue_mock.call_count, 2)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertTrue(is_duplicate('delivery:guid-1'))
 
 class SignatureMiddlewareTests(TestCase):
     def test_no_github_signature(self):
@@ -41,3 +296,327 @@ class SignatureMiddlewareTests(TestCase):
                                                hashlib.sha1('xy').hexdigest()
         r = SignatureMiddleware().process_request(request)
         self.assertEqual(r.status_code, 404)
+
+    def _signed_request(self, secret, digestmod, header, prefix):
+        body = 'payload=%s' % urllib.quote_plus('{"zen": "Keep it simple."}')
+        request = RequestFactory().post(
+            '/signed', body, content_type='application/x-www-form-urlencoded')
+        request.META[header] = prefix + \
+            hmac.new(secret, body, digestmod).hexdigest()
+        return request
+
+    @override_settings(GITHUB_HOOK_SECRET='secret')
+    def test_signatures(self):
+        request = self._signed_request('secret', hashlib.sha256,
+                                       'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+        self.assertIsNone(SignatureMiddleware().process_request(request))
+        # The body can still be read by the view.
+        self.assertEqual(request.POST['payload'], '{"zen": "Keep it simple."}')
+        self.assertTrue(request.body.startswith('payload='))
+
+        # Or before the signature is checked.
+        request = self._signed_request('secret', hashlib.sha256,
+                                       'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+        body = request.body
+        self.assertIsNone(SignatureMiddleware().process_request(request))
+        self.assertEqual(request.body, body)
+
+        request = self._signed_request('secret', hashlib.sha1,
+                                       'HTTP_X_HUB_SIGNATURE', 'sha1=')
+        self.assertIsNone(SignatureMiddleware().process_request(request))
+
+        # X-Hub-Signature-256 wins if both are present.
+        request = self._signed_request('secret', hashlib.sha1,
+                                       'HTTP_X_HUB_SIGNATURE', 'sha1=')
+        request.META['HTTP_X_HUB_SIGNATURE_256'] = 'sha256=' + '0' * 64
+        self.assertEqual(
+            SignatureMiddleware().process_request(request).status_code, 404)
+
+        # The algorithm must match the header.
+        request = self._signed_request('secret', hashlib.sha1,
+                                       'HTTP_X_HUB_SIGNATURE_256', 'sha1=')
+        self.assertEqual(
+            SignatureMiddleware().process_request(request).status_code, 404)
+
+        request = self._signed_request('other secret', hashlib.sha256,
+                                       'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+        self.assertEqual(
+            SignatureMiddleware().process_request(request).status_code, 404)
+
+    @override_settings(GITHUB_HOOK_SECRET='new',
+                       GITHUB_HOOK_OLD_SECRETS=('old', 'older'))
+    def test_secret_rotation(self):
+        for secret in ('new', 'older', 'old'):
+            request = self._signed_request(
+                secret, hashlib.sha256, 'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+            self.assertIsNone(SignatureMiddleware().process_request(request))
+            # The last secret that worked is tried first next time.
+            self.assertEqual(signatures.secret_ring().ordered()[0], secret)
+
+        request = self._signed_request('unknown', hashlib.sha256,
+                                       'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+        self.assertEqual(
+            SignatureMiddleware().process_request(request).status_code, 404)
+
+        with override_settings(GITHUB_HOOK_OLD_SECRETS=()):
+            request = self._signed_request(
+                'old', hashlib.sha256, 'HTTP_X_HUB_SIGNATURE_256', 'sha256=')
+            self.assertEqual(
+                SignatureMiddleware().process_request(request).status_code,
+                404)
+
+
+task_mock = mock.Mock()
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        task_mock.reset_mock()
+        task_mock.side_effect = None
+
+    def test_run_job(self):
+        enqueue('github_webhooks.tests.task_mock', number=42, sha='deadbeef')
+        enqueue('github_webhooks.tests.task_mock', number=43, sha='f00b4r')
+        self.assertEqual(Job.objects.count(), 2)
+        self.assertEqual(task_mock.call_count, 0)
+
+        self.assertEqual(process_jobs(), 2)
+        self.assertEqual(task_mock.call_args_list,
+                         [mock.call(number=42, sha='deadbeef'),
+                          mock.call(number=43, sha='f00b4r')])
+        self.assertEqual(Job.objects.count(), 0)
+        self.assertEqual(process_jobs(), 0)
+
+    @override_settings(JOB_MAX_ATTEMPTS=2, JOB_RETRY_DELAY=60)
+    def test_retry(self):
+        task_mock.side_effect = IOError('GitHub is down')
+        enqueue('github_webhooks.tests.task_mock')
+
+        self.assertEqual(process_jobs(), 1)
+        job = Job.objects.get()
+        self.assertEqual(job.state, JOB_QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('GitHub is down', job.last_error)
+        self.assertGreater(job.run_after, timezone.now())
+
+        # The job is only retried after JOB_RETRY_DELAY seconds.
+        self.assertEqual(process_jobs(), 0)
+        Job.objects.update(run_after=timezone.now())
+
+        self.assertEqual(process_jobs(), 1)
+        job = Job.objects.get()
+        self.assertEqual(job.state, JOB_FAILED)
+        self.assertEqual(job.attempts, 2)
+
+        # Failed jobs are not run again.
+        Job.objects.update(run_after=timezone.now())
+        self.assertEqual(process_jobs(), 0)
+        self.assertEqual(task_mock.call_count, 2)
+
+    @override_settings(JOB_MAX_ATTEMPTS=1)
+    def test_rate_limited(self):
+        github.reset_session()
+        task_mock.side_effect = github.RateLimitExceeded(time.time() + 3600)
+        enqueue('github_webhooks.tests.task_mock')
+
+        # The job waits for the rate limit to be reset, and does not use up
+        # its only attempt.
+        self.assertEqual(process_jobs(), 1)
+        job = Job.objects.get()
+        self.assertEqual(job.state, JOB_QUEUED)
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.run_after,
+                           timezone.now() + datetime.timedelta(minutes=59))
+
+        task_mock.side_effect = None
+        Job.objects.update(run_after=timezone.now())
+        self.assertEqual(process_jobs(), 1)
+        self.assertEqual(Job.objects.count(), 0)
+
+    @override_settings(JOB_LOCK_TIMEOUT=60)
+    def test_claim_abandoned_job(self):
+        enqueue('github_webhooks.tests.task_mock')
+        job = claim_job()
+        self.assertEqual(job.state, JOB_RUNNING)
+        self.assertIsNone(claim_job())
+
+        # Pretend the worker running the job died a long time ago.
+        Job.objects.filter(pk=job.pk).update(
+            locked_at=timezone.now() - datetime.timedelta(seconds=120))
+        self.assertEqual(claim_job().pk, job.pk)
+
+
+class GitHubSessionTests(TestCase):
+    def tearDown(self):
+        github.reset_session()
+
+    @override_settings(GITHUB_USERNAME='user', GITHUB_ACCESS_TOKEN='token',
+                       GITHUB_POOL_SIZE=3, GITHUB_MAX_RETRIES=2)
+    def test_shared_session(self):
+        github.reset_session()
+        session = github.session()
+        self.assertIs(github.session(), session)
+        self.assertEqual(session.auth, ('user', 'token'))
+
+        adapter = session.get_adapter('https://api.github.com')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+        github.reset_session()
+        self.assertIsNot(github.session(), session)
+
+    @override_settings(GITHUB_TIMEOUT=7)
+    def test_request(self):
+        with mock.patch.object(github.session(), 'request') as request_mock:
+            github.post('https://api.github.com/foo', data='{}')
+            request_mock.assert_called_with('POST',
+                                            'https://api.github.com/foo',
+                                            data='{}', timeout=7)
+
+            github.patch('https://api.github.com/bar', timeout=1)
+            request_mock.assert_called_with('PATCH',
+                                            'https://api.github.com/bar',
+                                            timeout=1)
+
+
+def mock_response(status_code=200, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class RateLimiterTests(TestCase):
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_token_bucket(self, time_mock, sleep_mock):
+        time_mock.return_value = 1000.0
+        limiter = github.RateLimiter(rate=2, burst=2, reserve=0)
+
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(sleep_mock.call_count, 0)
+
+        # The bucket is empty, a new token is added every 0.5s.
+        limiter.acquire()
+        sleep_mock.assert_called_once_with(0.5)
+        limiter.acquire()
+        sleep_mock.assert_called_with(1.0)
+
+        time_mock.return_value = 1010.0
+        sleep_mock.reset_mock()
+        limiter.acquire()
+        self.assertEqual(sleep_mock.call_count, 0)
+
+    @mock.patch('time.sleep')
+    def test_budget(self, sleep_mock):
+        limiter = github.RateLimiter(rate=100, burst=100, reserve=2)
+        self.assertIsNone(limiter.seconds_until_reset())
+
+        reset_at = int(time.time()) + 60
+        limiter.update(mock_response(headers={
+            'X-RateLimit-Remaining': '3',
+            'X-RateLimit-Reset': str(reset_at),
+        }))
+
+        limiter.acquire(github.PRIORITY_LOW)
+        # Only 2 requests left: keep them for important requests.
+        self.assertRaises(github.RateLimitExceeded,
+                          limiter.acquire, github.PRIORITY_LOW)
+        limiter.acquire(github.PRIORITY_HIGH)
+        limiter.acquire(github.PRIORITY_HIGH)
+        try:
+            limiter.acquire(github.PRIORITY_HIGH)
+            self.fail('RateLimitExceeded not raised')
+        except github.RateLimitExceeded as e:
+            self.assertEqual(e.reset_at, reset_at)
+        self.assertGreater(limiter.seconds_until_reset(), 0)
+
+        # The budget is replenished once the reset time has passed.
+        limiter.update(mock_response(headers={
+            'X-RateLimit-Remaining': '0',
+            'X-RateLimit-Reset': str(int(time.time()) - 1),
+        }))
+        self.assertIsNone(limiter.seconds_until_reset())
+        limiter.acquire(github.PRIORITY_LOW)
+
+    def test_rate_limited_response(self):
+        limiter = github.RateLimiter(rate=100, burst=100, reserve=0)
+
+        # A 403 that is not related to rate limiting.
+        limiter.update(mock_response(403))
+        limiter.acquire()
+
+        # Secondary rate limit.
+        self.assertRaises(github.RateLimitExceeded, limiter.update,
+                          mock_response(403, {'Retry-After': '30'}))
+        self.assertAlmostEqual(limiter.seconds_until_reset(), 30, delta=5)
+        self.assertRaises(github.RateLimitExceeded, limiter.acquire)
+
+        # Primary rate limit.
+        limiter = github.RateLimiter(rate=100, burst=100, reserve=0)
+        self.assertRaises(github.RateLimitExceeded, limiter.update,
+                          mock_response(403, {
+                              'X-RateLimit-Remaining': '0',
+                              'X-RateLimit-Reset': str(int(time.time()) + 60),
+                          }))
+        self.assertRaises(github.RateLimitExceeded, limiter.acquire)
+
+
+class MetricsTests(TestCase):
+    def test_text_format(self):
+        counter = metrics.Counter('requests_total', 'Requests.', ('path',))
+        counter.inc(path='/a')
+        counter.inc(2, path='/a"b')
+        self.assertEqual(counter.samples(), [
+            ('', {'path': '/a'}, 1),
+            ('', {'path': '/a"b'}, 2),
+        ])
+
+        histogram = metrics.Histogram('latency_seconds', 'Latency.',
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.samples(), [
+            ('_bucket', {'le': '0.1'}, 1),
+            ('_bucket', {'le': '1.0'}, 2),
+            ('_bucket', {'le': '+Inf'}, 3),
+            ('_sum', {}, 5.55),
+            ('_count', {}, 3),
+        ])
+
+        self.assertEqual(metrics._format_labels({'path': '/a"b', 'x': 1}),
+                         '{path="/a\\"b",x="1"}')
+
+    def test_outbound_requests(self):
+        def count(outcome):
+            for _, labels, value in metrics.outbound_requests.samples():
+                if labels == {'service': 'github', 'operation': 'test',
+                              'outcome': outcome}:
+                    return value
+            return 0
+
+        ok, server_errors = count('2xx'), count('5xx')
+        with mock.patch.object(github.session(), 'request') as request_mock:
+            request_mock.return_value = mock_response(201)
+            github.post('https://api.github.com/foo', operation='test')
+            request_mock.return_value = mock_response(502)
+            github.post('https://api.github.com/foo', operation='test')
+        self.assertEqual(count('2xx'), ok + 1)
+        self.assertEqual(count('5xx'), server_errors + 1)
+
+    def test_endpoint(self):
+        enqueue('github_webhooks.tests.task_mock')
+        response = self.client.get(reverse(
+            'github_webhooks.views.export_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('# TYPE jobs gauge\n', response.content)
+        self.assertIn('jobs{state="queued"} 1.0\n', response.content)
+        self.assertIn('trybot_pull_requests_needing_sync 0.0\n',
+                      response.content)
+
+        response = self.client.post(reverse(
+            'github_webhooks.views.export_metrics'))
+        self.assertEqual(response.status_code, 405)
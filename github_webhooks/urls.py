@@ -6,6 +6,11 @@ from django.conf.urls import patterns, include, url
 
 
 urlpatterns = patterns('',
+    url(r'^github-hooks/$',
+        'github_webhooks.views.handle_event'),
+    url(r'^metrics$',
+        'github_webhooks.views.export_metrics'),
+    # Per-application endpoints, kept for hooks that still point to them.
     url(r'^github-hooks/jira$',
         'updater_for_jira.views.handle_pull_request'),
     url(r'^github-hooks/trybot$',
@@ -0,0 +1,45 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+from django.db.models import get_apps
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET, require_POST
+
+from github_webhooks import metrics
+from github_webhooks.decorators import add_github_payload, require_github_signature
+from github_webhooks.decorators import filter_github_events
+from github_webhooks.decorators import ignore_duplicate_deliveries
+from github_webhooks.dispatch import consumer_actions
+from github_webhooks.dispatch import send_pull_request_changed
+
+
+# Loading all installed applications makes sure their pull_request_changed
+# consumers have been registered before the first event arrives.
+get_apps()
+
+
+@require_POST
+@require_github_signature
+@filter_github_events(['pull_request'], actions=consumer_actions())
+@add_github_payload
+@ignore_duplicate_deliveries
+def handle_event(request):
+    """
+    Single entry point for GitHub pull request events: the payload is
+    verified and decoded once and then passed to all consumers.
+    """
+    send_pull_request_changed(request.payload,
+                              request.META.get('HTTP_X_GITHUB_DELIVERY'))
+    return HttpResponse()
+
+
+@require_GET
+def export_metrics(request):
+    """
+    Returns the metrics of this process in the Prometheus text format. The
+    web server is expected to only let trusted clients (the Prometheus
+    server) reach this URL.
+    """
+    return HttpResponse(metrics.generate_latest(),
+                        content_type=metrics.CONTENT_TYPE)
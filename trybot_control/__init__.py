@@ -4,3 +4,5 @@
 
 # Import handlers.py so that the signal handlers are properly registered.
 import trybot_control.handlers
+# Register the collectors of the trybot metrics.
+import trybot_control.metrics
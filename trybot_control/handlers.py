@@ -0,0 +1,326 @@
+# Copyright (c) 2014 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Consumer of the pull_request_changed signal, and the slow actions it
+triggers. These are queued with github_webhooks.jobs.enqueue() and run by the
+process_jobs management command.
+"""
+
+import json
+import logging
+import requests
+import urllib
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from github_webhooks import github
+from github_webhooks import metrics
+from github_webhooks.deliveries import forget, is_duplicate
+from github_webhooks.dispatch import pull_request_consumer
+from github_webhooks.jobs import enqueue
+from trybot_control.masters import choose_master, get_master, health_checker
+from trybot_control.models import PullRequest, TrybotBuild, STATUS_PENDING
+from trybot_control.models import master_loads
+from trybot_control.routing import routing_table
+
+
+_unrouted = metrics.counter(
+    'trybot_unrouted_pull_requests_total',
+    'Pull request events ignored because TRYBOT_ROUTES has no route for '
+    'their target branch.')
+
+
+class PatchTooLarge(Exception):
+    """
+    Raised by download_patch() when a patch series is bigger than
+    TRYBOT_MAX_INLINE_PATCH_SIZE.
+    """
+
+
+def download_patch(patch_url):
+    """
+    Downloads the patch series at |patch_url| from GitHub, which compresses it
+    on the wire. It is read in chunks of TRYBOT_PATCH_CHUNK_SIZE bytes, and
+    the download stops with PatchTooLarge as soon as the series is known to
+    be bigger than TRYBOT_MAX_INLINE_PATCH_SIZE bytes. Returns the list of
+    chunks, or None if GitHub did not send the patch series.
+    """
+    response = github.get(patch_url, operation='download_patch', stream=True)
+    try:
+        if response.status_code != 200:
+            logging.error('Fetching %s from GitHub failed with status code '
+                          '%d.' % (patch_url, response.status_code))
+            return None
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(settings.TRYBOT_PATCH_CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.TRYBOT_MAX_INLINE_PATCH_SIZE:
+                raise PatchTooLarge(patch_url)
+            chunks.append(chunk)
+        return chunks
+    finally:
+        response.close()
+
+
+def make_trybot_payload(pull_request):
+    """
+    Gets any relevant data from a pull request JSON object sent by GitHub and
+    uses that to build a dict with the keys used by try_job_base.py. The
+    patch series is either in "patch" (as a list of chunks, see
+    send_patch()) or, if it is too big, referenced by "patch_url".
+    """
+    payload = {
+        'user': pull_request['user']['login'],
+        'name': pull_request['title'],
+        'email': 'noreply@01.org',
+        'revision': pull_request['head']['sha'],
+        'project': pull_request['base']['repo']['name'],
+        'repository': pull_request['base']['repo']['name'],
+        'branch': pull_request['base']['ref'],
+    }
+    try:
+        payload['patch'] = download_patch(pull_request['patch_url'])
+    except PatchTooLarge:
+        logging.warn('%s is too big to be sent to Buildbot, sending its URL '
+                     'instead.' % pull_request['patch_url'])
+        payload['patch_url'] = pull_request['patch_url']
+        return payload
+    if payload['patch'] is None:
+        return None
+    return payload
+
+
+def send_patch(trybot_payload, send_patch_url):
+    """
+    Posts |trybot_payload| to |send_patch_url|. The form is encoded (and
+    gzipped if TRYBOT_COMPRESS_PATCH is set) as it is sent, using chunked
+    transfer encoding, so that the patch series is not copied again.
+    Raises an exception if Buildbot does not accept it.
+    """
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    body = _encode_form(trybot_payload)
+    if settings.TRYBOT_COMPRESS_PATCH:
+        headers['Content-Encoding'] = 'gzip'
+        body = _gzip(body)
+    with metrics.outbound_call('buildbot', 'send_patch'):
+        response = requests.post(send_patch_url, data=body, headers=headers,
+                                 timeout=settings.TRYBOT_BUILDBOT_TIMEOUT)
+        response.raise_for_status()
+
+
+def _encode_form(fields):
+    """
+    Yields the application/x-www-form-urlencoded representation of the
+    |fields| dictionary piece by piece. Values can be lists of strings, which
+    are concatenated.
+    """
+    separator = ''
+    for name, value in sorted(fields.iteritems()):
+        yield '%s%s=' % (separator, urllib.quote_plus(name))
+        separator = '&'
+        if not isinstance(value, list):
+            value = [value]
+        for chunk in value:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            yield urllib.quote_plus(str(chunk))
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def start_try_job(pull_request):
+    """
+    Posts the initial Trybot comment to a pull request, registers it in the
+    database and queues a send_try_job() job to send it to Buildbot.
+    |pull_request| is the "pull_request" object of a GitHub pull_request
+    event.
+    The job queue retries failed jobs, and nothing here can be done twice,
+    so the steps that can fail after the comment has been posted are left to
+    a separate job. Nothing is sent to Buildbot if a newer head of the pull
+    request has already been registered.
+    """
+    route = routing_table().route(pull_request['base']['repo']['full_name'],
+                                  pull_request['base']['ref'])
+    if route is None:
+        # TRYBOT_ROUTES has changed since the job was queued.
+        logging.info('Pull request %d is not routed to any builders anymore.'
+                     % pull_request['number'])
+        return
+
+    pull_request_number = pull_request['number']
+    base_repo_path = pull_request['base']['repo']['full_name']
+    head_repo_path = pull_request['head']['repo']['full_name']
+    sha = pull_request['head']['sha']
+    updated_at = pull_request.get('updated_at')
+    if updated_at is not None:
+        updated_at = parse_datetime(updated_at)
+        if not settings.USE_TZ and timezone.is_aware(updated_at):
+            updated_at = timezone.make_naive(updated_at,
+                                             timezone.get_default_timezone())
+
+    comment_url = '%s/repos/%s/issues/%d/comments' % \
+                  (settings.GITHUB_API_URL, base_repo_path, pull_request_number)
+    message = 'The patch series with %s@%s as head will be tested soon.' % \
+              (head_repo_path, sha)
+    response = github.post(comment_url, operation='create_comment',
+                           data=json.dumps({'body': message}))
+    comment_id = response.json()['id']
+
+    with transaction.atomic():
+        pr_object = PullRequest.objects.create(number=pull_request_number,
+                                               head_sha=sha,
+                                               base_repo_path=base_repo_path,
+                                               head_repo_path=head_repo_path,
+                                               comment_id=comment_id,
+                                               updated_at=updated_at)
+        if supersede_pull_requests(pr_object):
+            logging.info('Pull request %d has a newer head than %s.' %
+                         (pull_request_number, sha))
+            return
+        enqueue('trybot_control.handlers.send_try_job',
+                pull_request_id=pr_object.pk, pull_request=pull_request)
+
+
+def send_try_job(pull_request_id, pull_request):
+    """
+    Sets the initial GitHub status of the PullRequest |pull_request_id| and
+    sends its patch series to the least loaded Buildbot master it can go to.
+    |pull_request| is the "pull_request" object of the GitHub event passed
+    to start_try_job(). Can be retried after failing at any point.
+    """
+    pr_object = PullRequest.objects.filter(pk=pull_request_id).first()
+    if pr_object is None:
+        logging.info('Pull request %d has been removed before being sent to '
+                     'Buildbot.' % pull_request_id)
+        return
+    route = routing_table().route(pr_object.base_repo_path,
+                                  pull_request['base']['ref'])
+    if route is None:
+        logging.info('Pull request %d is not routed to any builders anymore.'
+                     % pr_object.number)
+        return
+    # This raises if no master can take the pull request now, in which case
+    # the job is retried later.
+    master = choose_master(route.masters, master_loads)
+
+    trybot_payload = make_trybot_payload(pull_request)
+    if trybot_payload is None:
+        # Raising makes the job be retried later.
+        raise IOError('Could not fetch %s.' % pull_request['patch_url'])
+
+    if pr_object.master != master.name:
+        pr_object.master = master.name
+        pr_object.save(update_fields=['master'])
+    if not pr_object.synced_status:
+        pr_object.report_build_status()
+        pr_object.save(update_fields=['synced_status'])
+
+    # FIXME(rakuco): This is a bit too fragile, we create this object in the
+    # make_trybot_payload() call but it needs this to have all the information
+    # Buildbot needs.
+    trybot_payload['issue'] = pr_object.pk
+    if route.builders is not None:
+        # try_job_base.py takes the builders to use as a comma-separated list.
+        trybot_payload['bot'] = ','.join(route.builders)
+
+    try:
+        send_patch(trybot_payload, master.send_patch_url)
+    except Exception:
+        health_checker().mark_unhealthy(master)
+        raise
+
+
+def supersede_pull_requests(pull_request):
+    """
+    Marks the other PullRequest objects with the same number and base
+    repository as |pull_request| as superseded, so that they are not synced
+    to GitHub anymore. If TRYBOT_STOP_SUPERSEDED_BUILDS is set, a job to stop
+    their pending builds is also queued.
+    Heads are ordered by |updated_at| where it is known, and by the order in
+    which they are registered otherwise. If one of the other objects is newer
+    than |pull_request|, |pull_request| is marked as superseded instead.
+    Returns whether |pull_request| is superseded.
+    """
+    superseded = PullRequest.objects.filter(
+        number=pull_request.number,
+        base_repo_path=pull_request.base_repo_path,
+        superseded=False).exclude(pk=pull_request.pk)
+    if pull_request.updated_at is not None and superseded.filter(
+            updated_at__gt=pull_request.updated_at).exists():
+        pull_request.superseded = True
+        pull_request.needs_sync = False
+        pull_request.save(update_fields=['superseded', 'needs_sync'])
+        return True
+    if settings.TRYBOT_STOP_SUPERSEDED_BUILDS:
+        builds = list(TrybotBuild.objects.filter(
+            pull_request__in=superseded, status=STATUS_PENDING).values_list(
+            'master', 'builder_name', 'build_number'))
+        if builds:
+            enqueue('trybot_control.handlers.stop_builds', builds=builds)
+    superseded.update(superseded=True, needs_sync=False)
+    return False
+
+
+def stop_builds(builds):
+    """
+    Asks Buildbot to stop |builds|, a list of (master name, builder name,
+    build number) tuples. Builds that have already finished are ignored by
+    Buildbot.
+    """
+    for master_name, builder_name, build_number in builds:
+        url = '%s/builders/%s/builds/%d/stop' % \
+              (get_master(master_name).base_url, urllib.quote(builder_name),
+               build_number)
+        with metrics.outbound_call('buildbot', 'stop_build'):
+            response = requests.post(
+                url,
+                data={'comments': 'A newer head has been pushed to the pull '
+                                  'request.'},
+                timeout=settings.TRYBOT_BUILDBOT_TIMEOUT)
+            response.raise_for_status()
+
+
+# 'reopened' is irrelevant for our purposes. 'closed' initially looks
+# relevant, but we cannot kill the trybot builds in the middle: we need to
+# wait for them to complete and only then remove the pull request from the
+# database and update the status.
+@pull_request_consumer(actions=('opened', 'synchronize'))
+def on_pull_request_changed(payload):
+    pull_request = payload['pull_request']
+
+    # Nothing is posted to GitHub if no builder would test the pull request.
+    target_repository = pull_request['base']['repo']['full_name']
+    target_branch = pull_request['base']['ref']
+    if routing_table().route(target_repository, target_branch) is None:
+        _unrouted.inc()
+        return
+
+    # GitHub may send different events for the same head (e.g. "opened" and
+    # "synchronize"), and it only needs to be tested once.
+    key = 'trybot:%s:%s#%d@%s' % (target_repository, target_branch,
+                                  pull_request['number'],
+                                  pull_request['head']['sha'])
+    if is_duplicate(key):
+        return
+
+    try:
+        enqueue('trybot_control.handlers.start_try_job',
+                pull_request=pull_request)
+    except Exception:
+        forget(key)
+        raise
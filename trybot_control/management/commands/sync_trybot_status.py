@@ -2,24 +2,170 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
+import logging
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from github_webhooks import github
+from github_webhooks import metrics
+from trybot_control import notifications
+from trybot_control import retention
+from trybot_control.models import PullRequest
+from trybot_control.models import STATUS_FAILURE, STATUS_PENDING
 
-from trybot_control.models import PullRequest, STATUS_PENDING
+
+def sync_pull_request(pull_request):
+    """
+    Sends the builder statuses and the overall status of |pull_request| to
+    GitHub. Returns a (pull_request, succeeded, seconds taken) tuple.
+    This must not touch the database, as it can run in a separate thread.
+    """
+    start = time.time()
+    try:
+        # The status goes first, as it is more important than the comment if
+        # we are running out of GitHub API requests.
+        if pull_request.reported_status() != pull_request.synced_status:
+            pull_request.report_build_status()
+        pull_request.report_builder_statuses()
+    except Exception:
+        logging.error('Could not sync pull request %d:\n%s' %
+                      (pull_request.pk, traceback.format_exc()))
+        return (pull_request, False, time.time() - start)
+    return (pull_request, True, time.time() - start)
 
 
 class Command(BaseCommand):
     help = 'Goes through the list of status updates sent by Buildbot and ' \
            'updates the related pull request with the new information.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of pull requests to update on GitHub at '
+                         'the same time.'),
+        make_option('--daemon', action='store_true', dest='daemon',
+                    default=False,
+                    help='Keep running and sync pull requests as soon as '
+                         'Buildbot reports changes to them.'),
+        make_option('--metrics-port', type='int', dest='metrics_port',
+                    default=None,
+                    help='Export the metrics of this process over HTTP on '
+                         'this port.'),
+    )
+
     def handle(self, *args, **options):
-        for pull_request in PullRequest.objects.filter(needs_sync=True):
-            pull_request.needs_sync = False
-            pull_request.save()
+        if options['metrics_port'] is not None:
+            metrics.start_http_server(options['metrics_port'])
+        pool = None
+        if options['workers'] > 1:
+            pool = ThreadPool(options['workers'])
 
-            pull_request.report_builder_statuses()
-            pull_request.report_build_status()
+        try:
+            if options['daemon']:
+                self._run_daemon(pool)
+            else:
+                self._sync(pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _run_daemon(self, pool):
+        sock = notifications.listen()
+        try:
+            while True:
+                # Everything would fail right away, so do not even try.
+                blocked = github.rate_limiter().seconds_until_reset()
+                if blocked is not None:
+                    time.sleep(blocked)
+
+                next_sync = self._sync(pool)
+                # Do not keep a connection open while idling.
+                close_old_connections()
+                timeout = settings.TRYBOT_SYNC_POLL_INTERVAL
+                if next_sync is not None:
+                    timeout = min(timeout, next_sync)
+                notifications.wait_for_notification(sock, timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+
+    def _sync(self, pool):
+        """
+        Syncs all pull requests that need it. Returns the number of seconds
+        until a pull request whose update was postponed can be synced, or
+        None if there is none.
+        """
+        start = time.time()
+        now = timezone.now()
+
+        # Pull requests whose comment has been updated recently are left for
+        # later, so that changes from several builders are sent in one go.
+        # Pull requests that have finished building are always synced, and so
+        # are those with a first failed build to report.
+        interval = datetime.timedelta(
+            seconds=settings.TRYBOT_COMMENT_UPDATE_INTERVAL)
+        recently_synced = \
+            Q(status=STATUS_PENDING, synced_at__gt=now - interval) & \
+            (Q(builds_failed=0) | Q(synced_status=STATUS_FAILURE))
+        to_sync = PullRequest.objects.filter(needs_sync=True, superseded=False)
+
+        pks = list(to_sync.exclude(recently_synced)
+                          .values_list('pk', flat=True))
+        postponed = to_sync.filter(recently_synced).aggregate(
+            Min('synced_at'))['synced_at__min']
+        # The flag is cleared before the pull requests are read, so that
+        # changes Buildbot reports in the meantime are either part of what is
+        # sent now or flag them again for the next run.
+        PullRequest.objects.filter(pk__in=pks).update(needs_sync=False)
+        # The builds are fetched here so that sync_pull_request() does not
+        # need to access the database.
+        pull_requests = list(PullRequest.objects.filter(pk__in=pks)
+                             .prefetch_related('trybotbuild_set'))
+
+        if pool is not None and len(pull_requests) > 1:
+            results = pool.map(sync_pull_request, pull_requests)
+        else:
+            results = map(sync_pull_request, pull_requests)
+
+        # Try again next time.
+        failed = [pr.pk for pr, succeeded, _ in results if not succeeded]
+        PullRequest.objects.filter(pk__in=failed).update(needs_sync=True)
+
+        for pr, succeeded, _ in results:
+            if succeeded:
+                PullRequest.objects.filter(pk=pr.pk).update(
+                    synced_at=now, comment_sha1=pr.comment_sha1,
+                    synced_status=pr.synced_status)
+
+        # Pull requests that have finished building are moved to the archive
+        # along with their builds.
+        retention.archive_finished_pull_requests(now=now)
+        retention.purge_archive(now=now)
+
+        if results:
+            self._print_summary(results, time.time() - start)
+
+        if postponed is None:
+            return None
+        return max(0, (postponed + interval - timezone.now()).total_seconds())
 
-        # TrybotBuild entries with this pull request number will be deleted
-        # automatically (Django's default behavior is ON DELETE CASCADE).
-        PullRequest.objects.exclude(status=STATUS_PENDING).delete()
+    def _print_summary(self, results, elapsed):
+        latencies = sorted(seconds for _, _, seconds in results)
+        elapsed = max(elapsed, 0.001)
+        failed = len([r for r in results if not r[1]])
+        self.stdout.write(
+            'Synced %d pull requests (%d failed) in %.2fs (%.1f/s). '
+            'Latency: median %dms, max %dms.' %
+            (len(results), failed, elapsed, len(results) / elapsed,
+             latencies[len(latencies) / 2] * 1000, latencies[-1] * 1000))
@@ -0,0 +1,28 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from trybot_control import schema
+
+
+class Command(BaseCommand):
+    help = 'Adds the missing columns, indexes and constraints to the ' \
+           'trybot_control tables created by an older version. Run syncdb ' \
+           'first. Running it again does nothing.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Print the SQL statements without running them.'),
+    )
+
+    def handle(self, *args, **options):
+        statements = schema.upgrade(dry_run=options['dry_run'])
+        for sql in statements:
+            self.stdout.write('%s;' % sql)
+        if not statements:
+            self.stdout.write('The trybot_control tables are up to date.')
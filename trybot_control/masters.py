@@ -0,0 +1,164 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+The Buildbot masters try jobs are sent to.
+
+TRYBOT_MASTERS names the masters and their URLs. Without it, there is a single
+master at TRYBOT_BASE_URL and TRYBOT_SEND_PATCH_URL whose name is the empty
+string, which is also the master of the pull requests created before masters
+had names.
+
+Each pull request goes to the healthy master with the least work (see
+trybot_control.models.master_loads()). A master is healthy if a GET request
+to its base URL succeeded in the last TRYBOT_MASTER_HEALTH_CHECK_INTERVAL
+seconds. Masters failing to accept a patch are considered unhealthy until
+they are checked again.
+"""
+
+import collections
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+
+from github_webhooks import metrics
+
+
+Master = collections.namedtuple('Master',
+                                ('name', 'base_url', 'send_patch_url'))
+
+
+class NoMasterAvailable(Exception):
+    pass
+
+
+# Cache for configured_masters(): a ((TRYBOT_MASTERS, TRYBOT_BASE_URL,
+# TRYBOT_SEND_PATCH_URL), masters) tuple.
+_masters_cache = (None, None)
+_masters_lock = threading.Lock()
+
+
+def configured_masters():
+    """
+    Returns a dictionary mapping the name of each master to its Master.
+    """
+    global _masters_cache
+    key = (settings.TRYBOT_MASTERS, settings.TRYBOT_BASE_URL,
+           settings.TRYBOT_SEND_PATCH_URL)
+    with _masters_lock:
+        cached_key, masters = _masters_cache
+        if cached_key != key:
+            if settings.TRYBOT_MASTERS:
+                masters = dict(
+                    (name, Master(name, options['base_url'],
+                                  options['send_patch_url']))
+                    for name, options in settings.TRYBOT_MASTERS.iteritems())
+            else:
+                masters = {'': Master('', settings.TRYBOT_BASE_URL,
+                                      settings.TRYBOT_SEND_PATCH_URL)}
+            _masters_cache = (key, masters)
+        return masters
+
+
+def get_master(name):
+    """
+    Returns the Master called |name|. Masters that are not configured anymore
+    are assumed to be at TRYBOT_BASE_URL and TRYBOT_SEND_PATCH_URL.
+    """
+    master = configured_masters().get(name)
+    if master is None:
+        master = Master(name, settings.TRYBOT_BASE_URL,
+                        settings.TRYBOT_SEND_PATCH_URL)
+    return master
+
+
+class HealthChecker(object):
+    """
+    Remembers whether each master is healthy for |interval| seconds.
+    """
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.timeout = timeout
+        # Maps master names to (healthy, time of the check) tuples.
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def is_healthy(self, master):
+        with self.lock:
+            state = self.states.get(master.name)
+        if state is not None and time.time() - state[1] < self.interval:
+            return state[0]
+
+        try:
+            with metrics.outbound_call('buildbot', 'health_check'):
+                response = requests.get(master.base_url,
+                                        timeout=self.timeout)
+            healthy = response.status_code < 500
+        except requests.RequestException:
+            healthy = False
+        with self.lock:
+            self.states[master.name] = (healthy, time.time())
+        return healthy
+
+    def mark_unhealthy(self, master):
+        with self.lock:
+            self.states[master.name] = (False, time.time())
+
+
+_health_checker = None
+
+
+def health_checker():
+    """
+    Returns the HealthChecker shared by the whole process, creating it if
+    necessary.
+    """
+    global _health_checker
+    with _masters_lock:
+        if _health_checker is None:
+            _health_checker = HealthChecker(
+                settings.TRYBOT_MASTER_HEALTH_CHECK_INTERVAL,
+                settings.TRYBOT_MASTER_HEALTH_CHECK_TIMEOUT)
+        return _health_checker
+
+
+def reset_health_checker():
+    """
+    Forgets the health of all masters.
+    """
+    global _health_checker
+    with _masters_lock:
+        _health_checker = None
+
+
+def choose_master(names, get_loads):
+    """
+    Returns the healthy Master with the lowest load among those called
+    |names| (all configured masters if None). |get_loads| is called to get a
+    dictionary mapping master names to their load if there is more than one
+    candidate. Raises NoMasterAvailable if no candidate is healthy.
+    """
+    masters = configured_masters()
+    if names is None:
+        names = masters.keys()
+    candidates = [masters[name] for name in names if name in masters]
+    if not candidates:
+        raise NoMasterAvailable('None of the masters %s is configured.' %
+                                ', '.join(names))
+    if len(candidates) == 1:
+        # There is no choice to make, so do not bother checking it.
+        return candidates[0]
+
+    loads = get_loads()
+    candidates.sort(key=lambda master: (loads.get(master.name, 0),
+                                        master.name))
+    checker = health_checker()
+    for master in candidates:
+        if checker.is_healthy(master):
+            return master
+    raise NoMasterAvailable('No healthy master among %s.' %
+                            ', '.join(m.name for m in candidates))
@@ -0,0 +1,34 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from github_webhooks import metrics
+from trybot_control.models import PullRequest
+
+
+@metrics.register_collector
+def collect_metrics():
+    """
+    Exports the number of pull requests waiting to be synced with GitHub, and
+    how long the one that has waited the longest has been waiting.
+    """
+    backlog = PullRequest.objects.filter(needs_sync=True, superseded=False) \
+                                 .aggregate(Count('pk'),
+                                            Min('needs_sync_since'))
+
+    pending = metrics.Gauge('trybot_pull_requests_needing_sync',
+                            'Pull requests whose status and comment need to '
+                            'be sent to GitHub.')
+    pending.set(backlog['pk__count'])
+
+    oldest = backlog['needs_sync_since__min']
+    lag = metrics.Gauge('trybot_sync_lag_seconds',
+                        'Time the pull request needing a sync that has '
+                        'waited the longest has been waiting (0 if there is '
+                        'none).')
+    lag.set(0 if oldest is None else
+            (timezone.now() - oldest).total_seconds())
+    return [pending, lag]
@@ -2,12 +2,17 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import hashlib
 import json
-import requests
 import urllib
 
 from django.conf import settings
 from django.db import models
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from github_webhooks import github
+from trybot_control.masters import get_master
 
 
 # These are GitHub status names.
@@ -15,13 +20,25 @@ from django.db import models
 STATUS_PENDING = 'pending'
 STATUS_FAILURE = 'failure'
 STATUS_SUCCESS = 'success'
+# Statuses of pull requests that are not being built anymore.
+FINISHED_STATUSES = (STATUS_FAILURE, STATUS_SUCCESS)
+
+# Maps TrybotBuild statuses to the PullRequest fields counting them.
+BUILD_COUNT_FIELDS = {
+    STATUS_PENDING: 'builds_pending',
+    STATUS_FAILURE: 'builds_failed',
+    STATUS_SUCCESS: 'builds_succeeded',
+}
 
 
 class TrybotBuild(models.Model):
     class Meta:
-        unique_together = ('builder_name', 'build_number')
+        unique_together = ('master', 'builder_name', 'build_number')
 
     pull_request = models.ForeignKey('PullRequest')
+    # Name of the Buildbot master running the build (the same as the pull
+    # request's), as build numbers are only unique in a master.
+    master = models.CharField(max_length=64, blank=True)
     builder_name = models.CharField(max_length=256)
     build_number = models.IntegerField()
     status = models.CharField(max_length=7, default=STATUS_PENDING, choices=(
@@ -31,7 +48,52 @@ class TrybotBuild(models.Model):
     ))
 
 
+# Human-readable names of TrybotBuild statuses, as used in the Trybot comment.
+BUILD_STATUS_DISPLAY = dict(TrybotBuild._meta.get_field('status').choices)
+
+_COMMENT_HEADER = 'Testing patch series with %s@%s as its head.\n\n' \
+                  'Bot | Status\n' \
+                  '--- | ------\n'
+_COMMENT_ROW = '%s | [%s](%s/%d)\n'
+
+# Maps (Buildbot base URL, builder name) to the URL of the builder's builds.
+# There are only a few builders, so this does not need to be bounded.
+_builds_urls = {}
+
+
+def _builds_url(base_url, builder_name):
+    key = (base_url, builder_name)
+    url = _builds_urls.get(key)
+    if url is None:
+        url = _builds_urls[key] = '%s/builders/%s/builds' % \
+                                  (base_url, urllib.quote(builder_name))
+    return url
+
+
+def render_builder_statuses(head_repo_path, head_sha, builds, base_url=None):
+    """
+    Returns the body of the Trybot comment for a pull request whose head is
+    |head_sha| in |head_repo_path|. |builds| is a list of (builder name,
+    build number, status) tuples, one per row of the table, whose links
+    point to the Buildbot master at |base_url| (TRYBOT_BASE_URL by default).
+    """
+    if base_url is None:
+        base_url = settings.TRYBOT_BASE_URL
+    rows = [_COMMENT_HEADER % (head_repo_path, head_sha)]
+    rows.extend(_COMMENT_ROW % (builder_name,
+                                BUILD_STATUS_DISPLAY[status],
+                                _builds_url(base_url, builder_name),
+                                build_number)
+                for builder_name, build_number, status in builds)
+    return ''.join(rows)
+
+
 class PullRequest(models.Model):
+    class Meta:
+        # Indexes on needs_sync and status (partial ones where the database
+        # can use them) are created by the SQL files in sql/.
+        index_together = [('base_repo_path', 'number', 'head_sha')]
+
     # Pull request number.
     number = models.IntegerField()
     # SHA1 of the tip of the branch to be merged.
@@ -50,41 +112,130 @@ class PullRequest(models.Model):
     ))
     # Whether a comment and status update needs to be sent.
     needs_sync = models.BooleanField(default=True)
+    # When needs_sync was last set after having been cleared (or when the
+    # pull request was created, if it has never been synced).
+    needs_sync_since = models.DateTimeField(null=True, default=timezone.now)
+    # When the comment and status were last sent to GitHub.
+    synced_at = models.DateTimeField(null=True)
+    # SHA1 of the last comment body sent to GitHub.
+    comment_sha1 = models.CharField(max_length=40, blank=True)
+    # Whether a newer head has been pushed to the same pull request. Builds of
+    # superseded pull requests are still recorded, but not sent to GitHub.
+    superseded = models.BooleanField(default=False)
+    # Number of builds with each status, kept up to date as Buildbot reports
+    # them (see BUILD_COUNT_FIELDS).
+    builds_pending = models.IntegerField(default=0)
+    builds_failed = models.IntegerField(default=0)
+    builds_succeeded = models.IntegerField(default=0)
+    # Last status sent to GitHub (see reported_status()).
+    synced_status = models.CharField(max_length=7, blank=True)
+    # Name of the Buildbot master the pull request was sent to (see
+    # trybot_control/masters.py).
+    master = models.CharField(max_length=64, blank=True)
+    # The "updated_at" field of the GitHub event this head was received in,
+    # used to tell which head is the newest when events are handled out of
+    # order. Null if the event did not have it.
+    updated_at = models.DateTimeField(null=True)
+
+    def reported_status(self):
+        """
+        Returns the status to show on GitHub. It is |status|, except that a
+        pull request is reported as failed as soon as one of its builds fails,
+        without waiting for the others to finish.
+        """
+        if self.status == STATUS_PENDING and self.builds_failed > 0:
+            return STATUS_FAILURE
+        return self.status
 
     def report_build_status(self):
         """
         Sets a certain pull request's GitHub status (the status of all builds
         reported so far). Compare with |report_builder_statues|.
+        |synced_status| is updated but not saved.
+        Raises an exception if GitHub does not accept the new status.
         """
-        url = 'https://api.github.com/repos/%s/statuses/%s' % \
-              (self.base_repo_path, self.head_sha)
-        payload = {'state': self.status,
-                   'description': self.get_status_display(),
+        status = self.reported_status()
+        url = '%s/repos/%s/statuses/%s' % \
+              (settings.GITHUB_API_URL, self.base_repo_path, self.head_sha)
+        payload = {'state': status,
+                   'description': PULL_REQUEST_STATUS_DISPLAY[status],
                    'target_url': ''}
-        requests.post(url, data=json.dumps(payload),
-                      auth=(settings.GITHUB_USERNAME,
-                            settings.GITHUB_ACCESS_TOKEN))
+        response = github.post(url, operation='set_status',
+                               data=json.dumps(payload))
+        response.raise_for_status()
+        self.synced_status = status
 
     def report_builder_statuses(self):
         """
         Creates or updates the Trybot comment in a pull request with the status
         of all builders registered so far.
+        Nothing is sent if the comment would not change. Returns whether the
+        comment was updated. |comment_sha1| is updated but not saved.
+        Raises an exception if GitHub does not accept the new comment.
         """
-        message =  'Testing patch series with %s@%s as its head.\n\n' % \
-                   (self.head_repo_path, self.head_sha)
-        message += 'Bot | Status\n'
-        message += '--- | ------\n'
-
-        for builder in self.trybotbuild_set.all():
-            message += '%s | [%s](%s/builders/%s/builds/%d)\n' % \
-                       (builder.builder_name, builder.get_status_display(),
-                        settings.TRYBOT_BASE_URL,
-                        urllib.quote(builder.builder_name),
-                        builder.build_number)
-
-        url = 'https://api.github.com/repos/%s/issues/comments/%d' % \
-              (self.base_repo_path, self.comment_id)
-        requests.patch(url,
-                       auth=(settings.GITHUB_USERNAME,
-                             settings.GITHUB_ACCESS_TOKEN),
-                       data=json.dumps({'body': message}))
+        message = render_builder_statuses(
+            self.head_repo_path, self.head_sha,
+            [(build.builder_name, build.build_number, build.status)
+             for build in self.trybotbuild_set.all()],
+            get_master(self.master).base_url)
+
+        message_sha1 = hashlib.sha1(message.encode('utf-8')).hexdigest()
+        if message_sha1 == self.comment_sha1:
+            return False
+
+        url = '%s/repos/%s/issues/comments/%d' % \
+              (settings.GITHUB_API_URL, self.base_repo_path, self.comment_id)
+        # Comment updates are less important than the status (which is what
+        # is shown next to the commit and in the pull request list), so they
+        # are the first to go when we are close to the API rate limit.
+        response = github.patch(url, priority=github.PRIORITY_LOW,
+                                operation='edit_comment',
+                                data=json.dumps({'body': message}))
+        response.raise_for_status()
+        self.comment_sha1 = message_sha1
+        return True
+
+
+PULL_REQUEST_STATUS_DISPLAY = dict(
+    PullRequest._meta.get_field('status').choices)
+
+
+class ArchivedPullRequest(models.Model):
+    """
+    Summary of a PullRequest that has finished building, kept after the
+    pull request and its builds are removed (see trybot_control/retention.py).
+    """
+    class Meta:
+        index_together = (('base_repo_path', 'number'),)
+
+    number = models.IntegerField()
+    head_sha = models.CharField(max_length=40)
+    base_repo_path = models.CharField(max_length=256)
+    head_repo_path = models.CharField(max_length=256)
+    status = models.CharField(max_length=7)
+    superseded = models.BooleanField(default=False)
+    master = models.CharField(max_length=64, blank=True)
+    # When the comment and status were last sent to GitHub.
+    synced_at = models.DateTimeField(null=True)
+    archived_at = models.DateTimeField(db_index=True)
+    # The builds of the pull request as a JSON list of [builder name, build
+    # number, status] lists.
+    builds = models.TextField()
+
+
+def master_loads():
+    """
+    Returns a dictionary mapping the names of Buildbot masters to their load:
+    the number of builds they have started but not finished, plus the number
+    of pull requests sent to them whose builds have not started yet (unless
+    a newer head has been pushed since).
+    """
+    building = PullRequest.objects.filter(status=STATUS_PENDING)
+    loads = dict(building.values_list('master')
+                 .annotate(Sum('builds_pending')).order_by())
+    waiting = building.filter(superseded=False, builds_pending=0,
+                              builds_failed=0, builds_succeeded=0)
+    for master, count in waiting.values_list('master') \
+                                .annotate(Count('pk')).order_by():
+        loads[master] = loads.get(master, 0) + count
+    return loads
@@ -0,0 +1,70 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Lets the views wake up "sync_trybot_status --daemon" as soon as a pull request
+needs to be synced, instead of having it wait for its next poll.
+
+Notifications are empty UDP datagrams sent to TRYBOT_SYNC_NOTIFY_ADDRESS on
+the local machine. Sending one never blocks, and nothing happens if the daemon
+is not running, so the views do not depend on it.
+"""
+
+import errno
+import select
+import socket
+import time
+
+from django.conf import settings
+
+
+def notify_sync_needed():
+    """
+    Tells the sync daemon that at least one PullRequest has needs_sync=True.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto('', settings.TRYBOT_SYNC_NOTIFY_ADDRESS)
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+
+
+def listen():
+    """
+    Returns a socket that receives the notifications sent by
+    notify_sync_needed().
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(settings.TRYBOT_SYNC_NOTIFY_ADDRESS)
+    sock.setblocking(0)
+    return sock
+
+
+def wait_for_notification(sock, timeout):
+    """
+    Waits up to |timeout| seconds for a notification on |sock|. Once one
+    arrives, keeps collecting notifications for TRYBOT_SYNC_DEBOUNCE seconds
+    so that a burst of Buildbot events results in a single sync.
+    Returns whether any notification was received.
+    """
+    readable, _, _ = select.select([sock], [], [], timeout)
+    if not readable:
+        return False
+    _drain(sock)
+    time.sleep(settings.TRYBOT_SYNC_DEBOUNCE)
+    _drain(sock)
+    return True
+
+
+def _drain(sock):
+    while True:
+        try:
+            sock.recv(1)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
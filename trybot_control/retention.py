@@ -0,0 +1,156 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Retention of the pull requests and builds the trybot has finished with.
+
+Once a pull request has finished building and its final status has been sent
+to GitHub (or a newer head has been pushed), it is moved to the
+ArchivedPullRequest table: a single row summarizing the pull request, with its
+builds stored as JSON. The history of each pull request can still be queried,
+while the PullRequest and TrybotBuild tables only hold the ones being worked
+on. Pull requests that have not changed for TRYBOT_ARCHIVE_STALE_AFTER_DAYS
+are archived as they are, as Buildbot is not going to finish them anymore.
+
+Pull requests are archived in chunks of TRYBOT_ARCHIVE_CHUNK_SIZE, each in its
+own transaction. A chunk takes a fixed number of queries: the columns needed
+are read with values() instead of loading model instances, and only the
+primary keys of the pull requests are read to delete them, along with their
+builds. The cost of cleaning up thus grows linearly with the backlog, and no
+transaction lasts longer than a chunk.
+
+Archived pull requests older than TRYBOT_ARCHIVE_MAX_AGE_DAYS are deleted in
+chunks as well.
+"""
+
+import datetime
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from github_webhooks import metrics
+from trybot_control.models import ArchivedPullRequest, PullRequest
+from trybot_control.models import TrybotBuild, FINISHED_STATUSES
+from trybot_control.models import STATUS_PENDING
+
+
+# PullRequest fields copied to ArchivedPullRequest.
+_ARCHIVED_FIELDS = ('number', 'head_sha', 'base_repo_path', 'head_repo_path',
+                    'status', 'superseded', 'master', 'synced_at')
+
+_retained = metrics.counter(
+    'trybot_retention_pull_requests_total',
+    'Pull requests moved to the archive ("archive") or deleted from it '
+    '("purge").',
+    ('operation',))
+
+
+def finished_pull_requests():
+    """
+    Returns the pull requests the trybot does not need anymore. Superseded
+    pull requests are not synced, so they are done as soon as they have
+    finished building.
+    """
+    return PullRequest.objects.filter(status__in=FINISHED_STATUSES) \
+                              .filter(Q(needs_sync=False) | Q(superseded=True))
+
+
+def stale_pull_requests(now=None):
+    """
+    Returns the pull requests that have not finished building, but have not
+    been synced or changed for TRYBOT_ARCHIVE_STALE_AFTER_DAYS (none if it is
+    None).
+    """
+    days = settings.TRYBOT_ARCHIVE_STALE_AFTER_DAYS
+    if days is None:
+        return PullRequest.objects.none()
+    if now is None:
+        now = timezone.now()
+    cutoff = now - datetime.timedelta(days=days)
+    return PullRequest.objects.filter(status=STATUS_PENDING) \
+        .filter(Q(needs_sync_since__lt=cutoff) | Q(needs_sync_since=None)) \
+        .filter(Q(synced_at__lt=cutoff) | Q(synced_at=None))
+
+
+def archive_finished_pull_requests(chunk_size=None, now=None):
+    """
+    Moves all finished and stale pull requests and their builds to the
+    archive, |chunk_size| (TRYBOT_ARCHIVE_CHUNK_SIZE by default) at a time.
+    Returns the number of pull requests archived.
+    """
+    if chunk_size is None:
+        chunk_size = settings.TRYBOT_ARCHIVE_CHUNK_SIZE
+    if now is None:
+        now = timezone.now()
+    total = 0
+    # Stale pull requests are looked for separately, so that the query for
+    # finished ones can still use the index on status.
+    for pull_requests in (finished_pull_requests(), stale_pull_requests(now)):
+        while True:
+            archived = _archive_chunk(pull_requests, chunk_size, now)
+            total += archived
+            if archived < chunk_size:
+                break
+    return total
+
+
+def _archive_chunk(pull_requests, chunk_size, now):
+    with transaction.atomic():
+        rows = list(pull_requests.order_by('pk')
+                    .values('id', *_ARCHIVED_FIELDS)[:chunk_size])
+        if not rows:
+            return 0
+        pks = [row.pop('id') for row in rows]
+
+        builds = dict((pk, []) for pk in pks)
+        for pk, builder_name, build_number, status in \
+                TrybotBuild.objects.filter(pull_request__in=pks) \
+                                   .order_by('pk').values_list(
+                    'pull_request', 'builder_name', 'build_number', 'status'):
+            builds[pk].append([builder_name, build_number, status])
+
+        ArchivedPullRequest.objects.bulk_create([
+            ArchivedPullRequest(archived_at=now,
+                                builds=json.dumps(builds[pk],
+                                                  separators=(',', ':')),
+                                **row)
+            for pk, row in zip(pks, rows)])
+
+        # The builds are deleted along with the pull requests.
+        PullRequest.objects.filter(pk__in=pks).only('pk').delete()
+    _retained.inc(len(pks), operation='archive')
+    return len(pks)
+
+
+def purge_archive(max_age_days=None, chunk_size=None, now=None):
+    """
+    Deletes the pull requests archived more than |max_age_days| ago
+    (TRYBOT_ARCHIVE_MAX_AGE_DAYS by default; nothing is deleted if it is
+    None), |chunk_size| at a time. Returns the number of pull requests
+    deleted.
+    """
+    if max_age_days is None:
+        max_age_days = settings.TRYBOT_ARCHIVE_MAX_AGE_DAYS
+        if max_age_days is None:
+            return 0
+    if chunk_size is None:
+        chunk_size = settings.TRYBOT_ARCHIVE_CHUNK_SIZE
+    if now is None:
+        now = timezone.now()
+    expired = ArchivedPullRequest.objects.filter(
+        archived_at__lt=now - datetime.timedelta(days=max_age_days))
+
+    total = 0
+    while True:
+        pks = list(expired.order_by('pk')
+                   .values_list('pk', flat=True)[:chunk_size])
+        if pks:
+            ArchivedPullRequest.objects.filter(pk__in=pks).delete()
+            _retained.inc(len(pks), operation='purge')
+            total += len(pks)
+        if len(pks) < chunk_size:
+            return total
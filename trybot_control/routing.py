@@ -0,0 +1,96 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Routing of pull requests to the Buildbot builders that test them.
+
+TRYBOT_ROUTES maps base repositories and target branches (shell-style globs)
+to the builders that test the pull requests sent to them. The table is
+compiled the first time it is used, and the route found for each
+(repository, branch) pair is remembered, so looking one up is usually a
+dictionary access. Pull requests without a route are ignored before anything
+is sent to GitHub or Buildbot.
+"""
+
+import collections
+import fnmatch
+import re
+import threading
+
+from django.conf import settings
+
+
+# Number of (repository, branch) pairs whose route is remembered.
+_MAX_CACHED_ROUTES = 10000
+
+# |builders| is a tuple of builder names, or None to let Buildbot pick them.
+# |masters| is a tuple of master names, or None to use any master.
+Route = collections.namedtuple('Route', ('builders', 'masters'))
+
+_NOT_CACHED = object()
+
+
+class RoutingTable(object):
+    """
+    Finds the Route of a pull request in |routes|, a list of (repository
+    glob, branch glob, options) tuples (see TRYBOT_ROUTES).
+    """
+    def __init__(self, routes):
+        self.entries = []
+        for repository, branch, options in routes:
+            builders = options.get('builders')
+            masters = options.get('masters')
+            route = Route(tuple(builders) if builders is not None else None,
+                          tuple(masters) if masters is not None else None)
+            self.entries.append((re.compile(fnmatch.translate(repository)),
+                                 re.compile(fnmatch.translate(branch)),
+                                 route))
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def route(self, repository, branch):
+        """
+        Returns the Route for pull requests to |branch| of |repository| (a
+        full name such as "crosswalk-project/crosswalk"), or None if they
+        should not be tested.
+        """
+        key = (repository, branch)
+        # Reading a dictionary is atomic, so no lock is needed here.
+        route = self.cache.get(key, _NOT_CACHED)
+        if route is not _NOT_CACHED:
+            return route
+
+        route = None
+        for repository_regexp, branch_regexp, candidate in self.entries:
+            if repository_regexp.match(repository) and \
+               branch_regexp.match(branch):
+                route = candidate
+                break
+        if route is not None and route.builders == ():
+            route = None
+
+        with self.lock:
+            if len(self.cache) < _MAX_CACHED_ROUTES:
+                self.cache[key] = route
+        return route
+
+
+# Cache for routing_table(): a (TRYBOT_ROUTES, RoutingTable) tuple.
+_routing_table_cache = (None, None)
+_routing_table_lock = threading.Lock()
+
+
+def routing_table():
+    """
+    Returns the RoutingTable built from TRYBOT_ROUTES, building it again only
+    if the setting has changed.
+    """
+    global _routing_table_cache
+    routes = settings.TRYBOT_ROUTES
+    with _routing_table_lock:
+        cached_routes, table = _routing_table_cache
+        if cached_routes is not routes:
+            table = RoutingTable(routes)
+            _routing_table_cache = (routes, table)
+        return table
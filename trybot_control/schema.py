@@ -0,0 +1,222 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Upgrade of the trybot_control tables of existing databases.
+
+syncdb creates the tables of new models, but never changes existing ones, so
+the columns and indexes added to PullRequest and TrybotBuild since their
+tables were created have to be added separately. upgrade() compares the
+tables with the models and only adds what is missing, so it can be run any
+number of times.
+
+Columns are added with the default of their field, so that existing rows get
+a valid value. Indexes are the ones syncdb would create for the models,
+including those in the SQL files in sql/.
+
+Builds used to be unique by builder name and build number, and are now unique
+in each master. The old constraint is dropped, except in SQLite, which cannot
+drop it: the table is rebuilt instead.
+"""
+
+import re
+
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from trybot_control.models import PullRequest, TrybotBuild
+
+
+_UPGRADED_MODELS = (PullRequest, TrybotBuild)
+
+_INDEX_NAME_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(\S+)', re.I)
+
+_OLD_BUILD_KEY = set(['builder_name', 'build_number'])
+_BUILD_KEY = set(['master', 'builder_name', 'build_number'])
+
+
+def upgrade(dry_run=False):
+    """
+    Adds the missing columns and indexes to the tables of
+    _UPGRADED_MODELS. Returns the list of SQL statements that were run (or
+    would be, if |dry_run| is set).
+    """
+    cursor = connection.cursor()
+    statements = []
+    added_columns = set()
+    for model in _UPGRADED_MODELS:
+        for field, sql in _missing_columns(cursor, model):
+            statements.append(sql)
+            added_columns.add((model, field.name))
+    build_key_statements, rebuilt = _build_key(cursor)
+    statements.extend(build_key_statements)
+    statements.extend(_missing_indexes(cursor, rebuilt))
+    if dry_run:
+        return statements
+
+    with transaction.atomic():
+        for sql in statements:
+            cursor.execute(sql)
+        if (PullRequest, 'needs_sync_since') in added_columns:
+            _backfill_needs_sync_since()
+    return statements
+
+
+def _missing_columns(cursor, model):
+    """
+    Yields (field, ALTER TABLE statement) tuples for the fields of |model|
+    whose column is not in its table.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    existing = set(column.name for column in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table))
+    for field in model._meta.local_fields:
+        if field.column in existing:
+            continue
+        definition = '%s %s' % (qn(field.column),
+                                field.db_type(connection=connection))
+        if field.null:
+            definition += ' NULL'
+        else:
+            definition += ' NOT NULL DEFAULT %s' % \
+                          _literal(field.get_default())
+        yield field, 'ALTER TABLE %s ADD COLUMN %s' % (qn(table), definition)
+
+
+def _literal(value):
+    """
+    Returns |value| (a boolean, integer or string) as an SQL literal.
+    """
+    if isinstance(value, bool):
+        if connection.vendor == 'postgresql':
+            return 'true' if value else 'false'
+        return '1' if value else '0'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return "'%s'" % value.replace("'", "''")
+
+
+def _build_key(cursor):
+    """
+    Returns the statements replacing the old unique constraint of TrybotBuild
+    with the current one, and the models whose table they rebuild (and thus
+    have no indexes afterwards).
+    """
+    qn = connection.ops.quote_name
+    table = TrybotBuild._meta.db_table
+    indexes = table_indexes(cursor, table)
+    old = [name for name, (unique, columns) in indexes.iteritems()
+           if unique and columns == _OLD_BUILD_KEY]
+    if connection.vendor == 'sqlite' and old:
+        # The constraint is part of the table definition.
+        return _rebuild_table_sql(TrybotBuild), [TrybotBuild]
+
+    statements = []
+    for name in old:
+        if connection.vendor == 'postgresql':
+            statements.append('ALTER TABLE %s DROP CONSTRAINT %s' %
+                              (qn(table), qn(name)))
+        else:
+            statements.append('ALTER TABLE %s DROP INDEX %s' %
+                              (qn(table), qn(name)))
+    if not any(unique and columns == _BUILD_KEY
+               for unique, columns in indexes.itervalues()):
+        statements.append(
+            'CREATE UNIQUE INDEX %s ON %s (%s, %s, %s)' %
+            (qn('%s_master_build' % table), qn(table), qn('master'),
+             qn('builder_name'), qn('build_number')))
+    return statements, []
+
+
+def _rebuild_table_sql(model):
+    """
+    Returns the statements creating the table of |model| again as syncdb
+    would, and copying its rows over. The table must already have all the
+    columns of |model|.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    new_table = '%s__new' % table
+    statements, _ = connection.creation.sql_create_model(
+        model, no_style(), known_models=set(_UPGRADED_MODELS))
+    create_sql = statements[0].rstrip('; \n')
+    columns = ', '.join(qn(f.column) for f in model._meta.local_fields)
+    return [create_sql.replace(qn(table), qn(new_table), 1),
+            'INSERT INTO %s (%s) SELECT %s FROM %s' %
+            (qn(new_table), columns, columns, qn(table)),
+            'DROP TABLE %s' % qn(table),
+            'ALTER TABLE %s RENAME TO %s' % (qn(new_table), qn(table))]
+
+
+def _missing_indexes(cursor, rebuilt=()):
+    """
+    Returns the CREATE INDEX statements syncdb would run for
+    _UPGRADED_MODELS whose index does not exist. The tables of the models in
+    |rebuilt| are assumed to have no indexes.
+    """
+    statements = []
+    for model in _UPGRADED_MODELS:
+        existing = set()
+        if model not in rebuilt:
+            existing = set(name.lower() for name in
+                           table_indexes(cursor, model._meta.db_table))
+        for sql in (connection.creation.sql_indexes_for_model(model,
+                                                              no_style()) +
+                    custom_sql_for_model(model, no_style(), connection)):
+            sql = sql.strip().rstrip(';')
+            match = _INDEX_NAME_RE.match(sql)
+            if match and match.group(1).strip('"`').lower() not in existing:
+                statements.append(sql)
+    return statements
+
+
+def table_indexes(cursor, table):
+    """
+    Returns a dictionary mapping the names of the indexes of |table| to
+    (unique, set of column names) tuples.
+    """
+    qn = connection.ops.quote_name
+    indexes = {}
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % qn(table))
+        for row in cursor.fetchall():
+            name, unique = row[1], bool(row[2])
+            cursor.execute('PRAGMA index_info(%s)' % qn(name))
+            indexes[name] = (unique, set(r[2] for r in cursor.fetchall()))
+    elif connection.vendor == 'postgresql':
+        cursor.execute(
+            'SELECT c.relname, i.indisunique, a.attname '
+            'FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_class t ON t.oid = i.indrelid '
+            'JOIN pg_attribute a ON a.attrelid = t.oid '
+            '     AND a.attnum = ANY(i.indkey) '
+            'WHERE t.relname = %s', [table])
+        for name, unique, column in cursor.fetchall():
+            indexes.setdefault(name, (unique, set()))[1].add(column)
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % qn(table))
+        for row in cursor.fetchall():
+            # Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+            indexes.setdefault(row[2], (not row[1], set()))[1].add(row[4])
+    else:
+        raise NotImplementedError('Indexes of %s databases cannot be listed.'
+                                  % connection.vendor)
+    return indexes
+
+
+def _backfill_needs_sync_since():
+    """
+    Sets needs_sync_since on the pull requests that existed before the
+    column was added: when they were last synced, or now if they never were
+    (their creation time is not known).
+    """
+    missing = PullRequest.objects.filter(needs_sync_since=None)
+    missing.exclude(synced_at=None).update(needs_sync_since=F('synced_at'))
+    missing.update(needs_sync_since=timezone.now())
@@ -0,0 +1,6 @@
+-- Run by syncdb after creating the trybot_control_pullrequest table.
+-- MySQL does not support partial indexes, so these cover all rows.
+CREATE INDEX trybot_control_pullrequest_needs_sync
+    ON trybot_control_pullrequest (needs_sync);
+CREATE INDEX trybot_control_pullrequest_finished
+    ON trybot_control_pullrequest (status);
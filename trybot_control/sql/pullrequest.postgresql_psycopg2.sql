@@ -0,0 +1,7 @@
+-- Run by syncdb after creating the trybot_control_pullrequest table.
+-- Only the few pull requests that need to be synced or have finished building
+-- are indexed, so sync_trybot_status does not scan the whole history.
+CREATE INDEX trybot_control_pullrequest_needs_sync
+    ON trybot_control_pullrequest (id) WHERE needs_sync;
+CREATE INDEX trybot_control_pullrequest_finished
+    ON trybot_control_pullrequest (status) WHERE status <> 'pending';
@@ -0,0 +1,8 @@
+-- Run by syncdb after creating the trybot_control_pullrequest table.
+-- SQLite cannot use partial indexes for queries with bound parameters (which
+-- is what Django sends), so these cover all rows. Few rows need to be synced
+-- or have finished building at any time, so lookups stay cheap anyway.
+CREATE INDEX trybot_control_pullrequest_needs_sync
+    ON trybot_control_pullrequest (needs_sync);
+CREATE INDEX trybot_control_pullrequest_finished
+    ON trybot_control_pullrequest (status);
@@ -0,0 +1,487 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import datetime
+import json
+import mock
+import threading
+
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import connection, DatabaseError, IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from github_webhooks import github
+from trybot_control import metrics
+from trybot_control import notifications
+from trybot_control import retention
+from trybot_control import schema
+from trybot_control.models import *
+
+
+def create_pull_request(number, status=STATUS_PENDING):
+    pr = PullRequest.objects.create(
+        number=number,
+        head_sha='deadbeef',
+        base_repo_path='foo/bar',
+        head_repo_path='user/bar-fork',
+        comment_id=number * 10,
+        status=status
+    )
+    TrybotBuild.objects.create(
+        pull_request=pr,
+        builder_name='crosswalk-linux',
+        build_number=number,
+        status=STATUS_PENDING
+    )
+    return pr
+
+
+class FakeRequest(object):
+    """
+    Replacement for github.post() and github.patch() in tests that call them
+    from several threads, as mock.Mock does not record calls atomically.
+    """
+    def __init__(self, failing_urls=()):
+        self.failing_urls = failing_urls
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, **kwargs):
+        with self.lock:
+            self.urls.append(url)
+        if url in self.failing_urls:
+            raise IOError('Connection reset by peer')
+        return mock.Mock()
+
+
+class SyncTrybotStatusTestCase(TestCase):
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_sync(self, mock_patch, mock_post):
+        for number in xrange(1, 6):
+            create_pull_request(number)
+        finished = create_pull_request(6, status=STATUS_SUCCESS)
+        PullRequest.objects.filter(number=5).update(needs_sync=False)
+
+        stdout = StringIO()
+        call_command('sync_trybot_status', stdout=stdout)
+        self.assertEqual(mock_patch.call_count, 5)
+        self.assertEqual(mock_post.call_count, 5)
+        self.assertIn('Synced 5 pull requests (0 failed)', stdout.getvalue())
+
+        self.assertEqual(PullRequest.objects.filter(needs_sync=True).count(),
+                         0)
+        self.assertFalse(PullRequest.objects.filter(pk=finished.pk).exists())
+        self.assertEqual(PullRequest.objects.count(), 5)
+
+    def test_sync_workers(self):
+        for number in xrange(1, 11):
+            create_pull_request(number)
+
+        fake_patch = FakeRequest()
+        fake_post = FakeRequest()
+        with mock.patch('github_webhooks.github.patch', new=fake_patch), \
+             mock.patch('github_webhooks.github.post', new=fake_post):
+            call_command('sync_trybot_status', workers=4, stdout=StringIO())
+        self.assertEqual(len(fake_post.urls), 10)
+        self.assertItemsEqual(
+            fake_patch.urls,
+            ['https://api.github.com/repos/foo/bar/issues/comments/%d' % n
+             for n in xrange(10, 110, 10)])
+        self.assertEqual(PullRequest.objects.filter(needs_sync=True).count(),
+                         0)
+
+    def test_sync_error(self):
+        for number in xrange(1, 4):
+            create_pull_request(number)
+        create_pull_request(4, status=STATUS_FAILURE)
+
+        fake_patch = FakeRequest(failing_urls=(
+            'https://api.github.com/repos/foo/bar/issues/comments/20',
+            'https://api.github.com/repos/foo/bar/issues/comments/40'))
+        stdout = StringIO()
+        with mock.patch('github_webhooks.github.patch', new=fake_patch), \
+             mock.patch('github_webhooks.github.post', new=FakeRequest()):
+            call_command('sync_trybot_status', workers=2, stdout=stdout)
+        self.assertIn('Synced 4 pull requests (2 failed)', stdout.getvalue())
+
+        # Pull requests that could not be synced are kept for the next run,
+        # even if they have already finished building.
+        self.assertItemsEqual(
+            PullRequest.objects.filter(needs_sync=True).values_list(
+                'number', flat=True),
+            [2, 4])
+        self.assertEqual(PullRequest.objects.count(), 4)
+
+    def test_sync_lag(self):
+        _, lag = metrics.collect_metrics()
+        self.assertEqual(lag.samples()[0][2], 0)
+
+        # Pull requests that have never been synced have been waiting since
+        # they were created.
+        create_pull_request(1)
+        waiting = create_pull_request(2)
+        PullRequest.objects.filter(pk=waiting.pk).update(
+            needs_sync_since=timezone.now() - datetime.timedelta(hours=2))
+        _, lag = metrics.collect_metrics()
+        self.assertGreaterEqual(lag.samples()[0][2], 2 * 3600)
+        self.assertLess(lag.samples()[0][2], 3 * 3600)
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_sync_queries(self, mock_patch, mock_post):
+        for number in xrange(1, 11):
+            create_pull_request(number)
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 10)
+        # The builds of all pull requests are read at once.
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'SELECT "trybot_control_trybotbuild"' in
+                              q['sql']]), 1)
+
+    @mock.patch('github_webhooks.github.post')
+    def test_sync_concurrent_event(self, mock_post):
+        pr = create_pull_request(1)
+
+        def buildset_finished(url, **kwargs):
+            # Buildbot reports the end of the build while the comment is
+            # being sent.
+            PullRequest.objects.filter(pk=pr.pk).update(
+                status=STATUS_SUCCESS, needs_sync=True)
+            return mock.Mock()
+
+        with mock.patch('github_webhooks.github.patch',
+                        side_effect=buildset_finished):
+            call_command('sync_trybot_status', stdout=StringIO())
+        # The final status is sent next time instead of being archived.
+        pr = PullRequest.objects.get(pk=pr.pk)
+        self.assertTrue(pr.needs_sync)
+        self.assertEqual(pr.synced_status, STATUS_PENDING)
+
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(PullRequest.objects.count(), 0)
+        self.assertEqual(ArchivedPullRequest.objects.get().status,
+                         STATUS_SUCCESS)
+        self.assertIn('"state": "success"', mock_post.call_args[1]['data'])
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_sync_superseded(self, mock_patch, mock_post):
+        create_pull_request(1)
+        create_pull_request(2)
+        create_pull_request(3, status=STATUS_FAILURE)
+        PullRequest.objects.filter(number__in=(2, 3)).update(superseded=True)
+
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_patch.call_count, 1)
+        # Superseded pull requests are deleted once they are finished, even
+        # if they were flagged for syncing.
+        self.assertItemsEqual(
+            PullRequest.objects.values_list('number', flat=True), [1, 2])
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    @override_settings(TRYBOT_COMMENT_UPDATE_INTERVAL=60)
+    def test_sync_coalescing(self, mock_patch, mock_post):
+        pr = create_pull_request(1)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 1)
+        pr = PullRequest.objects.get(pk=pr.pk)
+        self.assertIsNotNone(pr.synced_at)
+        self.assertEqual(len(pr.comment_sha1), 40)
+
+        # The comment was updated too recently, so wait for more changes.
+        TrybotBuild.objects.create(pull_request=pr,
+                                   builder_name='crosswalk-windows',
+                                   build_number=7)
+        PullRequest.objects.filter(pk=pr.pk).update(needs_sync=True)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 1)
+        self.assertTrue(PullRequest.objects.get(pk=pr.pk).needs_sync)
+
+        PullRequest.objects.filter(pk=pr.pk).update(
+            synced_at=timezone.now() - datetime.timedelta(seconds=61))
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 2)
+        self.assertFalse(PullRequest.objects.get(pk=pr.pk).needs_sync)
+        # The status is still "pending", so it is not sent again.
+        self.assertEqual(mock_post.call_count, 1)
+
+        # Nothing changed, so the comment is not touched. Finished pull
+        # requests are never postponed.
+        PullRequest.objects.filter(pk=pr.pk).update(needs_sync=True,
+                                                    status=STATUS_SUCCESS)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 2)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(PullRequest.objects.count(), 0)
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    @override_settings(TRYBOT_COMMENT_UPDATE_INTERVAL=60)
+    def test_sync_early_failure(self, mock_patch, mock_post):
+        pr = create_pull_request(1)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_post.call_count, 1)
+
+        # A failed build is reported right away, even though the comment has
+        # been updated recently and other builds are still running.
+        PullRequest.objects.filter(pk=pr.pk).update(needs_sync=True,
+                                                    builds_failed=1)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(json.loads(mock_post.call_args[1]['data'])['state'],
+                         STATUS_FAILURE)
+        pr = PullRequest.objects.get(pk=pr.pk)
+        self.assertEqual(pr.synced_status, STATUS_FAILURE)
+        self.assertEqual(pr.status, STATUS_PENDING)
+
+        # Further changes are postponed as usual.
+        PullRequest.objects.filter(pk=pr.pk).update(needs_sync=True,
+                                                    builds_failed=2)
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertTrue(PullRequest.objects.get(pk=pr.pk).needs_sync)
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_sync_rate_limited(self, mock_patch, mock_post):
+        create_pull_request(1, status=STATUS_SUCCESS)
+        mock_patch.side_effect = github.RateLimitExceeded(0)
+
+        call_command('sync_trybot_status', stdout=StringIO())
+        # The status is sent before the comment.
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_patch.call_count, 1)
+        pr = PullRequest.objects.get()
+        self.assertTrue(pr.needs_sync)
+        self.assertEqual(pr.comment_sha1, '')
+
+        mock_patch.side_effect = None
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertEqual(mock_patch.call_count, 2)
+        self.assertEqual(PullRequest.objects.count(), 0)
+
+
+class RetentionTestCase(TestCase):
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_sync_archives(self, mock_patch, mock_post):
+        create_pull_request(1)
+        finished = create_pull_request(2, status=STATUS_SUCCESS)
+        TrybotBuild.objects.create(pull_request=finished,
+                                   builder_name='crosswalk-android',
+                                   build_number=7, status=STATUS_FAILURE)
+
+        call_command('sync_trybot_status', stdout=StringIO())
+        self.assertItemsEqual(
+            PullRequest.objects.values_list('number', flat=True), [1])
+        self.assertEqual(TrybotBuild.objects.count(), 1)
+
+        archived = ArchivedPullRequest.objects.get()
+        self.assertEqual(archived.number, 2)
+        self.assertEqual(archived.base_repo_path, 'foo/bar')
+        self.assertEqual(archived.status, STATUS_SUCCESS)
+        self.assertFalse(archived.superseded)
+        self.assertIsNotNone(archived.synced_at)
+        self.assertEqual(json.loads(archived.builds),
+                         [['crosswalk-linux', 2, STATUS_PENDING],
+                          ['crosswalk-android', 7, STATUS_FAILURE]])
+
+    def test_archive_chunks(self):
+        for number in xrange(1, 8):
+            create_pull_request(number, status=STATUS_FAILURE)
+        PullRequest.objects.update(needs_sync=False)
+        create_pull_request(8)
+        PullRequest.objects.filter(number=7).update(needs_sync=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                retention.archive_finished_pull_requests(chunk_size=2), 6)
+        # Three chunks with one DELETE per table, without reading whole rows.
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'DELETE FROM' in q['sql']]), 6)
+        self.assertFalse([q for q in queries.captured_queries
+                          if '"trybot_control_pullrequest"."comment_id"' in
+                          q['sql']])
+
+        self.assertItemsEqual(
+            ArchivedPullRequest.objects.values_list('number', flat=True),
+            xrange(1, 7))
+        self.assertItemsEqual(
+            PullRequest.objects.values_list('number', flat=True), [7, 8])
+        self.assertItemsEqual(
+            TrybotBuild.objects.values_list('build_number', flat=True),
+            [7, 8])
+
+    def test_archive_stale(self):
+        now = timezone.now()
+        old = now - datetime.timedelta(days=8)
+        create_pull_request(1)
+        PullRequest.objects.filter(number=1).update(needs_sync_since=old)
+        # Superseded before it was ever built.
+        create_pull_request(2)
+        PullRequest.objects.filter(number=2).update(
+            needs_sync_since=old, needs_sync=False, superseded=True)
+        # Synced recently.
+        create_pull_request(3)
+        PullRequest.objects.filter(number=3).update(
+            needs_sync_since=old, synced_at=now - datetime.timedelta(days=1))
+        create_pull_request(4)
+
+        with self.settings(TRYBOT_ARCHIVE_STALE_AFTER_DAYS=None):
+            self.assertEqual(
+                retention.archive_finished_pull_requests(now=now), 0)
+        with self.settings(TRYBOT_ARCHIVE_STALE_AFTER_DAYS=7):
+            self.assertEqual(
+                retention.archive_finished_pull_requests(now=now), 2)
+        self.assertItemsEqual(
+            ArchivedPullRequest.objects.values_list('number', 'status'),
+            [(1, STATUS_PENDING), (2, STATUS_PENDING)])
+        self.assertItemsEqual(
+            PullRequest.objects.values_list('number', flat=True), [3, 4])
+        self.assertItemsEqual(
+            TrybotBuild.objects.values_list('build_number', flat=True),
+            [3, 4])
+
+    def test_purge_archive(self):
+        now = timezone.now()
+        for days in (1, 10, 20, 30):
+            ArchivedPullRequest.objects.create(
+                number=days, head_sha='deadbeef', base_repo_path='foo/bar',
+                head_repo_path='user/bar-fork', status=STATUS_SUCCESS,
+                archived_at=now - datetime.timedelta(days=days), builds='[]')
+
+        # Archived pull requests are kept forever by default.
+        self.assertEqual(retention.purge_archive(now=now), 0)
+        with self.settings(TRYBOT_ARCHIVE_MAX_AGE_DAYS=15):
+            self.assertEqual(retention.purge_archive(chunk_size=1, now=now),
+                             2)
+        self.assertItemsEqual(
+            ArchivedPullRequest.objects.values_list('number', flat=True),
+            [1, 10])
+
+
+class SyncDaemonTestCase(TestCase):
+    @mock.patch('trybot_control.notifications.listen')
+    @mock.patch('trybot_control.notifications.wait_for_notification')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.patch')
+    def test_daemon(self, mock_patch, mock_post, mock_wait, mock_listen):
+        create_pull_request(1)
+
+        def wait(sock, timeout):
+            if mock_wait.call_count == 1:
+                # Buildbot reports something while the daemon is idle.
+                create_pull_request(2)
+                return True
+            raise KeyboardInterrupt()
+        mock_wait.side_effect = wait
+
+        call_command('sync_trybot_status', daemon=True, stdout=StringIO())
+        self.assertEqual(mock_wait.call_count, 2)
+        self.assertEqual(
+            [c[0][0] for c in mock_patch.call_args_list],
+            ['https://api.github.com/repos/foo/bar/issues/comments/10',
+             'https://api.github.com/repos/foo/bar/issues/comments/20'])
+        self.assertTrue(mock_listen.return_value.close.called)
+
+    @override_settings(TRYBOT_SYNC_NOTIFY_ADDRESS=('127.0.0.1', 0),
+                       TRYBOT_SYNC_DEBOUNCE=0)
+    def test_notifications(self):
+        sock = notifications.listen()
+        try:
+            self.assertFalse(notifications.wait_for_notification(sock, 0))
+
+            with self.settings(TRYBOT_SYNC_NOTIFY_ADDRESS=sock.getsockname()):
+                for i in xrange(3):
+                    notifications.notify_sync_needed()
+            self.assertTrue(notifications.wait_for_notification(sock, 5))
+
+            # All notifications are consumed at once.
+            self.assertFalse(notifications.wait_for_notification(sock, 0))
+        finally:
+            sock.close()
+
+    @override_settings(TRYBOT_SYNC_NOTIFY_ADDRESS=('127.0.0.1', 0))
+    def test_notify_without_daemon(self):
+        # Nobody is listening, which must not be an error.
+        notifications.notify_sync_needed()
+
+
+# The trybot_control tables as created by syncdb before any column or index
+# was added to them.
+_OLD_SCHEMA = (
+    'CREATE TABLE "trybot_control_pullrequest" ('
+    '"id" integer NOT NULL PRIMARY KEY, "number" integer NOT NULL, '
+    '"head_sha" varchar(40) NOT NULL, '
+    '"base_repo_path" varchar(256) NOT NULL, '
+    '"head_repo_path" varchar(256) NOT NULL, '
+    '"comment_id" integer NOT NULL, "status" varchar(7) NOT NULL, '
+    '"needs_sync" bool NOT NULL)',
+    'CREATE TABLE "trybot_control_trybotbuild" ('
+    '"id" integer NOT NULL PRIMARY KEY, '
+    '"pull_request_id" integer NOT NULL '
+    'REFERENCES "trybot_control_pullrequest" ("id"), '
+    '"builder_name" varchar(256) NOT NULL, '
+    '"build_number" integer NOT NULL, "status" varchar(7) NOT NULL, '
+    'UNIQUE ("builder_name", "build_number"))',
+)
+
+
+class UpgradeSchemaTestCase(TransactionTestCase):
+    def test_upgrade(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('The old schema is written for SQLite.')
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE "trybot_control_trybotbuild"')
+        cursor.execute('DROP TABLE "trybot_control_pullrequest"')
+        for sql in _OLD_SCHEMA:
+            cursor.execute(sql)
+        cursor.execute(
+            'INSERT INTO "trybot_control_pullrequest" VALUES '
+            '(1, 42, \'deadbeef\', \'foo/bar\', \'user/bar-fork\', 10, '
+            '\'success\', 1)')
+        cursor.execute(
+            'INSERT INTO "trybot_control_trybotbuild" VALUES '
+            '(1, 1, \'crosswalk-linux\', 7, \'success\')')
+
+        stdout = StringIO()
+        call_command('upgrade_trybot_schema', dry_run=True, stdout=stdout)
+        self.assertIn('ADD COLUMN "needs_sync_since" datetime NULL;',
+                      stdout.getvalue())
+        self.assertRaises(DatabaseError, create_pull_request, 2)
+
+        call_command('upgrade_trybot_schema', stdout=StringIO())
+        pr = PullRequest.objects.get()
+        self.assertEqual((pr.superseded, pr.builds_pending, pr.master),
+                         (False, 0, ''))
+        self.assertIsNotNone(pr.needs_sync_since)
+        self.assertEqual(TrybotBuild.objects.get().master, '')
+
+        # Build numbers are only unique in each master.
+        create_pull_request(2)
+        TrybotBuild.objects.create(pull_request=pr, master='b',
+                                   builder_name='crosswalk-linux',
+                                   build_number=7)
+        self.assertRaises(IntegrityError, TrybotBuild.objects.create,
+                          pull_request=pr, master='b',
+                          builder_name='crosswalk-linux', build_number=7)
+        indexes = schema.table_indexes(cursor, 'trybot_control_pullrequest')
+        self.assertIn('trybot_control_pullrequest_needs_sync', indexes)
+        self.assertIn(set(['base_repo_path', 'number', 'head_sha']),
+                      [columns for _, columns in indexes.itervalues()])
+
+        # Nothing is left to do.
+        stdout = StringIO()
+        call_command('upgrade_trybot_schema', stdout=stdout)
+        self.assertEqual(stdout.getvalue(),
+                         'The trybot_control tables are up to date.\n')
@@ -7,11 +7,12 @@ import mock
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from github_webhooks import github
 from trybot_control.models import *
 
 
 class PullRequestTestCase(TestCase):
-    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
     def test_report_build_status(self, mock_request):
         pr = PullRequest.objects.create(
             number=42,
@@ -32,10 +33,10 @@ class PullRequestTestCase(TestCase):
         self.assertEqual(mock_request.call_count, 1)
         self.assertEqual(
             mock_request.call_args,
-            mock.call(url, data=json.dumps(data), auth=mock.ANY)
+            mock.call(url, operation='set_status', data=json.dumps(data))
         )
 
-    @mock.patch('requests.patch')
+    @mock.patch('github_webhooks.github.patch')
     @override_settings(TRYBOT_BASE_URL='http://tryb.ot')
     def test_report_builder_statuses(self, mock_request):
         pr = PullRequest.objects.create(
@@ -73,7 +74,8 @@ Crosswalk Tizen | [**SUCCESS** :green_heart:](http://tryb.ot/builders/Crosswalk%
 
         self.assertEqual(mock_request.call_count, 1)
         self.assertEqual(mock_request.call_args,
-                         mock.call(url, auth=mock.ANY,
+                         mock.call(url, priority=github.PRIORITY_LOW,
+                                   operation='edit_comment',
                                    data=json.dumps({'body': message})))
 
         TrybotBuild.objects.create(
@@ -88,5 +90,56 @@ Crosswalk Tizen | [**SUCCESS** :green_heart:](http://tryb.ot/builders/Crosswalk%
 
         self.assertEqual(mock_request.call_count, 2)
         self.assertEqual(mock_request.call_args,
-                         mock.call(url, auth=mock.ANY,
+                         mock.call(url, priority=github.PRIORITY_LOW,
+                                   operation='edit_comment',
                                    data=json.dumps({'body': message})))
+
+    @mock.patch('github_webhooks.github.patch')
+    def test_report_builder_statuses_unchanged(self, mock_request):
+        pr = PullRequest.objects.create(
+            number=42,
+            head_sha='deadbeef',
+            base_repo_path='user/repo',
+            head_repo_path='another_user/bar-fork',
+            comment_id=1234
+        )
+        build = TrybotBuild.objects.create(
+            pull_request=pr,
+            builder_name='crosswalk-linux',
+            build_number=42,
+            status=STATUS_PENDING
+        )
+
+        self.assertTrue(pr.report_builder_statuses())
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(len(pr.comment_sha1), 40)
+
+        # Nothing has changed, so there is no need to update the comment.
+        self.assertFalse(pr.report_builder_statuses())
+        self.assertEqual(mock_request.call_count, 1)
+
+        build.status = STATUS_SUCCESS
+        build.save()
+        self.assertTrue(pr.report_builder_statuses())
+        self.assertEqual(mock_request.call_count, 2)
+
+    @override_settings(TRYBOT_BASE_URL='http://tryb.ot')
+    def test_render_builder_statuses(self):
+        builds = [('crosswalk-linux', 41, STATUS_FAILURE),
+                  ('crosswalk-linux', 42, STATUS_PENDING),
+                  ('Crosswalk Tizen', 34, STATUS_SUCCESS)]
+        message = render_builder_statuses('user/repo', 'deadbeef', builds)
+        self.assertEqual(message, '''Testing patch series with user/repo@deadbeef as its head.
+
+Bot | Status
+--- | ------
+crosswalk-linux | [**FAILED** :broken_heart:](http://tryb.ot/builders/crosswalk-linux/builds/41)
+crosswalk-linux | [In Progress](http://tryb.ot/builders/crosswalk-linux/builds/42)
+Crosswalk Tizen | [**SUCCESS** :green_heart:](http://tryb.ot/builders/Crosswalk%20Tizen/builds/34)
+''')
+
+        with override_settings(TRYBOT_BASE_URL='http://other'):
+            message = render_builder_statuses('user/repo', 'deadbeef',
+                                              builds[2:])
+        self.assertIn('(http://other/builders/Crosswalk%20Tizen/builds/34)',
+                      message)
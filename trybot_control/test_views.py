@@ -2,24 +2,128 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
+import gzip
 import hashlib
 import json
 import mock
+import requests
+import StringIO
+import urlparse
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils import timezone
 
+from github_webhooks.deliveries import reset_recent_keys
+from github_webhooks.dispatch import ConsumerFailed
+from github_webhooks.jobs import process_jobs
+from github_webhooks.models import Job, JOB_QUEUED
 from github_webhooks.test.utils import GitHubEventClient
 from github_webhooks.test.utils import mock_pull_request_payload
+from trybot_control.handlers import stop_builds
+from trybot_control.masters import reset_health_checker
 from trybot_control.models import *
 
 
+def mock_patch_response(chunks=(), status_code=200):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.iter_content.return_value = list(chunks)
+    return response
+
+
+def sent_form(mock_requests_post):
+    """
+    Returns the form posted to Buildbot with the mocked requests.post(), as
+    a dictionary of strings.
+    """
+    kwargs = mock_requests_post.call_args[1]
+    body = ''.join(kwargs['data'])
+    if kwargs['headers'].get('Content-Encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+    return dict((name, values[0]) for name, values in
+                urlparse.parse_qs(body, keep_blank_values=True).iteritems())
+
+
 class BuildbotEventTest(TestCase):
     def setUp(self):
         self.client = Client()
         self.url = reverse('trybot_control.views.buildbot_event')
 
+    @mock.patch('trybot_control.views.notify_sync_needed')
+    def test_notify_sync_needed(self, mock_notify):
+        PullRequest.objects.create(
+            pk=3,
+            number=97,
+            head_sha=hashlib.sha1('somehash').hexdigest(),
+            base_repo_path='crosswalk-project/crosswalk',
+            head_repo_path='user/crosswalk-fork',
+            comment_id=1234)
+
+        packets = [{
+            'event': 'buildStarted',
+            'payload': {
+                'build': {
+                    'builderName': 'crosswalk-linux',
+                    'number': 42,
+                    'properties': [('issue', 97, '')],
+                }
+            }
+        }]
+        self.client.post(self.url, {'packets': json.dumps(packets)})
+        self.assertEqual(mock_notify.call_count, 0)
+
+        packets[0]['payload']['build']['properties'] = [('issue', 3, '')]
+        self.client.post(self.url, {'packets': json.dumps(packets)})
+        self.assertEqual(mock_notify.call_count, 1)
+
+    @mock.patch('trybot_control.views.notify_sync_needed')
+    @override_settings(TRYBOT_STOP_SUPERSEDED_BUILDS=True)
+    def test_superseded(self, mock_notify):
+        PullRequest.objects.create(
+            pk=3,
+            number=97,
+            head_sha=hashlib.sha1('somehash').hexdigest(),
+            base_repo_path='crosswalk-project/crosswalk',
+            head_repo_path='user/crosswalk-fork',
+            comment_id=1234,
+            needs_sync=False,
+            superseded=True)
+
+        packets = [{
+            'event': 'buildStarted',
+            'payload': {
+                'build': {
+                    'builderName': 'crosswalk-linux',
+                    'number': 42,
+                    'properties': [('issue', 3, '')],
+                }
+            }
+        }, {
+            'event': 'buildsetFinished',
+            'payload': {
+                'build': {
+                    'properties': [('issue', 3, '')],
+                    'results': 2,
+                }
+            }
+        }]
+        response = self.client.post(self.url,
+                                    {'packets': json.dumps(packets)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_notify.call_count, 0)
+        self.assertEqual(TrybotBuild.objects.get().build_number, 42)
+        pr = PullRequest.objects.get(pk=3)
+        self.assertEqual(pr.status, STATUS_FAILURE)
+        self.assertFalse(pr.needs_sync)
+
+        # The build started after a newer head was pushed, so stop it.
+        self.assertEqual(json.loads(Job.objects.get().arguments),
+                         {'builds': [['', 'crosswalk-linux', 42]]})
+
     def test_buildStarted_event(self):
         PullRequest.objects.create(
             pk=3,
@@ -265,77 +369,388 @@ class BuildbotEventTest(TestCase):
         self.assertEqual(PullRequest.objects.count(), 0)
         self.assertEqual(TrybotBuild.objects.count(), 0)
 
+    def test_many_packets(self):
+        packets = []
+        for number in xrange(1, 6):
+            pr = PullRequest.objects.create(
+                number=number,
+                head_sha=hashlib.sha1(str(number)).hexdigest(),
+                base_repo_path='crosswalk-project/crosswalk',
+                head_repo_path='user/crosswalk-fork',
+                comment_id=number,
+                needs_sync=False)
+            for i in xrange(4):
+                TrybotBuild.objects.create(pull_request=pr,
+                                           builder_name='builder-%d' % i,
+                                           build_number=number)
+                packets.append({
+                    'event': 'buildFinished',
+                    'payload': {
+                        'build': {
+                            'builderName': 'builder-%d' % i,
+                            'number': number,
+                            'properties': [('issue', pr.pk, '')],
+                            'results': 2 if i == 3 else 0,
+                        }
+                    }
+                })
+            for i in xrange(5):
+                packets.append({
+                    'event': 'buildStarted',
+                    'payload': {
+                        'build': {
+                            'builderName': 'new-builder-%d' % i,
+                            'number': number,
+                            'properties': [('issue', pr.pk, '')],
+                        }
+                    }
+                })
+            packets.append({
+                'event': 'buildsetFinished',
+                'payload': {
+                    'build': {
+                        'properties': [('issue', pr.pk, '')],
+                        'results': 2,
+                    }
+                }
+            })
+
+        # The number of queries does not depend on the number of packets (the
+        # 50 packets here used to take 165 queries). There are 2 SELECTs, 1
+        # INSERT, 3 UPDATEs plus a SAVEPOINT and its RELEASE.
+        with self.assertNumQueries(8):
+            response = self.client.post(self.url,
+                                        {'packets': json.dumps(packets)})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(TrybotBuild.objects.count(), 45)
+        self.assertEqual(TrybotBuild.objects.filter(
+            status=STATUS_PENDING).count(), 25)
+        self.assertEqual(TrybotBuild.objects.filter(
+            status=STATUS_FAILURE).count(), 5)
+        self.assertEqual(TrybotBuild.objects.filter(
+            builder_name='new-builder-3', build_number=4).get()
+            .pull_request.number, 4)
+        self.assertEqual(PullRequest.objects.filter(
+            status=STATUS_FAILURE, needs_sync=True).count(), 5)
+
+    def test_build_counts(self):
+        pr = PullRequest.objects.create(
+            pk=3,
+            number=97,
+            head_sha=hashlib.sha1('somehash').hexdigest(),
+            base_repo_path='crosswalk-project/crosswalk',
+            head_repo_path='user/crosswalk-fork',
+            comment_id=1234,
+            needs_sync=False,
+            needs_sync_since=timezone.now() - datetime.timedelta(days=1))
+
+        def packet(event, number, results=None):
+            build = {
+                'builderName': 'crosswalk-linux',
+                'number': number,
+                'properties': [('issue', 3, '')],
+            }
+            if results is not None:
+                build['results'] = results
+            return {'event': event, 'payload': {'build': build}}
+
+        self.client.post(self.url, {'packets': json.dumps([
+            packet('buildStarted', 1), packet('buildStarted', 2),
+            packet('buildStarted', 3), packet('buildFinished', 1)])})
+        pr = PullRequest.objects.get(pk=3)
+        self.assertEqual((pr.builds_pending, pr.builds_failed,
+                          pr.builds_succeeded), (2, 0, 1))
+        self.assertEqual(pr.reported_status(), STATUS_PENDING)
+        needs_sync_since = pr.needs_sync_since
+        self.assertLess(timezone.now() - needs_sync_since,
+                        datetime.timedelta(hours=1))
+
+        self.client.post(self.url, {'packets': json.dumps([
+            packet('buildFinished', 2, results=2)])})
+        pr = PullRequest.objects.get(pk=3)
+        self.assertEqual((pr.builds_pending, pr.builds_failed,
+                          pr.builds_succeeded), (1, 1, 1))
+        self.assertEqual(pr.status, STATUS_PENDING)
+        self.assertEqual(pr.reported_status(), STATUS_FAILURE)
+        self.assertTrue(pr.needs_sync)
+        # The pull request has been waiting since the first change.
+        self.assertEqual(pr.needs_sync_since, needs_sync_since)
+
+        # Retried builds are still pending, and skipped ones did not fail.
+        self.client.post(self.url, {'packets': json.dumps([
+            packet('buildFinished', 3, results=5),
+            packet('buildStarted', 4), packet('buildFinished', 4, results=3)])})
+        pr = PullRequest.objects.get(pk=3)
+        self.assertEqual((pr.builds_pending, pr.builds_failed,
+                          pr.builds_succeeded), (1, 1, 2))
+        self.assertEqual(TrybotBuild.objects.get(build_number=3).status,
+                         STATUS_PENDING)
+
+    def test_build_started_and_finished_together(self):
+        pr = PullRequest.objects.create(
+            pk=3,
+            number=97,
+            head_sha=hashlib.sha1('somehash').hexdigest(),
+            base_repo_path='crosswalk-project/crosswalk',
+            head_repo_path='user/crosswalk-fork',
+            comment_id=1234,
+            needs_sync=False)
+
+        build = {
+            'builderName': 'crosswalk-linux',
+            'number': 42,
+            'properties': [('issue', 3, '')],
+        }
+        packets = [
+            {'event': 'buildStarted', 'payload': {'build': build}},
+            # Duplicate.
+            {'event': 'buildStarted', 'payload': {'build': build}},
+            {'event': 'buildFinished', 'payload': {'build': dict(build,
+                                                                 results=4)}},
+            # Never started.
+            {'event': 'buildFinished', 'payload': {'build': dict(build,
+                                                                 number=43)}},
+        ]
+        response = self.client.post(self.url, {'packets': json.dumps(packets)})
+        self.assertEqual(response.status_code, 200)
+        build = TrybotBuild.objects.get()
+        self.assertEqual(build.pull_request_id, pr.pk)
+        self.assertEqual(build.build_number, 42)
+        self.assertEqual(build.status, STATUS_FAILURE)
+        self.assertTrue(PullRequest.objects.get(pk=pr.pk).needs_sync)
+
+        # Starting the same build again later is ignored as well.
+        response = self.client.post(self.url, {'packets': json.dumps(
+            packets[:1])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TrybotBuild.objects.count(), 1)
+        self.assertEqual(TrybotBuild.objects.get().status, STATUS_FAILURE)
+
+    def test_builds_on_different_masters(self):
+        for pk, master in ((3, 'a'), (4, 'b')):
+            PullRequest.objects.create(
+                pk=pk,
+                number=97,
+                head_sha=hashlib.sha1('somehash%d' % pk).hexdigest(),
+                base_repo_path='crosswalk-project/crosswalk',
+                head_repo_path='user/crosswalk-fork',
+                comment_id=1234,
+                master=master)
+
+        # Build numbers are only unique in each master.
+        build = {'builderName': 'crosswalk-linux', 'number': 42}
+        packets = [
+            {'event': 'buildStarted', 'payload': {'build': dict(
+                build, properties=[('issue', 3, '')])}},
+            {'event': 'buildStarted', 'payload': {'build': dict(
+                build, properties=[('issue', 4, '')])}},
+        ]
+        response = self.client.post(self.url, {'packets': json.dumps(packets)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TrybotBuild.objects.count(), 2)
+
+        packets = [{'event': 'buildFinished', 'payload': {'build': dict(
+            build, properties=[('issue', 4, '')], results=0)}}]
+        response = self.client.post(self.url, {'packets': json.dumps(packets)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TrybotBuild.objects.get(master='a').status,
+                         STATUS_PENDING)
+        self.assertEqual(TrybotBuild.objects.get(master='b').status,
+                         STATUS_SUCCESS)
+
 
 class PullRequestTests(TestCase):
     def setUp(self):
+        reset_recent_keys()
+        reset_health_checker()
         self.client = GitHubEventClient()
         self.url = reverse('trybot_control.views.handle_pull_request')
 
     @mock.patch('requests.post')
-    @mock.patch('requests.get')
-    def test_trybot_payload(self, mock_requests_get, mock_requests_post):
-        get_response = mock.Mock()
-        get_response.status_code = 200
-        get_response.text = '+++ some/file\n--- some/file\n+ new line\n'
-        get_response.json.return_value = {'id': 3}
-        mock_requests_get.return_value = get_response
-
-        # One mock for each requests.post() call in the handler.
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    def test_trybot_payload(self, mock_github_get, mock_github_post,
+                            mock_requests_post):
+        mock_github_get.return_value = mock_patch_response(
+            ['+++ some/file\n--- some/file\n', '+ new line\n'])
+
         post_response_comment = mock.Mock()
         post_response_comment.json.return_value = {'id': 1234}
-        post_response_send_to_trybot = mock.Mock()
-
-        mock_requests_post.side_effects = (post_response_comment,
-                                           post_response_send_to_trybot)
+        mock_github_post.return_value = post_response_comment
 
         payload = mock_pull_request_payload()
         payload['pull_request']['base']['ref'] = 'crosswalk-4'
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 0)
-        self.assertEqual(mock_requests_get.call_count, 0)
+        self.assertEqual(mock_github_get.call_count, 0)
+        self.assertEqual(mock_github_post.call_count, 0)
         self.assertEqual(mock_requests_post.call_count, 0)
 
         payload = mock_pull_request_payload()
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 1)
-        self.assertEqual(mock_requests_post.call_count, 3)
-        payload = mock_requests_post.call_args[1]['data']
-        expected_payload = {'user': u'rakuco',
-                            'name': u'Hello world',
+        self.assertEqual(PullRequest.objects.get(pk=1).comment_id, 1234)
+        # The comment and the status are sent to GitHub, the patch to Buildbot.
+        self.assertEqual(mock_github_post.call_count, 2)
+        self.assertEqual(mock_requests_post.call_count, 1)
+        expected_payload = {'user': 'rakuco',
+                            'name': 'Hello world',
                             'email': 'noreply@01.org',
-                            'revision': u'deadbeef',
-                            'project': u'crosswalk',
-                            'repository': u'crosswalk',
-                            'branch': u'master',
+                            'revision': 'deadbeef',
+                            'project': 'crosswalk',
+                            'repository': 'crosswalk',
+                            'branch': 'master',
                             'patch': '+++ some/file\n--- some/file\n+ new line\n',
-                            'issue': PullRequest.objects.get(pk=1).pk}
-        self.assertEqual(payload, expected_payload)
+                            'issue': str(PullRequest.objects.get(pk=1).pk)}
+        self.assertEqual(sent_form(mock_requests_post), expected_payload)
 
-        # FIXME(rakuco): Remove this part of the test once the 'crosswalk-lite'
-        # hackish check is removed from handlers.py.
+        # crosswalk-lite is only tested in crosswalk (see TRYBOT_ROUTES).
         payload = mock_pull_request_payload()
         payload['pull_request']['base']['ref'] = 'crosswalk-lite'
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 2)
-        self.assertEqual(mock_requests_post.call_count, 6)
+        self.assertEqual(mock_github_post.call_count, 4)
+        self.assertEqual(mock_requests_post.call_count, 2)
         payload = mock_pull_request_payload()
         payload['pull_request']['base']['repo']['name'] = 'v8-crosswalk'
+        payload['pull_request']['base']['repo']['full_name'] = \
+            'crosswalk-project/v8-crosswalk'
         payload['pull_request']['base']['ref'] = 'crosswalk-lite'
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 2)
-        self.assertEqual(mock_requests_post.call_count, 6)
+        self.assertEqual(mock_github_post.call_count, 4)
+        self.assertEqual(mock_requests_post.call_count, 2)
 
     @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    @override_settings(
+        TRYBOT_MASTERS={
+            'main': {'base_url': 'http://buildbot',
+                     'send_patch_url': 'http://buildbot/send_try_patch'},
+            'other': {'base_url': 'http://other-buildbot',
+                      'send_patch_url': 'http://other-buildbot/send_try_patch'},
+        },
+        TRYBOT_ROUTES=(
+            ('crosswalk-project/crosswalk', 'crosswalk-1?', {'builders': []}),
+            ('crosswalk-project/crosswalk', 'crosswalk-*', {
+                'builders': ['crosswalk-linux', 'crosswalk-android'],
+                'masters': ['other']}),
+            ('*', 'master', {'masters': ['main']}),
+        ))
+    def test_routes(self, mock_github_get, mock_github_post,
+                    mock_requests_post):
+        mock_github_get.return_value = mock_patch_response(['+ new line\n'])
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+
+        def post(branch, sha):
+            payload = mock_pull_request_payload()
+            payload['pull_request']['base']['ref'] = branch
+            payload['pull_request']['head']['sha'] = sha
+            self.client.post(self.url, payload)
+            process_jobs()
+
+        # Nothing at all is sent for branches without builders.
+        for branch, sha in (('crosswalk-10', 'aa'), ('foo', 'bb')):
+            post(branch, sha)
+            self.assertEqual(Job.objects.count(), 0)
+            self.assertEqual(mock_github_get.call_count, 0)
+            self.assertEqual(mock_github_post.call_count, 0)
+            self.assertEqual(mock_requests_post.call_count, 0)
+
+        post('crosswalk-9', 'cc')
+        self.assertEqual(PullRequest.objects.count(), 1)
+        self.assertEqual(mock_requests_post.call_args[0][0],
+                         'http://other-buildbot/send_try_patch')
+        self.assertEqual(sent_form(mock_requests_post)['bot'],
+                         'crosswalk-linux,crosswalk-android')
+
+        post('master', 'dd')
+        self.assertEqual(PullRequest.objects.count(), 2)
+        self.assertEqual(mock_requests_post.call_args[0][0],
+                         'http://buildbot/send_try_patch')
+        self.assertNotIn('bot', sent_form(mock_requests_post))
+
     @mock.patch('requests.get')
-    def test_success(self, mock_requests_get, mock_requests_post):
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    @override_settings(TRYBOT_MASTERS={
+        'a': {'base_url': 'http://buildbot-a',
+              'send_patch_url': 'http://buildbot-a/send_try_patch'},
+        'b': {'base_url': 'http://buildbot-b',
+              'send_patch_url': 'http://buildbot-b/send_try_patch'},
+    })
+    def test_masters(self, mock_github_get, mock_github_post,
+                     mock_requests_post, mock_requests_get):
+        mock_github_get.return_value = mock_patch_response(['+ new line\n'])
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+        health = {'http://buildbot-a': 200, 'http://buildbot-b': 200}
+        mock_requests_get.side_effect = \
+            lambda url, **kwargs: mock.Mock(status_code=health[url])
+
+        def post(sha):
+            payload = mock_pull_request_payload()
+            payload['pull_request']['head']['sha'] = sha
+            self.client.post(self.url, payload)
+            process_jobs()
+
+        # "a" is busier than "b".
+        PullRequest.objects.create(
+            number=1, head_sha='00', base_repo_path='crosswalk-project/crosswalk',
+            head_repo_path='user/crosswalk-fork', comment_id=1,
+            master='a', builds_pending=3)
+        post('aa')
+        self.assertEqual(PullRequest.objects.get(head_sha='aa').master, 'b')
+        self.assertEqual(mock_requests_post.call_args[0][0],
+                         'http://buildbot-b/send_try_patch')
+
+        # "b" is still the least loaded master, but it is down now.
+        reset_health_checker()
+        health['http://buildbot-b'] = 503
+        post('bb')
+        self.assertEqual(PullRequest.objects.get(head_sha='bb').master, 'a')
+        self.assertEqual(mock_requests_post.call_args[0][0],
+                         'http://buildbot-a/send_try_patch')
+
+        # Masters failing to accept a patch are not healthy either. The job
+        # is retried later.
+        error_response = mock.Mock()
+        error_response.raise_for_status.side_effect = \
+            requests.HTTPError('500 Server Error')
+        mock_requests_post.return_value = error_response
+        post('cc')
+        self.assertEqual(Job.objects.get().state, JOB_QUEUED)
+        self.assertEqual(PullRequest.objects.filter(master='a').count(), 3)
+        # Both masters are unhealthy until they are checked again.
+        mock_requests_post.return_value = mock.Mock()
+        Job.objects.update(run_after=timezone.now())
+        process_jobs()
+        self.assertEqual(Job.objects.get().state, JOB_QUEUED)
+        self.assertEqual(Job.objects.get().attempts, 2)
+
+        # Builds are stopped in their master.
+        stop_builds([('b', 'crosswalk linux', 7)])
+        mock_requests_post.assert_called_with(
+            'http://buildbot-b/builders/crosswalk%20linux/builds/7/stop',
+            data=mock.ANY, timeout=mock.ANY)
+
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    def test_success(self, mock_github_get, mock_github_post,
+                     mock_requests_post):
         payload = mock_pull_request_payload()
 
-        get_response = mock.Mock()
-        get_response.status_code = 200
-        get_response.text = '+++ some/file\n--- some/file\n+ new line\n'
-        get_response.json.return_value = {'id': 3}
-        mock_requests_get.return_value = get_response
+        mock_github_get.return_value = mock_patch_response(
+            ['+++ some/file\n--- some/file\n', '+ new line\n'])
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 1)
         pr = PullRequest.objects.get(pk=1)
         self.assertEqual(pr.number, 42)
@@ -348,6 +763,7 @@ class PullRequestTests(TestCase):
         payload['action'] = 'synchronize'
         payload['pull_request']['head']['sha'] = 'f00b4r'
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(PullRequest.objects.count(), 2)
         pr = PullRequest.objects.get(pk=2)
         self.assertEqual(pr.number, 42)
@@ -357,16 +773,176 @@ class PullRequestTests(TestCase):
         self.assertEqual(pr.status, STATUS_PENDING)
         self.assertEqual(pr.needs_sync, True)
 
-    @mock.patch('requests.get')
-    def test_patch_fetch_error(self, mock_requests_get):
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    @override_settings(TRYBOT_MAX_INLINE_PATCH_SIZE=10,
+                       TRYBOT_PATCH_CHUNK_SIZE=4, TRYBOT_COMPRESS_PATCH=True)
+    def test_large_patch(self, mock_github_get, mock_github_post,
+                         mock_requests_post):
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+
+        # Small enough to be sent inline, gzipped.
+        mock_github_get.return_value = mock_patch_response(
+            ['+ a\n', '+ b\n'])
+        payload = mock_pull_request_payload()
+        self.client.post(self.url, payload)
+        process_jobs()
+        mock_github_get.assert_called_with(
+            payload['pull_request']['patch_url'], operation='download_patch',
+            stream=True)
+        mock_github_get.return_value.iter_content.assert_called_with(4)
+        self.assertTrue(mock_github_get.return_value.close.called)
+        form = sent_form(mock_requests_post)
+        self.assertEqual(form['patch'], '+ a\n+ b\n')
+        self.assertNotIn('patch_url', form)
+
+        # Too big: the download stops and Buildbot gets the URL instead.
+        chunks = iter(['+ a\n', '+ b\n', '+ c\n', '+ d\n'])
+        mock_github_get.return_value = mock_patch_response()
+        mock_github_get.return_value.iter_content.return_value = chunks
+        payload['action'] = 'synchronize'
+        payload['pull_request']['head']['sha'] = 'f00b4r'
+        self.client.post(self.url, payload)
+        process_jobs()
+        self.assertEqual(list(chunks), ['+ d\n'])
+        self.assertTrue(mock_github_get.return_value.close.called)
+        form = sent_form(mock_requests_post)
+        self.assertNotIn('patch', form)
+        self.assertEqual(form['patch_url'],
+                         payload['pull_request']['patch_url'])
+        self.assertEqual(form['revision'], 'f00b4r')
+        self.assertEqual(PullRequest.objects.count(), 2)
+
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    def test_patch_fetch_error(self, mock_github_get, mock_github_post):
         payload = mock_pull_request_payload()
 
-        mock_response = mock.Mock()
-        mock_response.status_code = 404
-        mock_requests_get.return_value = mock_response
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+        mock_github_get.return_value = mock_patch_response(status_code=404)
         response = self.client.post(self.url, payload)
-        self.assertEqual(response.status_code, 500)
-        self.assertEqual(PullRequest.objects.count(), 0)
+        self.assertEqual(response.status_code, 200)
+        process_jobs()
+        self.assertEqual(PullRequest.objects.count(), 1)
+        # Only the comment has been posted.
+        self.assertEqual(mock_github_post.call_count, 1)
+
+        # The job sending the patch series is kept so that it can be retried
+        # later.
+        job = Job.objects.get()
+        self.assertEqual(job.task, 'trybot_control.handlers.send_try_job')
+        self.assertEqual(job.state, JOB_QUEUED)
+        self.assertEqual(job.attempts, 1)
+
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    def test_retry(self, mock_github_get, mock_github_post,
+                   mock_requests_post):
+        mock_github_get.return_value = mock_patch_response(['+ new line\n'])
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+        mock_requests_post.side_effect = IOError('Connection refused')
+
+        self.client.post(self.url, mock_pull_request_payload())
+        process_jobs()
+        pr = PullRequest.objects.get()
+        self.assertEqual(Job.objects.get().attempts, 1)
+        # The comment and the status.
+        self.assertEqual(mock_github_post.call_count, 2)
+
+        # The comment and the PullRequest of the failed attempt are reused.
+        mock_requests_post.side_effect = None
+        Job.objects.update(run_after=timezone.now())
+        process_jobs()
+        self.assertEqual(Job.objects.count(), 0)
+        self.assertEqual(PullRequest.objects.get().pk, pr.pk)
+        self.assertFalse(PullRequest.objects.get().superseded)
+        # Only the patch series is sent again.
+        self.assertEqual(mock_github_post.call_count, 2)
+        self.assertEqual(sent_form(mock_requests_post)['issue'], str(pr.pk))
+
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    @override_settings(TRYBOT_STOP_SUPERSEDED_BUILDS=True,
+                       TRYBOT_BASE_URL='http://buildbot',
+                       TRYBOT_BUILDBOT_TIMEOUT=12)
+    def test_supersede(self, mock_github_get, mock_github_post,
+                       mock_requests_post):
+        mock_github_get.return_value = mock_patch_response(['+ new line\n'])
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+
+        payload = mock_pull_request_payload()
+        self.client.post(self.url, payload)
+        process_jobs()
+        old_pr = PullRequest.objects.get()
+        TrybotBuild.objects.create(pull_request=old_pr,
+                                   builder_name='crosswalk linux',
+                                   build_number=7)
+
+        payload['action'] = 'synchronize'
+        payload['pull_request']['head']['sha'] = 'f00b4r'
+        payload['pull_request']['updated_at'] = '2015-01-01T12:05:00Z'
+        self.client.post(self.url, payload)
+        process_jobs()
+        self.assertEqual(PullRequest.objects.count(), 2)
+        old_pr = PullRequest.objects.get(pk=old_pr.pk)
+        self.assertTrue(old_pr.superseded)
+        self.assertFalse(old_pr.needs_sync)
+        new_pr = PullRequest.objects.get(head_sha='f00b4r')
+        self.assertFalse(new_pr.superseded)
+        self.assertTrue(new_pr.needs_sync)
+
+        mock_requests_post.assert_any_call(
+            'http://buildbot/builders/crosswalk%20linux/builds/7/stop',
+            data=mock.ANY, timeout=12)
+        for args, kwargs in mock_requests_post.call_args_list:
+            self.assertEqual(kwargs['timeout'], 12)
+        self.assertEqual(Job.objects.count(), 0)
+
+    @mock.patch('requests.post')
+    @mock.patch('github_webhooks.github.post')
+    @mock.patch('github_webhooks.github.get')
+    def test_supersede_out_of_order(self, mock_github_get, mock_github_post,
+                                    mock_requests_post):
+        mock_github_get.return_value = mock_patch_response(['+ new line\n'])
+        mock_github_post.return_value.json.return_value = {'id': 1234}
+
+        new_payload = mock_pull_request_payload()
+        new_payload['action'] = 'synchronize'
+        new_payload['pull_request']['head']['sha'] = 'f00b4r'
+        new_payload['pull_request']['updated_at'] = '2015-01-01T12:05:00Z'
+        self.client.post(self.url, new_payload)
+        process_jobs()
+        self.assertEqual(mock_requests_post.call_count, 1)
+
+        # The event of the older head is handled last, but it does not
+        # supersede the newer one and is not sent to Buildbot.
+        self.client.post(self.url, mock_pull_request_payload())
+        process_jobs()
+        self.assertEqual(PullRequest.objects.count(), 2)
+        new_pr = PullRequest.objects.get(head_sha='f00b4r')
+        self.assertFalse(new_pr.superseded)
+        self.assertTrue(new_pr.needs_sync)
+        old_pr = PullRequest.objects.get(head_sha='deadbeef')
+        self.assertTrue(old_pr.superseded)
+        self.assertFalse(old_pr.needs_sync)
+        self.assertEqual(mock_requests_post.call_count, 1)
+        self.assertEqual(Job.objects.count(), 0)
+
+    @mock.patch('trybot_control.handlers.enqueue')
+    def test_redelivery_after_failure(self, enqueue_mock):
+        enqueue_mock.side_effect = IOError('Database is gone')
+        self.assertRaises(ConsumerFailed, self.client.post, self.url,
+                          mock_pull_request_payload(),
+                          HTTP_X_GITHUB_DELIVERY='guid-1')
+
+        enqueue_mock.side_effect = None
+        response = self.client.post(self.url, mock_pull_request_payload(),
+                                    HTTP_X_GITHUB_DELIVERY='guid-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(enqueue_mock.call_count, 2)
 
     def test_ignored_action(self):
         payload = mock_pull_request_payload()
@@ -374,9 +950,11 @@ class PullRequestTests(TestCase):
         payload['action'] = 'closed'
         response = self.client.post(self.url, payload)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(Job.objects.count(), 0)
         self.assertEqual(PullRequest.objects.count(), 0)
 
         payload['action'] = 'reopened'
         response = self.client.post(self.url, payload)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(Job.objects.count(), 0)
         self.assertEqual(PullRequest.objects.count(), 0)
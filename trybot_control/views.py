@@ -2,18 +2,22 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import hashlib
-import hmac
 import json
 import logging
-import requests
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseServerError
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils import timezone
 from django.views.decorators.http import require_POST
 
 from github_webhooks.decorators import add_github_payload, require_github_signature
+from github_webhooks.decorators import filter_github_events
+from github_webhooks.decorators import ignore_duplicate_deliveries
+from github_webhooks.jobs import enqueue
+from trybot_control.handlers import on_pull_request_changed
+from trybot_control.notifications import notify_sync_needed
 from trybot_control.models import *
 
 
@@ -25,7 +29,8 @@ def parse_buildbot_packet(packet):
     - status: None if the package does not have a "results" field, otherwise a
               corresponding models.STATUS_* value.
     - data: Whatever is in the packet's "build" field.
-    - pull_request: A PullRequest object obtained from the "issue" property.
+    - pull_request_id: The primary key of the PullRequest the packet refers
+                       to, obtained from the "issue" property.
     If parsing fails, ValueError is raised with an appropriate error message.
     """
     if 'event' not in packet:
@@ -40,48 +45,180 @@ def parse_buildbot_packet(packet):
     try:
         build = packet['payload']['build']
         properties = dict([(k, v) for k, v, _ in build['properties']])
-        pull_request = PullRequest.objects.get(pk=properties['issue'])
-    except ObjectDoesNotExist:
-        raise ValueError('Pull request with id=%d does not exist.' % \
-                         properties['issue'])
+        pull_request_id = int(properties['issue'])
     except KeyError:
         raise ValueError('Got a packet without an "issue" property.')
+    if packet['event'] in ('buildStarted', 'buildFinished') and \
+       ('builderName' not in build or 'number' not in build):
+        raise ValueError('Got a build packet without a builder name or '
+                         'build number.')
 
     # Buildbot status codes:
     # 0=Success, 1=Warnings, 2=Failure, 3=Skipped, 4=Exception, 5=Retry
+    # Skipped builds have not failed, and retried ones are run again, so
+    # neither is counted as a failure.
     status = build.get('results', 0)
-    if status < 2:
-        status = STATUS_SUCCESS
-    else:
+    if status in (2, 4):
         status = STATUS_FAILURE
+    elif status == 5:
+        status = STATUS_PENDING
+    else:
+        status = STATUS_SUCCESS
 
     return {'event_name': packet['event'],
             'status': status,
             'data': build,
-            'pull_request': pull_request}
+            'pull_request_id': pull_request_id}
 
 
-def make_trybot_payload(pull_request):
+def apply_buildbot_packets(packets):
     """
-    Gets any relevant data from a pull request JSON object sent by GitHub and
-    uses that to build a dict with the keys used by try_job_base.py.
+    Updates the database with the events in |packets|, a list of dictionaries
+    returned by parse_buildbot_packet(). Returns the number of pull requests
+    that were changed.
+
+    Buildbot usually sends many packets at once, so instead of doing a few
+    queries per packet, all referenced pull requests and builds are loaded
+    with one query each, the events are applied in memory and the results
+    are written back with a few bulk queries in a single transaction.
     """
-    patch_response = requests.get(pull_request['patch_url'])
-    if patch_response.status_code != 200:
-        logging.error('Fetching %s from GitHub failed with status code %d.' % \
-                      (pull_request['patch_url'], patch_response.status_code))
-        return None
-
-    return {
-        'user': pull_request['user']['login'],
-        'name': pull_request['title'],
-        'email': 'noreply@01.org',
-        'revision': pull_request['head']['sha'],
-        'project': pull_request['base']['repo']['name'],
-        'repository': pull_request['base']['repo']['name'],
-        'branch': pull_request['base']['ref'],
-        'patch': patch_response.text,
-    }
+    pull_requests = PullRequest.objects.in_bulk(
+        set(p['pull_request_id'] for p in packets))
+    for packet in packets:
+        if packet['pull_request_id'] not in pull_requests:
+            logging.warn('Pull request with id=%d does not exist.' % \
+                         packet['pull_request_id'])
+    packets = [p for p in packets if p['pull_request_id'] in pull_requests]
+
+    # Builds are identified by their master (the pull request's), builder
+    # and number.
+    build_keys = set((pull_requests[p['pull_request_id']].master,
+                      p['data']['builderName'], p['data']['number'])
+                     for p in packets
+                     if p['event_name'] in ('buildStarted', 'buildFinished'))
+    builds = {}
+    if build_keys:
+        for build in TrybotBuild.objects.filter(
+                master__in=set(k[0] for k in build_keys),
+                builder_name__in=set(k[1] for k in build_keys),
+                build_number__in=set(k[2] for k in build_keys)):
+            builds[(build.master, build.builder_name,
+                    build.build_number)] = build
+
+    new_builds = {}
+    changed_builds = {}
+    pull_request_statuses = {}
+    # Maps pull request IDs to the change in their number of builds with
+    # each status.
+    build_counts = {}
+    changed_pull_requests = set()
+    # Builds started for superseded pull requests.
+    stale_builds = []
+
+    for packet in packets:
+        event_name = packet['event_name']
+        status = packet['status']
+        data = packet['data']
+        pull_request = pull_requests[packet['pull_request_id']]
+
+        if event_name == 'buildStarted':
+            key = (pull_request.master, data['builderName'], data['number'])
+            if key in builds:
+                logging.warn('Build %d of %s has already started.' % \
+                             (key[2], key[1]))
+                continue
+            build = TrybotBuild(pull_request=pull_request,
+                                master=pull_request.master,
+                                builder_name=data['builderName'],
+                                build_number=data['number'],
+                                status=STATUS_PENDING)
+            builds[key] = new_builds[key] = build
+            _count_build(build_counts, pull_request.pk, STATUS_PENDING, 1)
+            if pull_request.superseded:
+                stale_builds.append(key)
+        elif event_name == 'buildFinished':
+            key = (pull_request.master, data['builderName'], data['number'])
+            if key not in builds:
+                logging.warn('Build %d of %s has finished without having '
+                             'started.' % (key[2], key[1]))
+                continue
+            build = builds[key]
+            _count_build(build_counts, build.pull_request_id, build.status, -1)
+            # 'results' is not set when the build finishes successfully.
+            if status is None:
+                build.status = STATUS_SUCCESS
+            else:
+                build.status = status
+            _count_build(build_counts, build.pull_request_id, build.status, 1)
+            if key not in new_builds:
+                changed_builds[key] = build
+        elif event_name == 'buildsetFinished':
+            pull_request_statuses[pull_request.pk] = status
+        else:
+            logging.warn('Got a packet with an unknown event type "%s".' % \
+                         event_name)
+            continue
+
+        # Superseded pull requests are kept up to date, but not synced.
+        if not pull_request.superseded:
+            changed_pull_requests.add(pull_request.pk)
+
+    with transaction.atomic():
+        if new_builds:
+            TrybotBuild.objects.bulk_create(new_builds.values())
+        for status, pks in _group_by_value(
+                dict((b.pk, b.status) for b in changed_builds.values())):
+            TrybotBuild.objects.filter(pk__in=pks).update(status=status)
+
+        # Pull requests getting the same changes are updated together.
+        # needs_sync_since is only set on the ones that did not need to be
+        # synced yet, so that it keeps the time of the oldest unsynced change.
+        changes = {}
+        now = timezone.now()
+        for pk in set(pull_request_statuses).union(build_counts,
+                                                   changed_pull_requests):
+            counts = build_counts.get(pk, {})
+            needs_sync = pk in changed_pull_requests
+            changes[pk] = (pull_request_statuses.get(pk),
+                           tuple(sorted((build_status, count) for
+                                        build_status, count in
+                                        counts.iteritems() if count)),
+                           needs_sync,
+                           needs_sync and not pull_requests[pk].needs_sync)
+        for (status, counts, needs_sync, raised), pks in \
+                _group_by_value(changes):
+            fields = dict((BUILD_COUNT_FIELDS[build_status],
+                           F(BUILD_COUNT_FIELDS[build_status]) + count)
+                          for build_status, count in counts)
+            if status is not None:
+                fields['status'] = status
+            if needs_sync:
+                fields['needs_sync'] = True
+            if raised:
+                fields['needs_sync_since'] = now
+            if fields:
+                PullRequest.objects.filter(pk__in=pks).update(**fields)
+
+        if stale_builds and settings.TRYBOT_STOP_SUPERSEDED_BUILDS:
+            enqueue('trybot_control.handlers.stop_builds',
+                    builds=stale_builds)
+
+    return len(changed_pull_requests)
+
+
+def _count_build(build_counts, pull_request_id, status, count):
+    counts = build_counts.setdefault(pull_request_id, {})
+    counts[status] = counts.get(status, 0) + count
+
+
+def _group_by_value(d):
+    """
+    Returns a list of (value, [keys with that value]) tuples for dict |d|.
+    """
+    groups = {}
+    for key, value in d.iteritems():
+        groups.setdefault(value, []).append(key)
+    return groups.items()
 
 
 @require_POST
@@ -97,108 +234,27 @@ def buildbot_event(request):
         logging.warn('POST from Buildbot did not contain a "packets" field.')
         return HttpResponseBadRequest()
 
-    packets = json.loads(request.POST['packets'])
-
-    for packet in packets:
+    packets = []
+    for packet in json.loads(request.POST['packets']):
         # We are consciously returning HTTP 200 even when an invalid packet is
         # sent because Buildbot will keep retrying to send the same packets
         # when it receives an error response.
         try:
-            packet = parse_buildbot_packet(packet)
+            packets.append(parse_buildbot_packet(packet))
         except ValueError, e:
             logging.warn(e)
-            continue
-
-        event_name = packet['event_name']
-        status = packet['status']
-        data = packet['data']
-        pull_request = packet['pull_request']
-
-        if event_name == 'buildStarted':
-            TrybotBuild.objects.create(pull_request=pull_request,
-                                       builder_name=data['builderName'],
-                                       build_number=data['number'],
-                                       status=STATUS_PENDING)
-        elif event_name == 'buildFinished':
-            build = TrybotBuild.objects.get(builder_name=data['builderName'],
-                                            build_number=data['number'])
-            # 'results' is not set when the build finishes successfully.
-            if status is None:
-                build.status = STATUS_SUCCESS
-            else:
-                build.status = status
-            build.save()
-        elif event_name == 'buildsetFinished':
-            pull_request.status = status
-        else:
-            logging.warn('Got a packet with an unknown event type "%s".' % \
-                         packet.event)
-            continue
-
-        pull_request.needs_sync = True
-        pull_request.save()
 
+    if apply_buildbot_packets(packets):
+        notify_sync_needed()
     return HttpResponse()
 
 
 @require_POST
 @require_github_signature
+@filter_github_events(['pull_request'],
+                      actions=on_pull_request_changed.event_filter.actions)
 @add_github_payload
+@ignore_duplicate_deliveries
 def handle_pull_request(request):
-    payload = request.payload
-
-    # 'reopened' is irrelevant for our purposes. 'closed' initially looks
-    # relevant, but we cannot kill the trybot builds in the middle: we need to
-    # wait for them to complete and only then remove the pull request from the
-    # database and update the status.
-    if payload['action'] not in ('opened', 'synchronize'):
-        logging.warn('Ignoring action type "%s".' % payload['action'])
-        return HttpResponse()
-
-    pull_request = payload['pull_request']
-
-    # FIXME(rakuco): Replace the 'crosswalk-lite' hackish check below with a
-    # proper flow where a comment gets posted only if there are builders to
-    # process the patch on the right branch.
-    target_project = pull_request['base']['repo']['name']
-    target_branch = pull_request['base']['ref']
-    if target_project == 'crosswalk':
-        if target_branch not in ('master', 'crosswalk-lite'):
-            return HttpResponse()
-    else:
-        if target_branch != 'master':
-            return HttpResponse()
-
-    trybot_payload = make_trybot_payload(payload['pull_request'])
-    if trybot_payload is None:
-        return HttpResponseServerError()
-
-    pull_request_number = pull_request['number']
-    base_repo_path = pull_request['base']['repo']['full_name']
-    head_repo_path = pull_request['head']['repo']['full_name']
-    sha = pull_request['head']['sha']
-
-    comment_url = 'https://api.github.com/repos/%s/issues/%d/comments' % \
-                  (base_repo_path, pull_request_number)
-    message = 'The patch series with %s@%s as head will be tested soon.' % \
-              (head_repo_path, sha)
-    response = requests.post(comment_url,
-                             auth=(settings.GITHUB_USERNAME,
-                                   settings.GITHUB_ACCESS_TOKEN),
-                             data=json.dumps({'body': message}))
-    comment_id = response.json()['id']
-
-    pr_object = PullRequest.objects.create(number=pull_request_number,
-                                           head_sha=sha,
-                                           base_repo_path=base_repo_path,
-                                           head_repo_path=head_repo_path,
-                                           comment_id=comment_id)
-    pr_object.report_build_status()
-
-    # FIXME(rakuco): This is a bit too fragile, we create this object in the
-    # make_trybot_payload() call but it needs this to have all the information
-    # Buildbot needs.
-    trybot_payload['issue'] = pr_object.pk
-
-    requests.post(settings.TRYBOT_SEND_PATCH_URL, data=trybot_payload)
+    on_pull_request_changed(request.payload)
     return HttpResponse()
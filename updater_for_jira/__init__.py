@@ -1,3 +1,6 @@
 # Copyright (c) 2014 Intel Corporation. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
+
+# Import views.py so that the signal handlers are properly registered.
+import updater_for_jira.views
@@ -0,0 +1,49 @@
+# Copyright (c) 2015 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+JIRA updates queued by the views in this application. They are run by the
+process_jobs management command.
+"""
+
+import logging
+
+from jira.exceptions import JIRAError
+
+from github_webhooks.jobs import enqueue
+from updater_for_jira.jirahelper import JiraHelper
+from updater_for_jira.views import issues_to_update
+
+
+def update_issue(issue_id, resolve, payload):
+    """
+    Resolves the JIRA issue |issue_id| if |resolve| is set, or comments on it
+    otherwise. |payload| is the GitHub pull_request event mentioning it.
+    Each issue is updated by its own job, so that retrying a failed update
+    does not touch the issues that have already been updated.
+    """
+    jira = JiraHelper()
+    try:
+        if resolve:
+            jira.resolve_issue(issue_id, payload)
+            logging.debug('Resolved issue %s' % issue_id)
+        else:
+            jira.comment_issue(issue_id, payload)
+            logging.debug('Commented on issue %s' % issue_id)
+    except JIRAError as e:
+        if e.status_code != 404:
+            raise
+        # Retrying would not make the issue appear.
+        logging.error('Issue %s does not exist.' % issue_id)
+
+
+def update_issues(payload):
+    """
+    Queues an update_issue() job for each JIRA issue to update because of
+    the pull_request event |payload|. Kept for the jobs queued before issues
+    were updated one by one.
+    """
+    for issue_id, resolve in issues_to_update(payload):
+        enqueue('updater_for_jira.handlers.update_issue', issue_id=issue_id,
+                resolve=resolve, payload=payload)
@@ -5,7 +5,11 @@
 from jira.client import JIRA
 from jira.exceptions import JIRAError
 from django.conf import settings
+from github_webhooks import metrics
+import collections
 import logging
+import threading
+import time
 
 open_comment_template = \
     u'(i) [{user_id}|{user_url}] referenced this issue in project' \
@@ -17,38 +21,207 @@ close_comment_template = \
     u'*[Pull Request {pr_number}|{pr_url}]*'
 
 
-class JiraHelper:
+class JiraClientPool(object):
     """
-    Connects to Jira server and provides high-level methods
-    to comment and resolve issues based on data from a PR
+    A thread-safe pool of authenticated JIRA clients shared by the whole
+    process, so that the connection to the server (and the server info
+    request done when a client is created) is reused across web hooks.
+    Clients are created lazily, up to |max_size| of them.
     """
-    def __init__(self):
-        self.jira = None
+    def __init__(self, max_size, health_check_interval):
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        # (client, time it was last used) tuples.
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
 
-    def _jira(self):
+    def _create_client(self):
+        options = {
+            'server': settings.JIRA_SERVER,
+            'verify': settings.JIRA_VERIFY_SSL
+        }
+        return JIRA(options, basic_auth=(settings.JIRA_USER,
+                                         settings.JIRA_PASSWORD))
+
+    def _acquire(self):
+        with self.condition:
+            while not self.idle and self.size >= self.max_size:
+                self.condition.wait()
+            if self.idle:
+                client, last_used = self.idle.pop()
+            else:
+                client, last_used = None, None
+                self.size += 1
+
+        try:
+            if client is None:
+                return self._create_client()
+            if time.time() - last_used > self.health_check_interval:
+                # The connection has been idle for a while and may have been
+                # closed or the session may have expired.
+                try:
+                    client.server_info()
+                except Exception:
+                    logging.info('Reconnecting to the JIRA server.')
+                    client = self._create_client()
+            return client
+        except Exception:
+            self._discard()
+            raise
+
+    def _release(self, client):
+        with self.condition:
+            self.idle.append((client, time.time()))
+            self.condition.notify()
+
+    def _discard(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def run(self, function, operation='request'):
         """
-        Initialize the connection to the JIRA server
+        Calls |function| with a JIRA client from the pool and returns its
+        result. If the server rejects the client's credentials (which happens
+        when its session expires, for example), the client is replaced with
+        a new one and |function| is called again.
+        Each call is recorded in the metrics as |operation|.
+        """
+        for attempt in xrange(2):
+            client = self._acquire()
+            try:
+                with metrics.outbound_call('jira', operation):
+                    result = function(client)
+            except JIRAError as e:
+                if e.status_code != 401:
+                    self._release(client)
+                    raise
+                self._discard()
+                if attempt > 0:
+                    raise
+                logging.info('JIRA rejected our credentials, reconnecting.')
+                continue
+            except Exception:
+                # We do not know what state the client is in.
+                self._discard()
+                raise
+            self._release(client)
+            return result
+
+
+class TransitionCache(object):
+    """
+    A thread-safe LRU cache of the ID of the "Resolve" transition, keyed by
+    (project, issue type, status). Transitions depend only on the workflow
+    and on the issue's current status, so this saves a request per issue.
+    Entries expire after |ttl| seconds; None is also cached for issues that
+    cannot be resolved from their current status.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Maps keys to (transition ID, expiration time) tuples.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
         """
-        if self.jira is None:
-            options = {
-                'server': settings.JIRA_SERVER,
-                'verify': settings.JIRA_VERIFY_SSL
-            }
-            self.jira = JIRA(options, basic_auth=(settings.JIRA_USER,
-                                                  settings.JIRA_PASSWORD))
-        return self.jira
-
-    def _get_resolve_transition(self, issue):
+        Returns a (found, transition ID) tuple for |key|.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return (False, None)
+            transition_id, expires = self.entries.pop(key)
+            if time.time() >= expires:
+                return (False, None)
+            # Mark it as the most recently used entry.
+            self.entries[key] = (transition_id, expires)
+            return (True, transition_id)
+
+    def set(self, key, transition_id):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (transition_id, time.time() + self.ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+_client_pool = None
+_transition_cache = None
+_client_pool_lock = threading.Lock()
+
+
+def client_pool():
+    """
+    Returns the JiraClientPool shared by the whole process, creating it if
+    necessary.
+    """
+    global _client_pool
+    with _client_pool_lock:
+        if _client_pool is None:
+            _client_pool = JiraClientPool(settings.JIRA_POOL_SIZE,
+                                          settings.JIRA_HEALTH_CHECK_INTERVAL)
+        return _client_pool
+
+
+def transition_cache():
+    """
+    Returns the TransitionCache shared by the whole process, creating it if
+    necessary.
+    """
+    global _transition_cache
+    with _client_pool_lock:
+        if _transition_cache is None:
+            _transition_cache = TransitionCache(
+                settings.JIRA_TRANSITION_CACHE_SIZE,
+                settings.JIRA_TRANSITION_CACHE_TTL)
+        return _transition_cache
+
+
+def reset_client_pool():
+    """
+    Drops all pooled clients and cached transitions, so that new ones are
+    created with the current settings.
+    """
+    global _client_pool, _transition_cache
+    with _client_pool_lock:
+        _client_pool = None
+        _transition_cache = None
+
+
+class JiraHelper:
+    """
+    Connects to Jira server and provides high-level methods
+    to comment and resolve issues based on data from a PR
+    """
+    def _get_resolve_transition(self, jira, issue):
         """
         Returns the JIRA transition corresponding to "Resolve" for the given
         issue, or None if such a transition does not exist for the issue at its
         current state.
         """
-        for transition in self._jira().transitions(issue):
+        for transition in jira.transitions(issue):
             if transition['name'] == settings.JIRA_TRANSITION_RESOLVE_NAME:
                 return transition
         return None
 
+    def _get_resolve_transition_id(self, jira, issue, cache_key):
+        """
+        Like _get_resolve_transition(), but only returns the ID of the
+        transition, which is looked up in the transition cache first.
+        """
+        found, transition_id = transition_cache().get(cache_key)
+        if not found:
+            transition = self._get_resolve_transition(jira, issue)
+            transition_id = transition['id'] if transition else None
+            transition_cache().set(cache_key, transition_id)
+        return transition_id
+
     def comment_issue(self, issue_id, payload):
         comment = open_comment_template.format(
             user_id=payload['pull_request']['user']['login'],
@@ -60,7 +233,8 @@ class JiraHelper:
             pr_title=payload['pull_request']['title'])
 
         try:
-            self._jira().add_comment(issue_id, comment)
+            client_pool().run(lambda jira: jira.add_comment(issue_id, comment),
+                              operation='add_comment')
         except JIRAError as e:
             logging.error('Could not comment issue %s: %s' %
                           (issue_id, e.text))
@@ -72,20 +246,33 @@ class JiraHelper:
             pr_number=payload['pull_request']['number'],
             pr_url=payload['pull_request']['html_url'])
 
-        issue = self._jira().issue(issue_id)
-        resolve_transition = self._get_resolve_transition(issue)
+        client_pool().run(lambda jira: self._resolve_issue(jira, issue_id,
+                                                           comment),
+                          operation='resolve_issue')
+
+    def _resolve_issue(self, jira, issue_id, comment):
+        issue = jira.issue(issue_id)
+        cache_key = (issue_id.rsplit('-', 1)[0],
+                     issue.fields.issuetype.id,
+                     issue.fields.status.id)
+        resolve_transition_id = self._get_resolve_transition_id(jira, issue,
+                                                                cache_key)
 
-        if resolve_transition is None:
+        if resolve_transition_id is None:
             logging.warn('Issue %s does not have a valid transition to '
                          'the "Resolve" state.' % issue_id)
             return
 
         try:
-            self._jira().transition_issue(
+            jira.transition_issue(
                 issue,
-                resolve_transition['id'],
+                resolve_transition_id,
                 comment=comment,
                 resolution={'id': settings.JIRA_RESOLUTION_FIXED_ID})
         except JIRAError as e:
+            # The workflow may have changed.
+            transition_cache().invalidate(cache_key)
+            if e.status_code == 401:
+                raise
             logging.error('Could not resolve issue %s: %s' %
                           (issue_id, e.text))
@@ -2,6 +2,9 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import json
+
+from jira.exceptions import JIRAError
 from mock import patch, ANY, Mock
 
 from django.core.urlresolvers import reverse
@@ -9,10 +12,14 @@ from django.conf import settings
 from django.test import TestCase
 from django.test.client import Client
 from django.test.utils import override_settings
+from django.utils import timezone
 
+from github_webhooks.jobs import process_jobs
+from github_webhooks.models import Job
 from github_webhooks.test.utils import GitHubEventClient
 from github_webhooks.test.utils import mock_pull_request_payload
-from updater_for_jira.jirahelper import JiraHelper
+from updater_for_jira.handlers import update_issue
+from updater_for_jira.jirahelper import JiraHelper, reset_client_pool
 from updater_for_jira.views import handle_pull_request
 from updater_for_jira.views import search_issues
 
@@ -20,6 +27,7 @@ from updater_for_jira.views import search_issues
 class JiraUpdaterTestCase(TestCase):
     def setUp(self):
         settings.JIRA_PROJECTS = ('PROJ', 'OTHERPROJ')
+        reset_client_pool()
         self.client = GitHubEventClient()
         self.url = reverse('updater_for_jira.views.handle_pull_request')
 
@@ -137,16 +145,51 @@ class JiraUpdaterTestCase(TestCase):
                               [{'id': 'PROJ-123', 'resolve': False},
                                {'id': 'OTHERPROJ-456', 'resolve': True}])
 
+    def test_resolve_issue_line_endings(self):
+        text = 'Bug fix for PROJ-1.\r\n\r\nBUG=PROJ-123\r\nSee PROJ-4'
+        issues = search_issues(text)
+        self.assertItemsEqual(issues,
+                              [{'id': 'PROJ-1', 'resolve': False},
+                               {'id': 'PROJ-123', 'resolve': True},
+                               {'id': 'PROJ-4', 'resolve': False}])
+
+        text = 'BUG=PROJ-1 and PROJ-2\rPROJ-3'
+        issues = search_issues(text)
+        self.assertItemsEqual(issues,
+                              [{'id': 'PROJ-1', 'resolve': True},
+                               {'id': 'PROJ-2', 'resolve': True},
+                               {'id': 'PROJ-3', 'resolve': False}])
+
+        # The last mention of an issue is the one that counts.
+        text = 'BUG=PROJ-1\nAlso see PROJ-1.'
+        issues = search_issues(text)
+        self.assertItemsEqual(issues,
+                              [{'id': 'PROJ-1', 'resolve': False}])
+
+    def test_regexp_projects_changed(self):
+        text = 'BUG=PROJ-1\nBUG=FOOBAR-2'
+        self.assertItemsEqual(search_issues(text),
+                              [{'id': 'PROJ-1', 'resolve': True}])
+
+        with self.settings(JIRA_PROJECTS=('FOOBAR',)):
+            self.assertItemsEqual(search_issues(text),
+                                  [{'id': 'FOOBAR-2', 'resolve': True}])
+
+        self.assertItemsEqual(search_issues(text),
+                              [{'id': 'PROJ-1', 'resolve': True}])
+
     @patch('updater_for_jira.jirahelper.JIRA')
     def test_no_issue(self, jira_mock):
         payload = mock_pull_request_payload()
 
         payload['pull_request']['body'] = 'This PR does not fix any issue'
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(jira_mock.called, False)
 
         payload['pull_request']['body'] = None
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(jira_mock.called, False)
 
     @patch('updater_for_jira.jirahelper.JIRA')
@@ -158,8 +201,45 @@ class JiraUpdaterTestCase(TestCase):
             '\n'\
             'BUG=https://crosswalk-project.org/jira/bug=PROJ-2'
         response = self.client.post(self.url, payload)
+        process_jobs()
         jira_mock.return_value.add_comment.assert_called_with('PROJ-2', ANY)
 
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_issue_failure(self, jira_mock):
+        payload = mock_pull_request_payload()
+        payload['pull_request']['body'] = 'BUG=PROJ-2\nBUG=PROJ-3\nBUG=PROJ-4'
+        issues = []
+
+        def add_comment(issue_id, comment):
+            issues.append(issue_id)
+            if issue_id == 'PROJ-3':
+                raise IOError('Connection reset by peer')
+            if issue_id == 'PROJ-4':
+                raise JIRAError(status_code=404, text='Issue Does Not Exist')
+        jira_mock.return_value.add_comment.side_effect = add_comment
+
+        self.client.post(self.url, payload)
+        process_jobs()
+        self.assertItemsEqual(issues, ['PROJ-2', 'PROJ-3', 'PROJ-4'])
+
+        # Only the issue that could not be updated is retried.
+        job = Job.objects.get()
+        self.assertEqual(json.loads(job.arguments)['issue_id'], 'PROJ-3')
+        jira_mock.return_value.add_comment.side_effect = None
+        Job.objects.update(run_after=timezone.now())
+        process_jobs()
+        self.assertEqual(Job.objects.count(), 0)
+        self.assertEqual(len(issues), 3)
+        self.assertEqual(jira_mock.return_value.add_comment.call_args[0][0],
+                         'PROJ-3')
+
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_resolve_missing_issue(self, jira_mock):
+        jira_mock.return_value.issue.side_effect = JIRAError(
+            status_code=404, text='Issue Does Not Exist')
+        # Nothing to retry.
+        update_issue('PROJ-2', True, mock_pull_request_payload())
+
     @override_settings(JIRA_TRANSITION_RESOLVE_NAME='Resolve')
     @patch('updater_for_jira.jirahelper.JIRA')
     def test_resolve_issue(self, jira_mock):
@@ -179,6 +259,7 @@ class JiraUpdaterTestCase(TestCase):
             {'id': '2', 'name': 'Resolve'},
         )
         response = self.client.post(self.url, payload)
+        process_jobs()
         jira_mock.return_value.issue.assert_called_with('PROJ-2')
         jira_mock.return_value.transition_issue.assert_called_with(
             issue_mock,
@@ -198,6 +279,130 @@ class JiraUpdaterTestCase(TestCase):
             {'id': '5', 'name': 'New'},
         )
         response = self.client.post(self.url, payload)
+        process_jobs()
         self.assertEqual(jira_mock.return_value.transitions.call_count, 2)
         self.assertEqual(jira_mock.return_value.add_comment.call_count, 0)
         self.assertEqual(jira_mock.return_value.transition_issue.call_count, 1)
+
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_client_reused(self, jira_mock):
+        payload = mock_pull_request_payload()
+        payload['pull_request']['body'] = 'BUG=PROJ-2'
+        self.client.post(self.url, payload)
+        process_jobs()
+        payload['pull_request']['body'] = 'BUG=PROJ-3'
+        self.client.post(self.url, payload)
+        process_jobs()
+
+        self.assertEqual(jira_mock.return_value.add_comment.call_count, 2)
+        self.assertEqual(jira_mock.call_count, 1)
+        self.assertEqual(jira_mock.return_value.server_info.call_count, 0)
+
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_reconnect_on_auth_failure(self, jira_mock):
+        expired_client = Mock()
+        expired_client.add_comment.side_effect = JIRAError(401)
+        new_client = Mock()
+        jira_mock.side_effect = [expired_client, new_client]
+
+        JiraHelper().comment_issue('PROJ-42', mock_pull_request_payload())
+        expired_client.add_comment.assert_called_with('PROJ-42', ANY)
+        new_client.add_comment.assert_called_with('PROJ-42', ANY)
+
+        JiraHelper().comment_issue('PROJ-43', mock_pull_request_payload())
+        self.assertEqual(jira_mock.call_count, 2)
+        self.assertEqual(expired_client.add_comment.call_count, 1)
+        self.assertEqual(new_client.add_comment.call_count, 2)
+
+    @override_settings(JIRA_HEALTH_CHECK_INTERVAL=60)
+    @patch('time.time')
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_health_check(self, jira_mock, time_mock):
+        time_mock.return_value = 1000
+        broken_client = Mock()
+        broken_client.server_info.side_effect = IOError('Broken pipe')
+        new_client = Mock()
+        jira_mock.side_effect = [broken_client, new_client]
+
+        JiraHelper().comment_issue('PROJ-42', mock_pull_request_payload())
+        time_mock.return_value = 1030
+        JiraHelper().comment_issue('PROJ-42', mock_pull_request_payload())
+        self.assertEqual(broken_client.server_info.call_count, 0)
+        self.assertEqual(broken_client.add_comment.call_count, 2)
+
+        # The client has been idle for too long, so check it first.
+        time_mock.return_value = 1100
+        JiraHelper().comment_issue('PROJ-42', mock_pull_request_payload())
+        self.assertEqual(broken_client.server_info.call_count, 1)
+        self.assertEqual(broken_client.add_comment.call_count, 2)
+        self.assertEqual(new_client.add_comment.call_count, 1)
+
+    def _mock_issue(self, issue_type='1', status='1'):
+        issue = Mock()
+        issue.fields.issuetype.id = issue_type
+        issue.fields.status.id = status
+        return issue
+
+    @override_settings(JIRA_TRANSITION_RESOLVE_NAME='Resolve')
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_transition_cached(self, jira_mock):
+        jira = jira_mock.return_value
+        jira.transitions.return_value = (
+            {'id': '1', 'name': 'Triage'},
+            {'id': '2', 'name': 'Resolve'},
+        )
+
+        jira.issue.return_value = self._mock_issue()
+        JiraHelper().resolve_issue('PROJ-2', mock_pull_request_payload())
+        jira.issue.return_value = self._mock_issue()
+        JiraHelper().resolve_issue('PROJ-3', mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 1)
+        self.assertEqual(jira.transition_issue.call_count, 2)
+        jira.transition_issue.assert_called_with(
+            jira.issue.return_value, '2', comment=ANY, resolution=ANY)
+
+        # Different project, issue type or status.
+        for issue_id, issue in (('OTHERPROJ-3', self._mock_issue()),
+                                ('PROJ-4', self._mock_issue(issue_type='2')),
+                                ('PROJ-5', self._mock_issue(status='2'))):
+            jira.issue.return_value = issue
+            JiraHelper().resolve_issue(issue_id, mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 4)
+
+    @override_settings(JIRA_TRANSITION_RESOLVE_NAME='Resolve')
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_transition_cache_invalidated(self, jira_mock):
+        jira = jira_mock.return_value
+        jira.issue.return_value = self._mock_issue()
+        jira.transitions.return_value = ({'id': '2', 'name': 'Resolve'},)
+        JiraHelper().resolve_issue('PROJ-2', mock_pull_request_payload())
+
+        # The workflow has changed.
+        jira.transition_issue.side_effect = JIRAError(400)
+        JiraHelper().resolve_issue('PROJ-3', mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 1)
+
+        jira.transition_issue.side_effect = None
+        jira.transitions.return_value = ({'id': '7', 'name': 'Resolve'},)
+        JiraHelper().resolve_issue('PROJ-3', mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 2)
+        jira.transition_issue.assert_called_with(
+            jira.issue.return_value, '7', comment=ANY, resolution=ANY)
+
+    @override_settings(JIRA_TRANSITION_CACHE_TTL=60,
+                       JIRA_TRANSITION_RESOLVE_NAME='Resolve')
+    @patch('time.time')
+    @patch('updater_for_jira.jirahelper.JIRA')
+    def test_transition_cache_expired(self, jira_mock, time_mock):
+        jira = jira_mock.return_value
+        jira.issue.return_value = self._mock_issue()
+        jira.transitions.return_value = ({'id': '2', 'name': 'Resolve'},)
+
+        time_mock.return_value = 1000
+        JiraHelper().resolve_issue('PROJ-2', mock_pull_request_payload())
+        time_mock.return_value = 1030
+        JiraHelper().resolve_issue('PROJ-2', mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 1)
+        time_mock.return_value = 1100
+        JiraHelper().resolve_issue('PROJ-2', mock_pull_request_payload())
+        self.assertEqual(jira.transitions.call_count, 2)
@@ -27,9 +27,51 @@ import re
 from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.http import require_POST
-from jirahelper import JiraHelper
 
 from github_webhooks.decorators import add_github_payload, require_github_signature
+from github_webhooks.decorators import filter_github_events
+from github_webhooks.decorators import ignore_duplicate_deliveries
+from github_webhooks.dispatch import pull_request_consumer
+from github_webhooks.jobs import enqueue
+
+
+# Cache for _issue_regexp(): a (JIRA_PROJECTS, compiled regexp) tuple.
+_issue_regexp_cache = (None, None)
+
+# Matches the end of a line the same way str.splitlines() does for the line
+# endings we care about.
+_line_end_regexp = re.compile(r'[\r\n]')
+
+
+def _issue_regexp():
+    """
+    Returns a compiled regular expression that matches both "BUG=" right after
+    a line break (in the first group) and the issue IDs of all projects in
+    settings.JIRA_PROJECTS (in the second group).
+    The expression is only compiled again when JIRA_PROJECTS changes.
+    """
+    global _issue_regexp_cache
+    projects = tuple(settings.JIRA_PROJECTS)
+    cached_projects, regexp = _issue_regexp_cache
+    if cached_projects != projects:
+        # This becomes something like "(?:FOO|BAR)-\d+" to match all prefixes.
+        pattern = r'[\r\n](BUG=)|((?:%s)-\d+)' % \
+                  '|'.join(re.escape(p) for p in projects)
+        # Starting with a lookahead for all possible first characters lets
+        # the regexp engine skip quickly over the text that cannot match,
+        # which is most of it.
+        if all(projects):
+            first_chars = set(p[0] for p in projects) | set('\r\n')
+            pattern = r'(?=[%s])(?:%s)' % \
+                      (''.join(re.escape(c) for c in first_chars), pattern)
+        regexp = re.compile(pattern)
+        _issue_regexp_cache = (projects, regexp)
+    return regexp
+
+
+def _line_end(text, pos):
+    match = _line_end_regexp.search(text, pos)
+    return match.start() if match else len(text)
 
 
 def search_issues(pr_body):
@@ -42,44 +84,60 @@ def search_issues(pr_body):
            the issue is fixed by this PR>
     }
     """
+    # Maps each issue ID to whether it should be resolved.
     issues = {}
-    # This becomes something like "((?:FOO|BAR)-\d+)" to match all prefixes.
-    regexp_pattern = r'((?:%s)-\d+)' % '|'.join(settings.JIRA_PROJECTS)
-    regexp = re.compile(regexp_pattern)
-    for line in pr_body.splitlines():
-        for issue in regexp.findall(line):
-            should_resolve = line.startswith('BUG=')
-            issues[issue] = {'id': issue, 'resolve': should_resolve}
-    # Create a list with the values in the dict.
-    flattened_issues = [v for v in issues.values()]
-    return flattened_issues
+    # The body is scanned only once: when a line starting with "BUG=" is
+    # found, we remember where it ends, and every issue found before that
+    # position is one that should be resolved.
+    bug_line_end = -1
+    if pr_body.startswith('BUG='):
+        bug_line_end = _line_end(pr_body, 0)
+    for match in _issue_regexp().finditer(pr_body):
+        issue = match.group(2)
+        if issue is None:
+            bug_line_end = _line_end(pr_body, match.end())
+        else:
+            issues[issue] = match.start() < bug_line_end
+    return [{'id': issue_id, 'resolve': resolve}
+            for issue_id, resolve in issues.iteritems()]
 
 
-@require_POST
-@require_github_signature
-@add_github_payload
-def handle_pull_request(request):
-    payload = request.payload
+def issues_to_update(payload):
+    """
+    Returns a list of (issue ID, whether to resolve it) tuples with the JIRA
+    issues to comment on or resolve because of the pull_request event
+    |payload|.
+    """
     pr_body = payload['pull_request']['body']
-    pr_action = payload['action']
-
     # This happens when a pull request only has a title and no message body.
     if pr_body is None:
-        logging.info('Pull request %d has an empty body. Skipping.')
-        return HttpResponse()
-
-    jira = JiraHelper()
-    for issue in search_issues(pr_body):
-        if pr_action == 'opened':
-            jira.comment_issue(issue['id'], payload)
-            logging.debug('Commented on issue %s' % issue['id'])
-        elif pr_action == 'closed' and\
-                payload['pull_request']['merged'] and\
-                issue['resolve']:
-            jira.resolve_issue(issue['id'], payload)
-            logging.debug('Resolved issue %s' % issue['id'])
-        else:
-            logging.debug('Nothing to do with issue %s' %
-                          issue['id'])
+        logging.info('Pull request %d has an empty body. Skipping.' %
+                     payload['pull_request']['number'])
+        return []
+
+    action = payload['action']
+    if action == 'opened':
+        return [(issue['id'], False) for issue in search_issues(pr_body)]
+    if action == 'closed' and payload['pull_request']['merged']:
+        return [(issue['id'], True) for issue in search_issues(pr_body)
+                if issue['resolve']]
+    return []
+
 
+@pull_request_consumer(actions=('opened', 'closed'))
+def on_pull_request_changed(payload):
+    # Talking to JIRA is slow, so it is done later by a job for each issue.
+    for issue_id, resolve in issues_to_update(payload):
+        enqueue('updater_for_jira.handlers.update_issue', issue_id=issue_id,
+                resolve=resolve, payload=payload)
+
+
+@require_POST
+@require_github_signature
+@filter_github_events(['pull_request'],
+                      actions=on_pull_request_changed.event_filter.actions)
+@add_github_payload
+@ignore_duplicate_deliveries
+def handle_pull_request(request):
+    on_pull_request_changed(request.payload)
     return HttpResponse()